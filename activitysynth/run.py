@@ -7,7 +7,8 @@ import s3fs
 from datetime import datetime
 import os
 
-from activitysynth.scripts import models, datasources, variables
+from activitysynth.scripts import (
+    models, datasources, variables, utils, loaders)
 
 
 warnings.simplefilter('ignore')
@@ -15,10 +16,18 @@ warnings.simplefilter('ignore')
 
 # default runtime args
 scenario = None
-accessibilities_mode = 'compute'
+accessibilities_mode = 'cache'
+access_workers = 1
+access_threads = None
+prefetch_workers = None
+arrow_backed = False
+wlcm_workers = None
+wlcm_max_rounds = 1
 data_out = './output/model_data_output.h5'
 output_store = False
 input_file_format = 'csv'
+# consolidated input store read in h5 mode, in the input data dir
+input_store_fname = 'model_data.h5'
 formattable_fname_dict = {
     'parcels': 'parcels.{0}',
     'buildings': 'buildings.{0}',
@@ -51,10 +60,21 @@ output_tables = [
 # default input data dir
 input_data_dir = './data/'
 
+initialization_steps = [
+    'initialize_network_small',
+    'initialize_network_walk',
+    'initialize_imputed_skims'
+]
+simulation_steps = [
+    'wlcm_simulate', 'TOD_choice_simulate',
+    'TOD_distribution_simulate',
+    'auto_ownership_simulate', 'primary_mode_choice_simulate',
+    'generate_activity_plans']
+
 
 def format_fname_dict(formattable_fname_dict, format='csv'):
     formatted_dict = {
-        k: v.format('csv')
+        k: v.format(format)
         for k, v in formattable_fname_dict.items()}
     return formatted_dict
 
@@ -72,7 +92,7 @@ if __name__ == "__main__":
 
     parser.add_argument(
         "--input-file-format", "-f", dest='input_file_format', action="store",
-        help="options: h5, csv, parquet")
+        help="options: h5, csv, parquet, feather")
 
     parser.add_argument(
         '-o', action='store_true', dest='output_store',
@@ -83,9 +103,54 @@ if __name__ == "__main__":
         help='full filepath for output data')
 
     parser.add_argument(
-        "--access-vars-mode", "-a", help="option: compute, stored",
+        "--access-vars-mode", "-a", help="option: cache, compute, stored",
         action="store", dest='accessibilities_mode')
 
+    parser.add_argument(
+        '--skims-chunksize', action='store', dest='skims_chunksize',
+        type=int, help='impute raw skims in chunks of this many records')
+
+    parser.add_argument(
+        '--access-workers', action='store', dest='access_workers',
+        type=int, help='number of processes to compute access vars with')
+
+    parser.add_argument(
+        '--access-threads', action='store', dest='access_threads',
+        type=int, help='max threads per access vars worker process')
+
+    parser.add_argument(
+        '--prefetch-workers', action='store', dest='prefetch_workers',
+        type=int, help='number of workers to load input tables with '
+        'before the first step, 0 to load them as they are used')
+
+    parser.add_argument(
+        '--wlcm-workers', action='store', dest='wlcm_workers', type=int,
+        help='number of processes to simulate workplace location choices '
+        'with, in chooser batches')
+
+    parser.add_argument(
+        '--wlcm-rounds', action='store', dest='wlcm_max_rounds', type=int,
+        help='max number of rounds in which workplace location choosers '
+        'that lose a capacity conflict draw again, with --wlcm-workers')
+
+    parser.add_argument(
+        '--arrow', action='store_true', dest='arrow_backed',
+        help='keep input tables in Arrow memory, memory-mapping feather '
+        'inputs and holding strings as pyarrow strings')
+
+    parser.add_argument(
+        '--convert-inputs', action='store', dest='convert_inputs',
+        nargs='?', const='h5', choices=['h5', 'feather'],
+        help='write the csv or parquet inputs to a single h5 store, or to '
+        'feather files, in the input data dir, to run from with "-f h5" '
+        'or "-f feather", and exit')
+
+    parser.add_argument(
+        '--scenario', action='store', dest='scenario', nargs='+',
+        help='names of steps that edit the input tables before the '
+        'simulation, with the network accessibility variables updated '
+        'for the records they change')
+
     options = parser.parse_args()
 
     if options.input_file_format:
@@ -103,6 +168,33 @@ if __name__ == "__main__":
     if options.accessibilities_mode:
         accessibilities_mode = options.accessibilities_mode
 
+    if options.access_workers:
+        access_workers = options.access_workers
+
+    if options.access_threads:
+        access_threads = options.access_threads
+
+    if options.prefetch_workers is not None:
+        prefetch_workers = options.prefetch_workers
+
+    if options.arrow_backed:
+        arrow_backed = options.arrow_backed
+    orca.add_injectable('arrow_backed', arrow_backed)
+
+    if options.wlcm_workers:
+        wlcm_workers = options.wlcm_workers
+    orca.add_injectable('wlcm_workers', wlcm_workers)
+
+    if options.wlcm_max_rounds:
+        wlcm_max_rounds = options.wlcm_max_rounds
+    orca.add_injectable('wlcm_max_rounds', wlcm_max_rounds)
+
+    if options.scenario:
+        scenario = options.scenario
+
+    if options.skims_chunksize:
+        orca.add_injectable('skims_chunksize', options.skims_chunksize)
+
     if options.input_data_dir:
         input_data_dir = options.input_data_dir
 
@@ -110,16 +202,15 @@ if __name__ == "__main__":
     orca.add_injectable('input_data_dir', input_data_dir)
     print('Reading input data from {0}'.format(input_data_dir))
 
-    # h5 inputs not currently operational
     if input_file_format == 'h5':
         @orca.injectable('store', cache=True)
         def hdfstore():
             return pd.HDFStore(
-                input_data_dir + "model_data_output.h5", mode='r')
+                os.path.join(input_data_dir, input_store_fname), mode='r')
         orca.add_injectable('input_fnames', None)  # h5 mode has no fnames
 
     # data modes that store data as individual files
-    elif input_file_format == 'parquet' or input_file_format == 'csv':
+    elif input_file_format in ['csv', 'parquet', 'feather']:
         orca.add_injectable('store', None)
         input_fnames = format_fname_dict(
             formattable_fname_dict, input_file_format)
@@ -128,24 +219,51 @@ if __name__ == "__main__":
     else:
         raise ValueError(
             'Must specifiy a valid input file format. Valid options '
-            'include "csv", "h5", and "parquet".')
+            'include "csv", "h5", "parquet" and "feather".')
+
+    if options.convert_inputs:
+        if input_file_format not in ['csv', 'parquet']:
+            raise ValueError('Inputs to convert must be csv or parquet.')
+        if options.convert_inputs == 'feather':
+            loaders.write_feather_inputs(
+                input_file_format, input_data_dir, input_fnames,
+                format_fname_dict(formattable_fname_dict, 'feather'))
+        else:
+            loaders.convert_inputs(
+                input_file_format, input_data_dir, input_fnames,
+                os.path.join(input_data_dir, input_store_fname))
+        raise SystemExit()
+
+    # load the input tables the run will need side by side rather than
+    # one at a time as each step first asks for them. h5 stores are not
+    # safe to read from several threads.
+    if prefetch_workers != 0 and input_file_format != 'h5':
+        utils.prefetch_tables(
+            utils.source_tables(
+                initialization_steps +
+                list(models.accessibility_step_outputs) +
+                (scenario or []) + simulation_steps),
+            processes=input_file_format == 'csv',
+            max_workers=prefetch_workers)
 
     # initialize networks
-    model_steps = [
-        'initialize_network_small',
-        'initialize_network_walk',
-        'initialize_imputed_skims'
-    ]
+    orca.run(initialization_steps)
+
+    # compute access vars, reusing cached results computed from the
+    # same inputs unless a full recompute is requested
+    if accessibilities_mode in ['cache', 'compute']:
+        orca.add_injectable(
+            'use_access_cache', accessibilities_mode == 'cache')
 
-    orca.run(model_steps)
+        # the aggregation steps read disjoint networks and write
+        # disjoint tables, so they can run side by side
+        utils.run_steps_in_parallel(
+            models.accessibility_step_outputs,
+            max_workers=access_workers,
+            threads_per_worker=access_threads)
 
     # create and save access vars if not run before
     if accessibilities_mode == 'compute':
-        model_steps = [
-            'network_aggregations_small',
-            'network_aggregations_walk',
-            'skims_aggregations']
-        orca.run(model_steps)
 
         orca.get_table('nodeswalk').to_frame().to_csv(
             os.path.join(input_data_dir, input_fnames['walk_access_vars']))
@@ -174,14 +292,11 @@ if __name__ == "__main__":
         # one containing zone-level accessibility variables
         orca.add_table('zones', zones)
 
-    model_steps = [
-        'wlcm_simulate', 'TOD_choice_simulate',
-        'TOD_distribution_simulate',
-        'auto_ownership_simulate', 'primary_mode_choice_simulate',
-        'generate_activity_plans']
+    if scenario:
+        models.run_scenario(scenario)
 
     orca.run(
-        model_steps,
+        simulation_steps,
         data_out=data_out,
         out_base_tables=[],
         out_base_local=True,
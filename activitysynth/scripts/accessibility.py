@@ -0,0 +1,416 @@
+import re
+from collections import OrderedDict
+
+import orca
+import pandas as pd
+import numpy as np
+import yaml
+from scipy import sparse
+from scipy.sparse import csgraph
+from urbansim.models import util
+from urbansim.utils import misc
+
+
+def _parse_variable_definitions(cfg):
+    """
+    Normalize the variable definitions of a network aggregations config,
+    filling in the same defaults as urbansim.utils.networks.from_yaml.
+    """
+    default_node_col = cfg.get('node_col', None)
+    definitions = []
+    for variable in cfg['variable_definitions']:
+        filters = variable.get('filters', None)
+        if isinstance(filters, str):
+            filters = [filters]
+        definitions.append({
+            'name': variable['name'],
+            'dataframe': variable['dataframe'],
+            'varname': variable.get('varname', None),
+            'filters': tuple(filters) if filters else None,
+            'node_col': variable.get('node_col', default_node_col),
+            'radius': variable['radius'],
+            'aggregation': variable.get('aggregation', 'sum'),
+            'decay': variable.get('decay', 'linear'),
+            'apply': variable.get('apply', None)})
+    return definitions
+
+
+def _load_variable_definitions(cfgname):
+    with open(misc.config(cfgname)) as f:
+        return _parse_variable_definitions(yaml.safe_load(f))
+
+
+def _filter_columns(filters, columns):
+    """
+    Columns of a table that a list of filter queries refers to.
+    """
+    if not filters:
+        return set()
+    names = set(re.findall(r'[A-Za-z_][A-Za-z0-9_]*', ' '.join(filters)))
+    return names & set(columns)
+
+
+def _group_definitions(definitions):
+    """
+    Group variable definitions so that each source table is loaded once
+    and each (filters, node_col, varname) combination is handed to
+    pandana once for all the radii/aggregations computed from it.
+
+    Returns
+    -------
+    OrderedDict
+        {dataframe: OrderedDict({(filters, node_col, varname): [defs]})}
+    """
+    groups = OrderedDict()
+    for definition in definitions:
+        key = (
+            definition['filters'], definition['node_col'],
+            definition['varname'])
+        groups.setdefault(
+            definition['dataframe'], OrderedDict()).setdefault(
+            key, []).append(definition)
+    return groups
+
+
+def _table_columns(df_groups, table_columns):
+    """
+    Columns of a source table needed by a group of variable definitions.
+    """
+    columns = set()
+    for filters, node_col, varname in df_groups:
+        assert node_col is not None, 'Need to specify a node_col in config'
+        columns.add(node_col)
+        if varname is not None:
+            columns.add(varname)
+        columns |= _filter_columns(filters, table_columns)
+    return sorted(columns)
+
+
+def from_yaml(net, cfgname):
+    """
+    Batched version of urbansim.utils.networks.from_yaml.
+
+    Rather than materializing the full source table and calling
+    net.set() once per variable, every source table is read once with
+    only the columns the config needs, every filter is applied once,
+    and every filtered variable is set on the network once and then
+    aggregated for each of the radii, aggregation types and decays it
+    is requested with.
+
+    Parameters
+    ----------
+    net : pandana.Network
+    cfgname : str
+        Name of the network aggregations config in the configs dir.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One column per variable definition, indexed by network node id.
+    """
+    print('Computing accessibility variables')
+    definitions = _load_variable_definitions(cfgname)
+
+    nodes = pd.DataFrame(index=net.node_ids)
+
+    for dfname, df_groups in _group_definitions(definitions).items():
+        table = orca.get_table(dfname)
+        df = table.to_frame(columns=_table_columns(df_groups, table.columns))
+
+        for (filters, node_col, varname), group in df_groups.items():
+            sub = util.apply_filter_query(df, list(filters)) \
+                if filters else df
+            net.set(
+                sub[node_col],
+                variable=sub[varname] if varname is not None else None,
+                name=dfname)
+
+            for definition in group:
+                name = definition['name']
+                print('Computing {0}'.format(name))
+                nodes[name] = net.aggregate(
+                    definition['radius'], type=definition['aggregation'],
+                    decay=definition['decay'], name=dfname)
+                if definition['apply'] is not None:
+                    nodes[name] = nodes[name].apply(
+                        eval(definition['apply']))
+
+    return nodes[[definition['name'] for definition in definitions]]
+
+
+# aggregations that are linear in the source values, so that they can
+# be updated by aggregating only the change in the source values
+linear_aggregations = ['sum']
+
+
+def _decay_weights(dist, radius, decay):
+    """
+    Weight of a source at network distance `dist`, as defined by pandana.
+    """
+    if decay == 'flat':
+        return np.ones_like(dist)
+    elif decay == 'linear':
+        return 1 - dist / radius
+    elif decay == 'exp':
+        return np.exp(-dist / radius)
+    raise ValueError('Unknown decay {0}'.format(decay))
+
+
+def _network_graph(node_ids, edges, twoway, impedance='length'):
+    """
+    Sparse directed graph of the network with edge impedances in
+    thousandths as weights, with rows/columns in the order of `node_ids`.
+    """
+    pos = pd.Series(np.arange(len(node_ids)), index=node_ids)
+    u = pos.reindex(edges['u'].values).values
+    v = pos.reindex(edges['v'].values).values
+    # pandana's contraction hierarchy holds impedances as integer
+    # thousandths, truncating every edge. Keeping them whole keeps path
+    # lengths exact, so that sources right at the radius are in range.
+    w = np.floor(edges[impedance].values.astype(float) * 1000)
+    valid = ~(np.isnan(u) | np.isnan(v))
+    u, v, w = u[valid].astype(int), v[valid].astype(int), w[valid]
+    if twoway:
+        u, v, w = np.concatenate([u, v]), np.concatenate([v, u]), \
+            np.concatenate([w, w])
+
+    # keep the shortest of any parallel edges. scipy treats explicit
+    # zero weights as missing edges, so zero-length edges are nudged.
+    od = pd.DataFrame({'u': u, 'v': v, 'w': w}).groupby(['u', 'v']).w.min()
+    weights = np.maximum(od.values, 1e-9)
+    return sparse.csr_matrix(
+        (weights, (od.index.get_level_values('u'),
+                   od.index.get_level_values('v'))),
+        shape=(len(node_ids), len(node_ids)))
+
+
+def _distances(graph, positions, radius, batch_size=64):
+    """
+    Yield (positions, distances) for batches of source positions, with
+    distances from each source to every node, inf beyond `radius`.
+    """
+    for start in range(0, len(positions), batch_size):
+        batch = positions[start:start + batch_size]
+        yield batch, csgraph.dijkstra(
+            graph, directed=True, indices=batch, limit=radius * 1000) / 1000
+
+
+def _changed_records(old, new, columns):
+    """
+    Records of a source table that were removed or modified (as they
+    were before) and that were added or modified (as they are now).
+    """
+    old = old[columns]
+    new = new[columns]
+    common = old.index.intersection(new.index)
+    o = old.loc[common]
+    n = new.loc[common]
+    same = ((o == n) | (o.isnull() & n.isnull())).all(axis=1).values
+    modified = common[~same]
+    return (
+        old.loc[old.index.difference(new.index).union(modified)],
+        new.loc[new.index.difference(old.index).union(modified)])
+
+
+def _source_values(df, definition):
+    """
+    Node positions and values of the records a definition aggregates.
+    """
+    if definition['filters']:
+        df = util.apply_filter_query(df, list(definition['filters']))
+    if definition['varname'] is None:
+        values = pd.Series(1.0, index=df.index)
+    else:
+        values = df[definition['varname']].astype(float)
+    return df[definition['node_col']], values
+
+
+def _aggregate(values, weights, aggregation):
+    """
+    Aggregate the source values within range of one node, following
+    pandana's definitions of each aggregation type.
+    """
+    if len(values) == 0:
+        return 0.0
+    if aggregation == 'sum':
+        return (values * weights).sum()
+    elif aggregation == 'count':
+        # pandana counts every source in range, whatever the decay
+        return float(len(values))
+    elif aggregation in ['ave', 'mean']:
+        return (values * weights).sum() / len(values)
+    elif aggregation == 'min':
+        return values.min()
+    elif aggregation == 'max':
+        return values.max()
+    elif aggregation == 'median':
+        return np.median(values)
+    elif aggregation in ['std', 'stddev']:
+        return values.std()
+    raise ValueError('Unknown aggregation {0}'.format(aggregation))
+
+
+def _recompute_nodes(graph, positions, node_ids, source_nodes, values,
+                     definition):
+    """
+    Recompute one variable from scratch at the given node positions.
+    """
+    pos = pd.Series(np.arange(len(node_ids)), index=node_ids)
+    src = pos.reindex(source_nodes.values).values
+    valid = ~np.isnan(src)
+    src = src[valid].astype(int)
+    vals = values.values[valid]
+
+    # records sorted by node, with the range of records at each node
+    order = np.argsort(src, kind='mergesort')
+    src, vals = src[order], vals[order]
+    starts = np.searchsorted(src, np.arange(len(node_ids)), side='left')
+    ends = np.searchsorted(src, np.arange(len(node_ids)), side='right')
+
+    radius = definition['radius']
+    results = np.zeros(len(positions))
+    i = 0
+    for batch, dists in _distances(graph, positions, radius):
+        for row in dists:
+            reach = np.flatnonzero(row <= radius)
+            counts = ends[reach] - starts[reach]
+            has = counts > 0
+            reach, counts = reach[has], counts[has]
+            idx = np.repeat(starts[reach] - np.cumsum(counts) + counts,
+                            counts) + np.arange(counts.sum())
+            weights = np.repeat(
+                _decay_weights(row[reach], radius, definition['decay']),
+                counts)
+            results[i] = _aggregate(
+                vals[idx], weights, definition['aggregation'])
+            i += 1
+    return results
+
+
+def source_frames(cfgname):
+    """
+    Snapshot of the source tables of a network aggregations config,
+    restricted to the columns its variables need. Take one before a
+    scenario edits the tables, to pass to update_from_yaml afterwards.
+    """
+    definitions = _load_variable_definitions(cfgname)
+    frames = {}
+    for dfname, df_groups in _group_definitions(definitions).items():
+        table = orca.get_table(dfname)
+        frames[dfname] = table.to_frame(
+            columns=_table_columns(df_groups, table.columns))
+    return frames
+
+
+def update_from_yaml(nodes, cfgname, edges, old_tables, new_tables,
+                     twoway, impedance='length'):
+    """
+    Incrementally update network aggregations computed by from_yaml
+    after some records of their source tables have changed.
+
+    Only the records that were added, removed or modified are looked
+    at. For sums, the change in the source values at the affected
+    source nodes is aggregated over the network and added to the
+    existing results. For every other aggregation type the variable is
+    recomputed from scratch, but only at the nodes within its radius of
+    an affected source node. Network distances come from Dijkstra
+    searches bounded by each variable's radius, so the work scales with
+    the size of the changed neighborhoods rather than the region.
+
+    Parameters
+    ----------
+    nodes : pandas.DataFrame
+        Results of from_yaml for the source tables in `old_tables`,
+        indexed by network node id.
+    cfgname : str
+        Name of the network aggregations config in the configs dir.
+    edges : pandas.DataFrame
+        Network edges with 'u', 'v' and `impedance` columns.
+    old_tables, new_tables : dict
+        {dataframe name: pandas.DataFrame} with the before and after
+        versions of every changed source table, indexed by their
+        primary keys. They must include the node_col, varname and
+        filter columns of the variables computed from them. Variables
+        whose source table is not included are left as they are.
+    twoway : bool
+        Whether the network edges are traversable both ways.
+    impedance : str, optional
+
+    Returns
+    -------
+    pandas.DataFrame
+        Updated copy of `nodes`.
+    """
+    definitions = _load_variable_definitions(cfgname)
+    nodes = nodes.copy()
+    node_ids = nodes.index.values
+    graph = _network_graph(node_ids, edges, twoway, impedance)
+    # sources reach node i if they are within range *from* i, so
+    # searches starting from sources run on the reversed graph
+    reverse_graph = graph.T.tocsr()
+    pos = pd.Series(np.arange(len(node_ids)), index=node_ids)
+
+    for dfname, df_groups in _group_definitions(definitions).items():
+        if dfname not in new_tables:
+            continue
+        old, new = old_tables[dfname], new_tables[dfname]
+        columns = _table_columns(df_groups, new.columns)
+        old_changed, new_changed = _changed_records(old, new, columns)
+        print('{0} changed {1} records'.format(
+            dfname, len(old_changed.index.union(new_changed.index))))
+        if len(old_changed) == 0 and len(new_changed) == 0:
+            continue
+
+        for group in df_groups.values():
+            for definition in group:
+                name = definition['name']
+                radius = definition['radius']
+                old_nodes, old_values = _source_values(
+                    old_changed, definition)
+                new_nodes, new_values = _source_values(
+                    new_changed, definition)
+                delta = new_values.groupby(new_nodes.values).sum().sub(
+                    old_values.groupby(old_nodes.values).sum(),
+                    fill_value=0)
+                # sorted positions of the nodes with changed records
+                sources = np.unique(pos.reindex(np.concatenate([
+                    old_nodes.values, new_nodes.values])).dropna().values
+                ).astype(int)
+                if len(sources) == 0:
+                    continue
+
+                if definition['aggregation'] in linear_aggregations and \
+                        definition['apply'] is None:
+                    delta = delta.reindex(node_ids[sources]).fillna(0).values
+                    update = np.zeros(len(node_ids))
+                    for batch, dists in _distances(
+                            reverse_graph, sources, radius):
+                        in_range = dists <= radius
+                        weights = np.where(in_range, _decay_weights(
+                            np.where(in_range, dists, 0), radius,
+                            definition['decay']), 0)
+                        update += delta[np.searchsorted(
+                            sources, batch)].dot(weights)
+                    nodes[name] = nodes[name] + update
+                    print('Updated {0} incrementally'.format(name))
+                    continue
+
+                affected = np.zeros(len(node_ids), dtype=bool)
+                for batch, dists in _distances(
+                        reverse_graph, sources, radius):
+                    affected |= (dists <= radius).any(axis=0)
+                affected = np.flatnonzero(affected)
+
+                source_nodes, values = _source_values(
+                    new[columns], definition)
+                results = _recompute_nodes(
+                    graph, affected, node_ids, source_nodes, values,
+                    definition)
+                if definition['apply'] is not None:
+                    results = pd.Series(results).apply(
+                        eval(definition['apply'])).values
+                nodes.iloc[affected, nodes.columns.get_loc(name)] = results
+                print('Recomputed {0} at {1} nodes'.format(
+                    name, len(affected)))
+
+    return nodes
@@ -0,0 +1,141 @@
+import numpy as np
+
+
+def draw(probs, rng):
+    """
+    One Monte Carlo draw per row of a matrix of choice probabilities.
+
+    Parameters
+    ----------
+    probs : numpy.ndarray
+        (n, k) non-negative weights, rows need not be normalized.
+    rng : numpy.random.Generator
+
+    Returns
+    -------
+    numpy.ndarray
+        Column drawn for each row.
+    """
+    cum = probs.cumsum(axis=1)
+    u = rng.random(len(probs)) * cum[:, -1]
+    return np.minimum((cum <= u[:, None]).sum(axis=1), probs.shape[1] - 1)
+
+
+def accept(alts, sizes, remaining):
+    """
+    Accept the choices that fit in the remaining capacity of their
+    alternatives, in the order the choosers are given in.
+
+    A chooser that does not fit is skipped over, so that smaller
+    choosers behind it can still take the capacity it leaves.
+
+    Parameters
+    ----------
+    alts : numpy.ndarray
+        Chosen alternative position of each chooser, in priority order.
+    sizes : numpy.ndarray
+        Size of each chooser.
+    remaining : numpy.ndarray
+        Remaining capacity of every alternative.
+
+    Returns
+    -------
+    numpy.ndarray
+        Boolean mask of the accepted choices.
+    """
+    accepted = np.zeros(len(alts), dtype=bool)
+    if (sizes == 1).all() and (remaining <= 1).all():
+        # unit capacities: the first chooser of each alternative wins
+        first = np.unique(alts, return_index=True)[1]
+        accepted[first] = remaining[alts[first]] >= 1
+        return accepted
+
+    left = remaining.astype(float)
+    undecided = sizes <= left[alts]
+    while undecided.any():
+        idx = np.flatnonzero(undecided)
+        idx = idx[np.argsort(alts[idx], kind='stable')]
+        sorted_alts = alts[idx]
+        starts = np.r_[0, np.flatnonzero(np.diff(sorted_alts)) + 1]
+        group_start = np.repeat(starts, np.diff(np.r_[starts, len(idx)]))
+
+        # every chooser ahead of the first one that overflows its
+        # alternative fits
+        cum_sizes = np.cumsum(sizes[idx])
+        overflows = cum_sizes - np.r_[0, cum_sizes][group_start] > \
+            left[sorted_alts]
+        cum_overflows = np.cumsum(overflows)
+        fits = cum_overflows - np.r_[0, cum_overflows][group_start] == 0
+
+        accepted[idx[fits]] = True
+        left -= np.bincount(
+            sorted_alts[fits], weights=sizes[idx[fits]],
+            minlength=len(left))
+        undecided[idx[fits]] = False
+
+        # the others can only take what the choosers ahead left over
+        rest = idx[~fits]
+        undecided[rest] = sizes[rest] <= left[alts[rest]]
+    return accepted
+
+
+def assign(alt_pos, probs, sizes, remaining, rng, max_rounds=10):
+    """
+    Capacity-constrained assignment of choosers to alternatives from
+    their sampled choice sets, in vectorized rounds.
+
+    In the first round every chooser draws an alternative from its
+    whole choice set, and choosers are accepted in priority order while
+    capacity lasts. Only the choosers that lost a conflict draw again
+    in the next rounds, among the alternatives of their choice set that
+    still have room for them. Choosers whose sampled alternatives are
+    all full are left unassigned, to sample a new choice set.
+
+    Parameters
+    ----------
+    alt_pos : numpy.ndarray
+        (n, k) positions of the sampled alternatives, choosers in
+        priority order.
+    probs : numpy.ndarray
+        (n, k) choice probabilities of the sampled alternatives.
+    sizes : numpy.ndarray
+        Size of each chooser.
+    remaining : numpy.ndarray
+        Remaining capacity of every alternative. Updated in place.
+    rng : numpy.random.Generator
+    max_rounds : int, optional
+        Maximum number of rounds. Choosers still pending afterwards are
+        left unassigned.
+
+    Returns
+    -------
+    chosen : numpy.ndarray
+        Position of the alternative assigned to each chooser, -1 if
+        none was.
+    conflicts : list of int
+        Number of choosers that lost a conflict in each round.
+    """
+    chosen = np.full(len(alt_pos), -1)
+    pending = np.arange(len(alt_pos))
+    conflicts = []
+
+    for i in range(max_rounds):
+        p = probs[pending]
+        if i > 0:
+            fits = remaining[alt_pos[pending]] >= sizes[pending, None]
+            p = np.where(fits, p, 0)
+            has_room = p.sum(axis=1) > 0
+            pending, p = pending[has_room], p[has_room]
+        if not len(pending):
+            break
+
+        alts = alt_pos[pending, draw(p, rng)]
+        accepted = accept(alts, sizes[pending], remaining)
+        remaining -= np.bincount(
+            alts[accepted], weights=sizes[pending[accepted]],
+            minlength=len(remaining))
+        chosen[pending[accepted]] = alts[accepted]
+        pending = pending[~accepted]
+        conflicts.append(len(pending))
+
+    return chosen, conflicts
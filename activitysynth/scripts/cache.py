@@ -0,0 +1,152 @@
+import os
+import pickle
+import hashlib
+
+import pandas as pd
+import numpy as np
+
+
+def cache_key(*parts):
+    """
+    Hex digest identifying a cached result by everything it depends on.
+    """
+    h = hashlib.sha1()
+    for part in parts:
+        h.update(repr(part).encode('utf-8'))
+        h.update(b';')
+    return h.hexdigest()
+
+
+def load_node_index(path, fingerprint, get_net):
+    """
+    Load the spatial index of a network's nodes from the local cache,
+    or build it and add it to the cache.
+
+    Parameters
+    ----------
+    path : str
+        Directory to keep cached indexes in.
+    fingerprint : str or None
+        Identifier of the network inputs. None disables the cache.
+    get_net : callable
+        Returns the pandana.Network. Only called on a cache miss, so
+        that a cached index does not need the network to be built.
+
+    Returns
+    -------
+    (scipy.spatial.cKDTree, numpy.ndarray)
+        The tree over the node coordinates and the node id of each of
+        its points.
+    """
+    from scipy.spatial import cKDTree
+
+    fname = None
+    if fingerprint is not None:
+        fname = os.path.join(path, cache_key(fingerprint) + '.kdtree.pkl')
+        if os.path.exists(fname):
+            with open(fname, 'rb') as f:
+                return pickle.load(f)
+
+    nodes = get_net().nodes_df
+    index = (cKDTree(nodes[['x', 'y']].values), nodes.index.values)
+    if fname is not None:
+        if not os.path.exists(path):
+            os.makedirs(path)
+        with open(fname + '.tmp', 'wb') as f:
+            pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(fname + '.tmp', fname)
+    return index
+
+
+def load_node_ids(path, fingerprint, get_net, x, y, chunksize=1000000):
+    """
+    Nearest network node of each point, as returned by
+    pandana.Network.get_node_ids, from the local cache if the points and
+    the network are unchanged since they were last mapped.
+
+    On a cache miss the points are matched against the cached spatial
+    index of the network in chunks of `chunksize`, with each chunk's
+    queries spread over every core.
+
+    Parameters
+    ----------
+    path : str
+        Directory to keep cached indexes and mappings in.
+    fingerprint : str or None
+        Identifier of the network inputs. None disables the cache.
+    get_net : callable
+        Returns the pandana.Network. Only called on a cache miss.
+    x, y : pandas.Series
+        Coordinates of the points, with a shared index.
+    chunksize : int, optional
+
+    Returns
+    -------
+    pandas.Series
+        Node ids named 'node_id' and indexed like `x`. NaN where a
+        point has no coordinates.
+    """
+    points = pd.DataFrame({'x': x, 'y': y})
+
+    fname = None
+    if fingerprint is not None:
+        h = hashlib.sha1(
+            pd.util.hash_pandas_object(points, index=True).values.tobytes())
+        fname = os.path.join(path, cache_key(
+            fingerprint, h.hexdigest()) + '.parquet')
+        node_ids = load_frame(fname)
+        if node_ids is not None:
+            return node_ids['node_id']
+
+    tree, tree_node_ids = load_node_index(path, fingerprint, get_net)
+    xy = points.values
+    valid = ~np.isnan(xy).any(axis=1)
+    positions = np.full(len(xy), -1)
+    valid_pos = np.flatnonzero(valid)
+    for start in range(0, len(valid_pos), chunksize):
+        chunk = valid_pos[start:start + chunksize]
+        positions[chunk] = tree.query(xy[chunk], workers=-1)[1]
+
+    values = tree_node_ids[positions]
+    if not valid.all():
+        values = values.astype(float)
+        values[~valid] = np.nan
+    node_ids = pd.Series(values, index=points.index, name='node_id')
+
+    if fname is not None:
+        save_frame(node_ids.to_frame(), fname)
+    return node_ids
+
+
+def file_hash(path):
+    """
+    Content hash of a (small) file such as a config.
+    """
+    with open(path, 'rb') as f:
+        return hashlib.sha1(f.read()).hexdigest()
+
+
+def load_frame(path):
+    """
+    Read a cached table, or return None if it is not in the cache.
+    """
+    if not os.path.exists(path):
+        return None
+    print('Loading cached table from {0}'.format(path))
+    return pd.read_parquet(path)
+
+
+def save_frame(df, path):
+    """
+    Add a table to the cache in Parquet format. Does nothing if no
+    Parquet engine is installed.
+    """
+    dirname = os.path.dirname(path)
+    if not os.path.exists(dirname):
+        os.makedirs(dirname)
+    try:
+        df.to_parquet(path + '.tmp')
+    except ImportError:
+        print('No parquet engine installed. Not caching {0}'.format(path))
+        return
+    os.replace(path + '.tmp', path)
@@ -2,193 +2,113 @@ import orca
 import pandas as pd
 import numpy as np
 import os
+
+from activitysynth.scripts import joins, loaders, utils
+from activitysynth.scripts.skims import load_skim_store
+from activitysynth.scripts.zones import ZoneSystem
 # data documentation: https://berkeley.app.box.com/notes/282712547032
 
 
+# number of raw skims records to impute at a time. None imputes
+# the raw skims in memory all at once.
+orca.add_injectable('skims_chunksize', None)
+
+# whether to reuse accessibility variables computed on a previous run
+# from identical inputs
+orca.add_injectable('use_access_cache', True)
+
+# whether to keep input tables in Arrow memory, see loaders.load_table
+orca.add_injectable('arrow_backed', False)
+
+# number of worker processes to simulate workplace location choices
+# with, see wlcm.simulate. None runs the model template as is.
+orca.add_injectable('wlcm_workers', None)
+
+# maximum number of assignment rounds per chooser batch and iteration
+# of the parallel WLCM, see wlcm.simulate
+orca.add_injectable('wlcm_max_rounds', 1)
+
+
 @orca.table('parcels', cache=True)
-def parcels(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['parcels']))
-    elif input_file_format == 'h5':
-        df = store['parcels']
-    elif input_file_format == 'csv':
-        try:
-            df = pd.read_csv(
-                os.path.join(input_data_dir, input_fnames['parcels']),
-                index_col='parcel_id', dtype={
-                    'parcel_id': int, 'block_id': str, 'apn': str})
-        except ValueError:
-            df = pd.read_csv(
-                os.path.join(input_data_dir, input_fnames['parcels']),
-                index_col='primary_id', dtype={
-                    'primary_id': int, 'block_id': str, 'apn': str})
-    return df
+def parcels(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'parcels', input_file_format, input_data_dir, store, input_fnames,
+        arrow_backed=arrow_backed)
 
 
 @orca.table('buildings', cache=True)
-def buildings(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['buildings']))
-    elif input_file_format == 'h5':
-        df = store['buildings']
-    elif input_file_format == 'csv':
-        df = pd.read_csv(
-            os.path.join(input_data_dir, input_fnames['buildings']),
-            index_col='building_id', dtype={
-                'building_id': int, 'parcel_id': int})
+def buildings(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    df = loaders.load_table(
+        'buildings', input_file_format, input_data_dir, store, input_fnames,
+        arrow_backed=arrow_backed)
     df['res_sqft_per_unit'] = df[
         'residential_sqft'] / df['residential_units']
-    df['res_sqft_per_unit'][df['res_sqft_per_unit'] == np.inf] = 0
+    df.loc[df['res_sqft_per_unit'] == np.inf, 'res_sqft_per_unit'] = 0
     return df
 
 
 @orca.table('jobs', cache=True)
-def jobs(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['jobs']))
-    elif input_file_format == 'h5':
-        df = store['jobs']
-    elif input_file_format == 'csv':
-        try:
-            df = pd.read_csv(
-                os.path.join(input_data_dir, input_fnames['jobs']),
-                index_col='job_id', dtype={'job_id': int, 'building_id': int})
-        except ValueError:
-            df = pd.read_csv(
-                os.path.join(input_data_dir, input_fnames['jobs']),
-                index_col=0, dtype={'job_id': int, 'building_id': int})
-            df.index.name = 'job_id'
-    return df
+def jobs(input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'jobs', input_file_format, input_data_dir, store, input_fnames,
+        arrow_backed=arrow_backed)
 
 
 @orca.table('establishments', cache=True)
-def establishments(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['establishments']))
-    elif input_file_format == 'h5':
-        df = store['establishments']
-    elif input_file_format == 'csv':
-        df = pd.read_csv(
-            os.path.join(input_data_dir, input_fnames['establishments']),
-            index_col='establishment_id', dtype={
-                'establishment_id': int, 'building_id': int,
-                'primary_id': int})
-    return df
+def establishments(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'establishments', input_file_format, input_data_dir, store,
+        input_fnames, arrow_backed=arrow_backed)
 
 
 @orca.table('households', cache=True)
-def households(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['households']))
-    elif input_file_format == 'h5':
-        df = store['households']
-    elif input_file_format == 'csv':
-        try:
-            df = pd.read_csv(
-                os.path.join(input_data_dir, input_fnames['households']),
-                index_col='household_id', dtype={
-                    'household_id': int, 'block_group_id': str, 'state': str,
-                    'county': str, 'tract': str, 'block_group': str,
-                    'building_id': int, 'unit_id': int, 'persons': float})
-        except ValueError:
-            df = pd.read_csv(
-                os.path.join(input_data_dir, input_fnames['households']),
-                index_col=0, dtype={
-                    'household_id': int, 'block_group_id': str, 'state': str,
-                    'county': str, 'tract': str, 'block_group': str,
-                    'building_id': int, 'unit_id': int, 'persons': float})
-            df.index.name = 'household_id'
-    return df
+def households(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'households', input_file_format, input_data_dir, store,
+        input_fnames, arrow_backed=arrow_backed)
 
 
 @orca.table('persons', cache=True)
-def persons(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['persons']))
-    elif input_file_format == 'h5':
-        df = store['persons']
-    elif input_file_format == 'csv':
-        try:
-            df = pd.read_csv(
-                os.path.join(input_data_dir, input_fnames['persons']),
-                index_col='person_id', dtype={
-                    'person_id': int, 'household_id': int})
-        except ValueError:
-            df = pd.read_csv(
-                os.path.join(input_data_dir, input_fnames['persons']),
-                index_col=0, dtype={'person_id': int, 'household_id': int})
-            df.index.name = 'person_id'
-    return df
+def persons(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'persons', input_file_format, input_data_dir, store, input_fnames,
+        arrow_backed=arrow_backed)
 
 
 @orca.table('rentals', cache=True)
-def rentals(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['rentals']))
-    elif input_file_format == 'h5':
-        df = store['craigslist']
-    elif input_file_format == 'csv':
-        try:
-            df = pd.read_csv(
-                os.path.join(input_data_dir, input_fnames['rentals']),
-                index_col='pid', dtype={
-                    'pid': int, 'date': str, 'region': str,
-                    'neighborhood': str, 'rent': float, 'sqft': float,
-                    'rent_sqft': float, 'longitude': float,
-                    'latitude': float, 'county': str, 'fips_block': str,
-                    'state': str, 'bathrooms': str})
-        except ValueError:
-            df = pd.read_csv(
-                os.path.join(input_data_dir, input_fnames['rentals']),
-                index_col=0, dtype={
-                    'date': str, 'region': str,
-                    'neighborhood': str, 'rent': float, 'sqft': float,
-                    'rent_sqft': float, 'longitude': float,
-                    'latitude': float, 'county': str, 'fips_block': str,
-                    'state': str, 'bathrooms': str})
-            df.index.name = 'pid'
-    df.rent[df.rent < 100] = 100.0
-    df.rent[df.rent > 10000] = 10000.0
-    df.rent_sqft[df.rent_sqft < .2] = .2
-    df.rent_sqft[df.rent_sqft > 50] = 50.0
+def rentals(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    df = loaders.load_table(
+        'rentals', input_file_format, input_data_dir, store, input_fnames,
+        arrow_backed=arrow_backed)
+    df.loc[df.rent < 100, 'rent'] = 100.0
+    df.loc[df.rent > 10000, 'rent'] = 10000.0
+    df.loc[df.rent_sqft < .2, 'rent_sqft'] = .2
+    df.loc[df.rent_sqft > 50, 'rent_sqft'] = 50.0
     return df
 
 
 @orca.table('units', cache=True)
-def units(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['units']))
-    elif input_file_format == 'h5':
-        df = store['units']
-    elif input_file_format == 'csv':
-        df = pd.read_csv(
-            os.path.join(input_data_dir, input_fnames['units']),
-            index_col='unit_id', dtype={'unit_id': int, 'building_id': int})
-    df.index.name = 'unit_id'
-    return df
+def units(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'units', input_file_format, input_data_dir, store, input_fnames,
+        arrow_backed=arrow_backed)
 
 
 @orca.table('zones', cache=True)
-def zones(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['zones']))
-    elif input_file_format == 'h5':
-        df = store['zones']
-    elif input_file_format == 'csv':
-        df = pd.read_csv(
-            os.path.join(input_data_dir, input_fnames['zones']),
-            index_col='zone_id', dtype={'zone_id': int})
-        if 'tract' in df.columns:
-            df.drop('tract', axis=1, inplace=True)
+def zones(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    df = loaders.load_table(
+        'zones', input_file_format, input_data_dir, store, input_fnames,
+        arrow_backed=arrow_backed)
+    if input_file_format == 'csv' and 'tract' in df.columns:
+        df.drop('tract', axis=1, inplace=True)
     return df
 
 
@@ -207,110 +127,160 @@ def access_indicators_ampeak():
 
 # Tables from Emma
 @orca.table('mtc_skims', cache=True)
-def mtc_skims(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['mtc_skims']))
-    elif input_file_format == 'h5':
-        df = store['mtc_skims']
-    elif input_file_format == 'csv':
-        df = pd.read_csv(
-            os.path.join(input_data_dir, input_fnames['mtc_skims']),
-            index_col=0)
-    return df
+def mtc_skims(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'mtc_skims', input_file_format, input_data_dir, store, input_fnames,
+        arrow_backed=arrow_backed)
 
 
 @orca.table(cache=True)
-def beam_skims_raw(input_file_format, input_data_dir, store, input_fnames):
+def beam_skims_raw(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
     """
     Load full BEAM skims, convert travel time to minutes
     """
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['beam_skims_raw']))
-    elif input_file_format == 'h5':
-        df = store['beam_skims_raw']
-    elif input_file_format == 'csv':
-        df = pd.read_csv(
-            os.path.join(input_data_dir, input_fnames['beam_skims_raw']))
-
-    df.rename(columns={
-        'generalizedCost': 'gen_cost', 'origTaz': 'from_zone_id',
-        'destTaz': 'to_zone_id'}, inplace=True)
+    df = loaders.load_table(
+        'beam_skims_raw', input_file_format, input_data_dir, store,
+        input_fnames, arrow_backed=arrow_backed)
+    df.rename(columns=utils.beam_skims_raw_columns, inplace=True)
     return df
 
 
 @orca.table(cache=True)
-def beam_skims_imputed(input_file_format, input_data_dir, store, input_fnames):
+def beam_skims_imputed(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
     """
     Load imputed BEAM skims
     """
-    if input_file_format == 'parquet':
-        df = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['beam_skims_imputed']))
-    elif input_file_format == 'h5':
-        df = store['beam_skims_imputed']
-    elif input_file_format == 'csv':
-        df = pd.read_csv(
-            os.path.join(input_data_dir, input_fnames['beam_skims_imputed']))
+    df = loaders.load_table(
+        'beam_skims_imputed', input_file_format, input_data_dir, store,
+        input_fnames, arrow_backed=arrow_backed)
+    utils.check_imputed_skims(df.columns)
     df.set_index(['from_zone_id', 'to_zone_id'], inplace=True)
     return df
 
 
+@orca.injectable(cache=True)
+def skim_store_dir(input_data_dir):
+    return os.path.join(input_data_dir, 'skim_stores')
+
+
+@orca.injectable(cache=True)
+def cache_dir(input_data_dir):
+    return os.path.join(input_data_dir, 'cache')
+
+
+@orca.injectable(cache=True)
+def zone_system(zones, parcels):
+    """
+    Dense int32 codes of the zone ids of the zones table, and of any
+    zone ids of parcels missing from it
+    """
+    return ZoneSystem(np.union1d(
+        zones.index.values, parcels.zone_id.dropna().values))
+
+
+@orca.injectable(cache=True)
+def join_index():
+    """
+    Positional join paths from the agent tables to their geography
+    """
+    return joins.JoinIndex()
+
+
+def source_fingerprint(table_name):
+    """
+    Fingerprint of the file a table is read from, or None if the table
+    has no file on disk (e.g. it was created during this run).
+    """
+    if orca.get_injectable('input_file_format') == 'h5':
+        return utils.file_fingerprint(orca.get_injectable('store').filename)
+    return utils.file_fingerprint(os.path.join(
+        orca.get_injectable('input_data_dir'),
+        orca.get_injectable('input_fnames')[table_name]))
+
+
+def read_columns(table_name, columns, where=None):
+    """
+    Read some columns of an input table, and from an h5 store only the
+    rows matching `where`, rather than the whole table its orca table
+    function loads.
+    """
+    return loaders.load_table(
+        table_name, orca.get_injectable('input_file_format'),
+        orca.get_injectable('input_data_dir'), orca.get_injectable('store'),
+        orca.get_injectable('input_fnames'), columns=columns, where=where,
+        arrow_backed=orca.get_injectable('arrow_backed'))
+
+
+@orca.injectable(cache=True)
+def beam_skim_store(skim_store_dir):
+    """
+    Dense, memory-mapped version of the imputed BEAM skims
+    """
+    fingerprint = source_fingerprint('beam_skims_imputed')
+
+    def frame_func():
+        return orca.get_table('beam_skims_imputed').to_frame()
+
+    # imputed skims created during this run have no file to fingerprint
+    if fingerprint is None:
+        df = frame_func()
+        fingerprint = utils.frame_fingerprint(df)
+        frame_func = lambda: df
+
+    store = load_skim_store(
+        os.path.join(skim_store_dir, 'beam_skims_imputed'), fingerprint,
+        frame_func)
+
+    # a store built earlier from the same file is reused as it is
+    utils.check_imputed_skims(store.measures)
+    return store
+
+
+@orca.injectable(cache=True)
+def mtc_skim_store(skim_store_dir):
+    """
+    Dense, memory-mapped version of the MTC skims
+    """
+    fingerprint = source_fingerprint('mtc_skims')
+    return load_skim_store(
+        os.path.join(skim_store_dir, 'mtc_skims'), fingerprint,
+        lambda: orca.get_table('mtc_skims').to_frame(),
+        orig_col='orig', dest_col='dest')
+
+
 @orca.table(cache=True)
-def drive_nodes(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        nodes = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['drive_nodes']))
-    elif input_file_format == 'h5':
-        nodes = store['drive_nodes']
-    elif input_file_format == 'csv':
-        nodes = pd.read_csv(os.path.join(
-            input_data_dir,
-            input_fnames['drive_nodes'])).set_index('osmid')
-    return nodes
+def drive_nodes(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'drive_nodes', input_file_format, input_data_dir, store, input_fnames,
+        columns=['x', 'y'], arrow_backed=arrow_backed)
 
 
 @orca.table(cache=True)
-def drive_edges(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        edges = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['drive_edges']))
-    elif input_file_format == 'h5':
-        edges = store['drive_edges']
-    elif input_file_format == 'csv':
-        edges = pd.read_csv(os.path.join(
-            input_data_dir,
-            input_fnames['drive_edges'])).set_index('uniqueid')
-    return edges
+def drive_edges(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'drive_edges', input_file_format, input_data_dir, store, input_fnames,
+        columns=['u', 'v', 'length'], arrow_backed=arrow_backed)
 
 
 @orca.table(cache=True)
-def walk_nodes(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        nodes = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['walk_nodes']))
-    elif input_file_format == 'h5':
-        nodes = store['walk_nodes']
-    elif input_file_format == 'csv':
-        nodes = pd.read_csv(os.path.join(
-            input_data_dir,
-            input_fnames['walk_nodes'])).set_index('osmid')
-    return nodes
+def walk_nodes(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'walk_nodes', input_file_format, input_data_dir, store, input_fnames,
+        columns=['x', 'y'], arrow_backed=arrow_backed)
 
 
 @orca.table(cache=True)
-def walk_edges(input_file_format, input_data_dir, store, input_fnames):
-    if input_file_format == 'parquet':
-        edges = pd.read_parquet(
-            os.path.join(input_data_dir, input_fnames['walk_edges']))
-    elif input_file_format == 'h5':
-        edges = store['walk_edges']
-    elif input_file_format == 'csv':
-        edges = pd.read_csv(os.path.join(
-            input_data_dir,
-            input_fnames['walk_edges'])).set_index('uniqueid')
-    return edges
+def walk_edges(
+        input_file_format, input_data_dir, store, input_fnames, arrow_backed):
+    return loaders.load_table(
+        'walk_edges', input_file_format, input_data_dir, store, input_fnames,
+        columns=['u', 'v', 'length'], arrow_backed=arrow_backed)
 
 
 # Broadcasts, a.k.a. merge relationships
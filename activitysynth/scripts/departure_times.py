@@ -0,0 +1,138 @@
+import numpy as np
+import pandas as pd
+import scipy.stats as st
+import yaml
+from urbansim.utils import misc
+
+
+# points at which the CDF is tabulated for distributions that scipy can
+# only invert by root finding, one value at a time
+cdf_grid_size = 4097
+
+
+def load_specs(cfgname='TOD_distribution.yaml'):
+    """
+    Departure time distributions by time of day period choice and trip
+    direction, from a yaml config in the configs dir.
+
+    Returns
+    -------
+    dict
+        Maps each TOD code to a dict mapping the departure time column
+        of each direction to a list of mixture components. Every
+        component is a dict with a frozen scipy distribution under
+        'dist', its truncation 'bounds' and its mixture 'share'.
+    """
+    with open(misc.config(cfgname)) as f:
+        cfg = yaml.safe_load(f)
+
+    specs = {}
+    for tod, directions in cfg['distributions'].items():
+        specs[int(tod)] = {}
+        for col, components in directions.items():
+            if isinstance(components, dict):
+                components = [components]
+            weights = np.array(
+                [c.get('weight', 1) for c in components], dtype=float)
+            specs[int(tod)][col] = [{
+                'dist': getattr(st, c['dist'])(**c.get('params', {})),
+                'bounds': tuple(c['bounds']),
+                'after': c.get('after'),
+                'share': weight / weights.sum()}
+                for c, weight in zip(components, weights)]
+    return specs
+
+
+def truncated_inverse_cdf(dist, u, lower, upper):
+    """
+    Map uniform draws onto a distribution truncated to [lower, upper),
+    as F^-1(F(lower) + u * (F(upper) - F(lower))).
+
+    Draws in the upper tail are mapped through the survival function so
+    that heavy-tailed fits keep their precision. Distributions without
+    a closed-form inverse are inverted by interpolating their CDF,
+    tabulated over the truncation bounds.
+
+    Parameters
+    ----------
+    dist : scipy.stats frozen distribution
+    u : numpy.ndarray
+        Uniform draws in [0, 1).
+    lower : float or numpy.ndarray
+        Lower bound, may differ per draw.
+    upper : float
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    lower = np.broadcast_to(np.asarray(lower, dtype=float), u.shape)
+    F_lower, F_upper = dist.cdf(lower), dist.cdf(upper)
+    if (F_upper <= F_lower).any():
+        raise ValueError(
+            'No probability mass in [{0}, {1}) for {2}'.format(
+                lower.min(), upper, dist.dist.name))
+
+    if type(dist.dist)._ppf is st.rv_continuous._ppf:
+        grid = np.linspace(lower.min(), upper, cdf_grid_size)
+        x = np.interp(F_lower + u * (F_upper - F_lower), dist.cdf(grid), grid)
+    else:
+        x = np.empty(len(u))
+        tail = F_lower > 0.5
+        S_lower, S_upper = dist.sf(lower[tail]), dist.sf(upper)
+        x[tail] = dist.isf(S_lower - u[tail] * (S_lower - S_upper))
+        x[~tail] = dist.ppf(
+            F_lower[~tail] + u[~tail] * (F_upper - F_lower[~tail]))
+
+    # guard against rounding at the bounds
+    return np.clip(x, lower, np.nextafter(upper, -np.inf))
+
+
+def simulate(tod, specs, seed=None):
+    """
+    Departure times of the trips of each person from their time of day
+    period choice, in a single draw per distribution.
+
+    Parameters
+    ----------
+    tod : pandas.Series
+        TOD code of each person.
+    specs : dict
+        As returned by load_specs(). Components with an 'after' column
+        have their lower bound raised to that column's departure time,
+        which must come earlier in the direction order.
+    seed : int, optional
+
+    Returns
+    -------
+    pandas.DataFrame
+        Departure time columns of the persons with a TOD code in
+        `specs`, in hours. Times after midnight wrap to the next day.
+    """
+    rng = np.random.default_rng(seed)
+    codes = tod.values
+    columns = list(dict.fromkeys(
+        col for directions in specs.values() for col in directions))
+    times = pd.DataFrame(np.nan, index=tod.index, columns=columns)
+
+    for code, directions in specs.items():
+        rows = np.flatnonzero(codes == code)
+        for col, components in directions.items():
+            # split the persons between the mixture components in
+            # proportion to their shares
+            order = rng.permutation(len(rows))
+            counts = np.round(
+                np.cumsum([c['share'] for c in components]) * len(rows))
+            starts = np.r_[0, counts[:-1]].astype(int)
+            for c, start, stop in zip(components, starts, counts.astype(int)):
+                comp_rows = rows[order[start:stop]]
+                lower, upper = c['bounds']
+                if c['after'] is not None:
+                    lower = np.maximum(
+                        lower, times[c['after']].values[comp_rows])
+                times.iloc[comp_rows, times.columns.get_loc(col)] = \
+                    truncated_inverse_cdf(
+                        c['dist'], rng.random(len(comp_rows)), lower, upper)
+
+    times = times[np.isin(codes, list(specs))]
+    return times.where(times <= 24, times - 24)
@@ -0,0 +1,245 @@
+import orca
+import pandas as pd
+import numpy as np
+
+
+# foreign key each table uses to reach its parent in the geography
+# hierarchy, mirroring the broadcasts registered in datasources
+parent_keys = {
+    'parcels': ('zone_id', 'zones'),
+    'buildings': ('parcel_id', 'parcels'),
+    'units': ('building_id', 'buildings'),
+    'households': ('unit_id', 'units'),
+    'persons': ('household_id', 'households'),
+    'jobs': ('building_id', 'buildings'),
+}
+
+# other foreign keys that lead into the hierarchy
+other_keys = {
+    ('persons', 'job_id'): 'jobs',
+}
+
+
+def _parent(table_name, key):
+    if (table_name, key) in other_keys:
+        return other_keys[(table_name, key)]
+    if table_name in parent_keys and parent_keys[table_name][0] == key:
+        return parent_keys[table_name][1]
+    raise KeyError('{0}.{1} is not a known foreign key'.format(
+        table_name, key))
+
+
+def join_path(table_name, target_name, via=None):
+    """
+    Foreign key hops leading from one table to another.
+
+    Parameters
+    ----------
+    table_name : str
+    target_name : str
+    via : str, optional
+        Foreign key to take for the first hop instead of the table's
+        parent key, e.g. 'job_id' to go from persons to their work
+        geography.
+
+    Returns
+    -------
+    list of (table name, foreign key) tuples
+    """
+    hops = []
+    current = table_name
+    key = via
+    while current != target_name:
+        if key is None:
+            if current not in parent_keys:
+                raise KeyError('No join path from {0} to {1}'.format(
+                    table_name, target_name))
+            key = parent_keys[current][0]
+        hops.append((current, key))
+        current = _parent(current, key)
+        key = None
+    return hops
+
+
+class JoinIndex(object):
+    """
+    Positional join paths between the agent tables and the geography
+    tables they belong to.
+
+    Each foreign key hop is resolved once into an int32 array holding,
+    for every row of the child table, the position of its parent row,
+    and hops are composed into paths such as persons -> parcels. Any
+    parcel attribute can then be broadcast to persons or jobs with a
+    single numpy take instead of a chain of index alignments.
+
+    Hops keep a copy of the keys they were resolved from and are
+    rebuilt when the foreign key column or either table's index has
+    changed, e.g. after update_column has reassigned building_id or
+    job_id, so that stale positions are never used.
+    """
+
+    def __init__(self):
+        self._hops = {}
+        self._paths = {}
+
+    def invalidate(self):
+        """
+        Drop every resolved hop and path.
+        """
+        self._hops = {}
+        self._paths = {}
+
+    def _hop(self, table_name, key):
+        """
+        (version, positions) of one foreign key hop, rebuilt if its
+        inputs have changed since it was resolved.
+        """
+        table = orca.get_table(table_name)
+        parent = orca.get_table(_parent(table_name, key))
+        keys = table.get_column(key)
+        parent_index = parent.index
+
+        cached = self._hops.get((table_name, key))
+        if cached is not None:
+            version, snapshot, positions = cached
+            if snapshot[0].equals(keys.index) and \
+                    snapshot[1].equals(parent_index) and \
+                    np.array_equal(snapshot[2], keys.values):
+                return version, positions
+            version += 1
+        else:
+            version = 0
+
+        positions = parent_index.get_indexer(keys.values).astype(np.int32)
+        self._hops[(table_name, key)] = (
+            version, (keys.index, parent_index, keys.values.copy()),
+            positions)
+        return version, positions
+
+    def positions(self, table_name, target_name, via=None):
+        """
+        Position in `target_name` of the row each row of `table_name`
+        belongs to, -1 where a key along the way is missing.
+
+        Parameters
+        ----------
+        table_name : str
+        target_name : str
+        via : str, optional
+            See join_path.
+
+        Returns
+        -------
+        numpy.ndarray
+            int32 array aligned with the index of `table_name`.
+        """
+        hops = join_path(table_name, target_name, via)
+        resolved = [self._hop(*hop) for hop in hops]
+        versions = tuple(version for version, _ in resolved)
+
+        path = (table_name, target_name, via)
+        cached = self._paths.get(path)
+        if cached is not None and cached[0] == versions:
+            return cached[1]
+
+        positions = resolved[0][1]
+        for _, hop_positions in resolved[1:]:
+            positions = np.where(
+                positions >= 0, hop_positions[positions], -1).astype(np.int32)
+        self._paths[path] = (versions, positions)
+        return positions
+
+    def broadcast(self, values, table_name, target_name, via=None):
+        """
+        Broadcast a column of `target_name` to the rows of `table_name`.
+
+        Parameters
+        ----------
+        values : pandas.Series
+            Indexed like `target_name`.
+        table_name : str
+        target_name : str
+        via : str, optional
+            See join_path.
+
+        Returns
+        -------
+        pandas.Series
+            Indexed like `table_name`, with NaN where a row has no
+            match, as from misc.reindex.
+        """
+        target_index = orca.get_table(target_name).index
+        if not values.index.equals(target_index):
+            values = values.reindex(target_index)
+
+        positions = self.positions(table_name, target_name, via)
+        found = positions >= 0
+        result = values.values.take(np.where(found, positions, 0))
+        if not found.all():
+            if result.dtype.kind in 'iub':
+                result = result.astype(float)
+            result[~found] = np.nan
+        return pd.Series(
+            result, index=orca.get_table(table_name).index,
+            name=values.name)
+
+
+def rollup(join_index, target_name, specs):
+    """
+    Aggregate columns of the agent tables up to a geography table.
+
+    Every table is mapped to the target once, through the join index,
+    and each variable is then aggregated with a single np.bincount pass
+    instead of a chain of groupbys.
+
+    Parameters
+    ----------
+    join_index : JoinIndex
+    target_name : str
+        Table to aggregate to, e.g. 'zones'.
+    specs : list of tuples
+        (column_name, table_name, variable, agg, weights) where agg is
+        'sum', 'count' or 'mean'. `variable` may be None for a count of
+        rows. `weights` names a column of the same table to take a
+        weighted mean with, or is None.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One column per spec, indexed like `target_name`. Zones without
+        any (non-null) values get 0.
+    """
+    target_index = orca.get_table(target_name).index
+    n = len(target_index)
+
+    results = pd.DataFrame(index=target_index)
+    for column_name, table_name, variable, agg, weights in specs:
+        positions = join_index.positions(table_name, target_name)
+        table = orca.get_table(table_name)
+        valid = positions >= 0
+        if variable is None:
+            values = np.ones(len(positions))
+        else:
+            values = table.get_column(variable).values.astype(float)
+            valid &= ~np.isnan(values)
+        if weights is None:
+            w = np.ones(len(positions))
+        else:
+            w = table.get_column(weights).values.astype(float)
+            valid &= ~np.isnan(w)
+
+        pos = positions[valid]
+        if agg == 'count':
+            result = np.bincount(pos, minlength=n).astype(float)
+        else:
+            result = np.bincount(
+                pos, weights=(values * w)[valid], minlength=n)
+            if agg == 'mean':
+                totals = np.bincount(pos, weights=w[valid], minlength=n)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    result = np.where(totals > 0, result / totals, 0)
+            elif agg != 'sum':
+                raise ValueError('Unknown aggregation {0}'.format(agg))
+        results[column_name] = result
+
+    return results
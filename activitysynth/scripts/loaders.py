@@ -0,0 +1,486 @@
+import os
+
+import pandas as pd
+import numpy as np
+
+
+# Schema of each input table:
+# - index: candidate index columns, the first one present is used
+# - index_fallback: use the first column as the index if none of the
+#   candidates is present
+# - index_name: name to give the index
+# - dtypes: storage types of known columns. integer columns keep the
+#   type they were read as if their values do not fit
+# - keep_float64: float columns not to downcast, e.g. coordinates
+# - required: columns the models cannot run without
+# - h5_key: key of the table in the h5 store, if not its name
+# - downcast: whether to store other numeric columns as int32/float32
+# - filter_columns: columns other than ids that rows are selected by
+table_schemas = {
+    'parcels': {
+        'index': ['parcel_id', 'primary_id'],
+        'dtypes': {
+            'parcel_id': 'int32', 'primary_id': 'int32',
+            'block_id': 'category', 'apn': 'category',
+            'county': 'category'},
+        'keep_float64': ['x', 'y'],
+        'required': ['zone_id', 'x', 'y']},
+    'buildings': {
+        'index': ['building_id'],
+        'dtypes': {'building_id': 'int32', 'parcel_id': 'int32'},
+        'required': [
+            'parcel_id', 'residential_units', 'residential_sqft']},
+    'jobs': {
+        'index': ['job_id'], 'index_fallback': True, 'index_name': 'job_id',
+        'dtypes': {'job_id': 'int32', 'building_id': 'int32'},
+        'required': ['building_id']},
+    'establishments': {
+        'index': ['establishment_id'],
+        'dtypes': {
+            'establishment_id': 'int32', 'building_id': 'int32',
+            'primary_id': 'int32'},
+        'required': ['building_id']},
+    'households': {
+        'index': ['household_id'], 'index_fallback': True,
+        'index_name': 'household_id',
+        'dtypes': {
+            'household_id': 'int32', 'block_group_id': 'category',
+            'state': 'category', 'county': 'category',
+            'tract': 'category', 'block_group': 'category',
+            'building_id': 'int32', 'unit_id': 'int32',
+            'persons': 'float32'},
+        'required': ['building_id', 'unit_id']},
+    'persons': {
+        'index': ['person_id'], 'index_fallback': True,
+        'index_name': 'person_id',
+        'dtypes': {'person_id': 'int32', 'household_id': 'int32'},
+        'required': ['household_id']},
+    'rentals': {
+        'index': ['pid'], 'index_fallback': True, 'index_name': 'pid',
+        'h5_key': 'craigslist',
+        'dtypes': {
+            'pid': 'int32', 'date': 'category', 'region': 'category',
+            'neighborhood': 'category', 'rent': 'float32',
+            'sqft': 'float32', 'rent_sqft': 'float32',
+            'longitude': 'float64', 'latitude': 'float64',
+            'county': 'category', 'fips_block': 'category',
+            'state': 'category', 'bathrooms': 'category'},
+        'keep_float64': ['longitude', 'latitude'],
+        'required': ['rent', 'rent_sqft', 'longitude', 'latitude']},
+    'units': {
+        'index': ['unit_id'], 'index_name': 'unit_id',
+        'dtypes': {'unit_id': 'int32', 'building_id': 'int32'},
+        'required': ['building_id']},
+    'zones': {
+        'index': ['zone_id'],
+        'dtypes': {'zone_id': 'int32'}},
+
+    # networks keep 64 bit osm ids and full precision for pandana
+    'drive_nodes': {
+        'index': ['osmid'], 'downcast': False, 'required': ['x', 'y']},
+    'drive_edges': {
+        'index': ['uniqueid'], 'downcast': False,
+        'required': ['u', 'v', 'length']},
+    'walk_nodes': {
+        'index': ['osmid'], 'downcast': False, 'required': ['x', 'y']},
+    'walk_edges': {
+        'index': ['uniqueid'], 'downcast': False,
+        'required': ['u', 'v', 'length']},
+
+    # skims keep full precision for imputation and lookups
+    'mtc_skims': {
+        'index': [], 'index_fallback': True, 'downcast': False,
+        'filter_columns': ['orig', 'dest']},
+    'beam_skims_raw': {
+        'index': [], 'downcast': False},
+    'beam_skims_imputed': {
+        'index': [], 'downcast': False},
+}
+
+
+def _downcast(df, schema):
+    """
+    Store numeric columns without an explicit dtype as int32/float32
+    where that loses nothing but precision beyond float32.
+    """
+    keep = set(schema.get('dtypes', {})) | set(
+        schema.get('keep_float64', []))
+    for col in df.columns:
+        if col in keep:
+            continue
+        kind = df[col].dtype.kind
+        if kind in 'iu' and df[col].dtype.itemsize > 4:
+            if _fits(df[col], np.int32):
+                df[col] = df[col].astype(np.int32)
+        elif kind == 'f' and df[col].dtype.itemsize > 4:
+            df[col] = df[col].astype(np.float32)
+    return df
+
+
+def _fits(values, dtype):
+    """
+    Whether an integer dtype can hold every value of a column, without
+    wrapping around or dropping missing values.
+    """
+    if len(values) == 0:
+        return True
+    if pd.isnull(values).any():
+        return False
+    info = np.iinfo(dtype)
+    return values.min() >= info.min and values.max() <= info.max
+
+
+def _as_dtype(values, dtype, name):
+    """
+    Cast a column or index to its schema dtype, keeping it as it is if
+    it is an integer dtype too narrow for its values.
+    """
+    if values.dtype == dtype:
+        return values
+    if pd.api.types.is_integer_dtype(dtype) and not _fits(values, dtype):
+        print('Keeping {0} as {1}, {2} cannot hold its values'.format(
+            name, values.dtype, dtype))
+        return values
+    return values.astype(dtype)
+
+
+def _apply_dtypes(df, dtypes):
+    for col, dtype in dtypes.items():
+        if col in df.columns:
+            df[col] = _as_dtype(df[col], dtype, col)
+    return df
+
+
+def _read_csv(path, schema, columns, start=None, stop=None):
+    """
+    Read a csv with only the projected columns and the schema dtypes,
+    picking the index column from the header rather than by retrying.
+    """
+    header = list(pd.read_csv(path, nrows=0).columns)
+    candidates = [col for col in schema['index'] if col in header]
+    if candidates:
+        index_col = candidates[0]
+    elif schema.get('index_fallback'):
+        index_col = header[0]
+    else:
+        index_col = None
+
+    usecols = None
+    if columns is not None:
+        usecols = [col for col in header if col in set(columns) or
+                   col == index_col]
+
+    # integer ids are cast after reading, once their range is known, as
+    # the parser wraps values that overflow them
+    dtypes = {
+        col: dtype for col, dtype in schema.get('dtypes', {}).items()
+        if col in header and not pd.api.types.is_integer_dtype(dtype)}
+    df = pd.read_csv(
+        path, index_col=index_col, usecols=usecols, dtype=dtypes,
+        skiprows=range(1, start + 1) if start else None,
+        nrows=None if stop is None else stop - (start or 0))
+    return df
+
+
+def _arrow_string_dtype(arrow_type):
+    import pyarrow as pa
+
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return pd.StringDtype('pyarrow')
+    return None
+
+
+def _arrow_to_pandas(table, schema, start, stop, arrow_backed):
+    """
+    Slice an Arrow table to the requested rows and convert it to pandas.
+
+    Arrow-backed, string ids the schema stores as categoricals are
+    dictionary encoded in Arrow, other strings stay in Arrow buffers as
+    pyarrow strings and numeric columns without nulls are handed to
+    pandas without copying.
+    """
+    if start is not None or stop is not None:
+        start = start or 0
+        stop = table.num_rows if stop is None else stop
+        table = table.slice(start, max(stop - start, 0))
+
+    if not arrow_backed:
+        return table.to_pandas()
+
+    import pyarrow.compute as pc
+
+    for col, dtype in schema.get('dtypes', {}).items():
+        if dtype == 'category' and col in table.column_names and \
+                _arrow_string_dtype(table.schema.field(col).type):
+            table = table.set_column(
+                table.column_names.index(col), col,
+                pc.dictionary_encode(table.column(col)))
+    return table.to_pandas(
+        split_blocks=True, types_mapper=_arrow_string_dtype)
+
+
+def _set_index(df, schema, candidates):
+    if candidates and df.index.name not in schema['index'] and \
+            candidates[0] in df.columns:
+        df.set_index(candidates[0], inplace=True)
+    return df
+
+
+def _read_parquet(path, schema, columns, start=None, stop=None,
+                  arrow_backed=False):
+    """
+    Read a parquet file with only the projected columns, setting the
+    index from a candidate column if it was not saved as the index.
+    """
+    import pyarrow.parquet as pq
+
+    names = pq.read_schema(path).names
+    candidates = [col for col in schema['index'] if col in names]
+    if columns is not None:
+        columns = [col for col in names if col in set(columns)] + \
+            candidates[:1]
+    table = pq.read_table(
+        path, columns=columns, use_pandas_metadata=True,
+        memory_map=arrow_backed)
+    df = _arrow_to_pandas(table, schema, start, stop, arrow_backed)
+    return _set_index(df, schema, candidates)
+
+
+def _read_feather(path, schema, columns, start=None, stop=None,
+                  arrow_backed=False):
+    """
+    Read a feather (Arrow IPC) file memory-mapped, so that columns left
+    out of the projection are never read from disk.
+    """
+    import pyarrow.feather as feather
+
+    table = feather.read_table(path, memory_map=True)
+    candidates = [col for col in schema['index'] if col in table.column_names]
+    if columns is not None:
+        metadata = table.schema.pandas_metadata or {}
+        index_columns = [
+            col for col in metadata.get('index_columns', [])
+            if isinstance(col, str)]
+        table = table.select([
+            col for col in table.column_names if col in set(columns) or
+            col in index_columns or col in candidates[:1]])
+    df = _arrow_to_pandas(table, schema, start, stop, arrow_backed)
+    return _set_index(df, schema, candidates)
+
+
+def _read_h5(store, key, columns, where=None, start=None, stop=None):
+    if key not in store:
+        # missing tables behave like missing input files
+        raise FileNotFoundError(
+            'No {0} table in {1}'.format(key, store.filename))
+    if store.get_storer(key).is_table:
+        return store.select(
+            key, where=where, start=start, stop=stop,
+            columns=None if columns is None else list(columns))
+
+    # fixed format stores can only be read whole
+    if where is not None:
+        raise ValueError(
+            'where reads need {0} to be stored in table format'.format(key))
+    df = store[key].iloc[start:stop]
+    if columns is not None:
+        df = df[[col for col in df.columns if col in set(columns)]]
+    return df
+
+
+def load_table(table_name, input_file_format, input_data_dir, store,
+               input_fnames, columns=None, where=None, start=None,
+               stop=None, arrow_backed=False):
+    """
+    Load an input table according to its schema in table_schemas.
+
+    Only the projected columns are read, in all input formats, ids are
+    stored as int32, repetitive strings as categoricals and the
+    remaining numbers as int32/float32, and the input file size and
+    memory used are reported.
+
+    Arrow-backed tables keep the other string columns as pyarrow strings
+    instead of Python objects. Numeric columns of memory-mapped feather
+    files are not downcast, so that they stay views of the file rather
+    than being copied into memory. write_feather_inputs writes feather
+    files with the compact dtypes already applied.
+
+    Parameters
+    ----------
+    table_name : str
+    input_file_format : str
+        'csv', 'parquet', 'feather' or 'h5'.
+    input_data_dir : str
+    store : pandas.HDFStore or None
+    input_fnames : dict or None
+    columns : list of str, optional
+        Columns to read, besides the index. Defaults to all of them.
+    where : str, optional
+        Query selecting the rows to read. h5 inputs only.
+    start, stop : int, optional
+        Range of rows to read.
+    arrow_backed : bool, optional
+        Keep the table in Arrow memory where possible.
+
+    Returns
+    -------
+    pandas.DataFrame
+    """
+    schema = table_schemas[table_name]
+
+    if input_file_format == 'h5':
+        df = _read_h5(
+            store, schema.get('h5_key', table_name), columns, where, start,
+            stop)
+        file_size = None
+    else:
+        if where is not None:
+            raise ValueError('where reads need an h5 input store')
+        path = os.path.join(input_data_dir, input_fnames[table_name])
+        file_size = os.path.getsize(path)
+        if input_file_format == 'parquet':
+            df = _read_parquet(
+                path, schema, columns, start, stop, arrow_backed)
+        elif input_file_format == 'feather':
+            df = _read_feather(
+                path, schema, columns, start, stop, arrow_backed)
+        elif input_file_format == 'csv':
+            df = _read_csv(path, schema, columns, start, stop)
+        else:
+            raise ValueError(
+                'Unknown input file format {0}'.format(input_file_format))
+
+    missing = [
+        col for col in schema.get('required', [])
+        if col not in df.columns and
+        (columns is None or col in columns)]
+    if missing:
+        raise ValueError('{0} table is missing required columns {1}'.format(
+            table_name, missing))
+
+    index_dtype = schema.get('dtypes', {}).get(df.index.name)
+    if index_dtype is not None:
+        df.index = _as_dtype(df.index, index_dtype, df.index.name)
+    if schema.get('index_name'):
+        df.index.name = schema['index_name']
+
+    df = _apply_dtypes(df, schema.get('dtypes', {}))
+    if arrow_backed:
+        for col in df.columns[df.dtypes == object]:
+            df[col] = df[col].astype(pd.StringDtype('pyarrow'))
+    memory_mapped = arrow_backed and input_file_format == 'feather'
+    if schema.get('downcast', True) and not memory_mapped:
+        df = _downcast(df, schema)
+
+    print('Loaded {0}: {1} rows x {2} columns, {3:.1f} MB in memory{4}'.format(
+        table_name, len(df), len(df.columns),
+        df.memory_usage(index=True, deep=True).sum() / 1e6,
+        '' if file_size is None else
+        ' from a {0:.1f} MB file'.format(file_size / 1e6)))
+    return df
+
+
+# tables that are only read to create another input, left out of the
+# converted inputs by default
+convert_excluded = ['beam_skims_raw']
+
+
+def _existing_tables(input_data_dir, input_fnames):
+    return [
+        name for name in table_schemas if name in input_fnames and
+        name not in convert_excluded and
+        os.path.exists(os.path.join(input_data_dir, input_fnames[name]))]
+
+
+def _data_columns(df, schema):
+    """
+    Columns of a table to index in an h5 store so that where queries
+    can select rows by them: ids and the schema's filter columns.
+    """
+    return [
+        col for col in df.columns if col.endswith('_id') or
+        col in schema.get('filter_columns', [])]
+
+
+def convert_inputs(input_file_format, input_data_dir, input_fnames, path,
+                   table_names=None):
+    """
+    Write the input tables into one consolidated h5 store to run from
+    with the 'h5' input file format.
+
+    Tables are loaded with load_table, so they are stored with their
+    compact dtypes, and written in table format. Columns can then be
+    read on their own and rows selected with row ranges, or with where
+    queries on the index, id columns and filter columns of the schema.
+
+    Parameters
+    ----------
+    input_file_format : str
+        'csv', 'parquet' or 'feather'.
+    input_data_dir : str
+    input_fnames : dict
+    path : str
+        h5 file to write.
+    table_names : list of str, optional
+        Defaults to every table with a schema whose input file exists,
+        except those in convert_excluded.
+
+    Returns
+    -------
+    None
+    """
+    if table_names is None:
+        table_names = _existing_tables(input_data_dir, input_fnames)
+
+    with pd.HDFStore(path + '.tmp', mode='w') as store:
+        for table_name in table_names:
+            df = load_table(
+                table_name, input_file_format, input_data_dir, None,
+                input_fnames)
+            schema = table_schemas[table_name]
+            store.put(
+                schema.get('h5_key', table_name), df, format='table',
+                data_columns=_data_columns(df, schema))
+    os.replace(path + '.tmp', path)
+    print('Wrote {0} to {1}'.format(', '.join(table_names), path))
+
+
+def write_feather_inputs(input_file_format, input_data_dir, input_fnames,
+                         feather_fnames, table_names=None):
+    """
+    Write the input tables as feather files to run from with the
+    'feather' input file format and Arrow-backed tables.
+
+    Tables are loaded with load_table, so they are stored with their
+    compact dtypes and categorical string ids, and written uncompressed
+    so that they can be memory-mapped rather than decoded.
+
+    Parameters
+    ----------
+    input_file_format : str
+        'csv' or 'parquet'.
+    input_data_dir : str
+    input_fnames : dict
+    feather_fnames : dict
+        Feather file name of each table, in the input data dir.
+    table_names : list of str, optional
+        Defaults to every table with a schema whose input file exists,
+        except those in convert_excluded.
+
+    Returns
+    -------
+    None
+    """
+    import pyarrow.feather as feather
+
+    if table_names is None:
+        table_names = _existing_tables(input_data_dir, input_fnames)
+
+    for table_name in table_names:
+        df = load_table(
+            table_name, input_file_format, input_data_dir, None,
+            input_fnames)
+        path = os.path.join(input_data_dir, feather_fnames[table_name])
+        feather.write_feather(df, path + '.tmp', compression='uncompressed')
+        os.replace(path + '.tmp', path)
+        print('Wrote {0} to {1}'.format(table_name, path))
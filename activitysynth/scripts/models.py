@@ -1,17 +1,20 @@
 import orca
 import pandana as pdna
 import pandas as pd
-import scipy.stats as st
 import numpy as np
 from datetime import datetime
 import os
+import yaml
 
-from urbansim.utils import networks
+from urbansim.utils import misc
 from urbansim_templates import modelmanager as mm
 from urbansim_templates.models import LargeMultinomialLogitStep
 from urbansim_templates.utils import update_column
 
-from activitysynth.scripts import utils
+from activitysynth.scripts import (
+    accessibility, cache, datasources, departure_times, sampling, utils,
+    wlcm)
+from activitysynth.scripts.zones import ZoneSystem
 
 
 # load existing model steps from the model manager
@@ -19,7 +22,7 @@ mm.initialize()
 
 
 @orca.step()
-def initialize_imputed_skims(mtc_skims):
+def initialize_imputed_skims(skims_chunksize, input_data_dir, input_fnames):
 
     # if imputed skims exist, just load them
     try:
@@ -29,9 +32,26 @@ def initialize_imputed_skims(mtc_skims):
     except FileNotFoundError:
         print('No imputed skims found. Creating them now.')
 
+        # imputation only needs the MTC drive distances
+        mtc_skims = orca.DataFrameWrapper(
+            'mtc_skims', datasources.read_columns(
+                'mtc_skims', utils.mtc_dist_columns))
+
         try:
-            raw_skims = orca.get_table('beam_skims_raw')
-            df = utils.impute_missing_skims(mtc_skims, raw_skims)
+            # stream the raw skims from disk and write the imputed
+            # skims back to the data directory a block at a time
+            if skims_chunksize and input_fnames:
+                utils.impute_missing_skims_streaming(
+                    mtc_skims,
+                    os.path.join(
+                        input_data_dir, input_fnames['beam_skims_raw']),
+                    os.path.join(
+                        input_data_dir, input_fnames['beam_skims_imputed']),
+                    chunksize=skims_chunksize)
+                df = orca.get_table('beam_skims_imputed').to_frame()
+            else:
+                raw_skims = orca.get_table('beam_skims_raw')
+                df = utils.impute_missing_skims(mtc_skims, raw_skims)
         except FileNotFoundError:
             print(
                 "Couldn't find raw skims either. Make sure there "
@@ -40,29 +60,66 @@ def initialize_imputed_skims(mtc_skims):
     orca.add_table('beam_skims_imputed', df, cache=True)
 
 
+# each of these variables must be defined for the zones table since
+# the skims are reported at the zone level. currently they get created
+# in variables.py under the section commented as "ZONES VARIABLES".
+# they are measured on the skims of the period they were estimated on.
+skim_access_specs = [
+    (col + '_{0}_{1}'.format(impedance, tt), col,
+     '{0}_{1}'.format(impedance, utils.default_skim_period), tt, agg)
+    for impedance in ['gen_tt_WALK_TRANSIT', 'gen_tt_CAR']
+    for cols, tts, agg in [
+        (['total_jobs', 'sum_persons', 'sum_income',
+          'sum_residential_units'], [15, 45], 'sum'),
+        (['avg_income'], [30], 'mean')]
+    for col in cols
+    for tt in tts]
+
+
+# computed columns can feed any accessibility variable, so cached
+# accessibilities are keyed on their definitions too
+variables_path = os.path.join(os.path.dirname(__file__), 'variables.py')
+
+
 @orca.step()
-def skims_aggregations(beam_skims_imputed):
-
-    for impedance in ['gen_tt_WALK_TRANSIT', 'gen_tt_CAR']:
-
-        # each of these columns must be defined for the
-        # zones table since the skims are reported at
-        # the zone level. currently they get created in
-        # variables.py under the section commented as
-        # "ZONES VARIABLES"
-        for col in [
-                'total_jobs', 'sum_persons', 'sum_income',
-                'sum_residential_units']:
-            for tt in [15, 45]:
-                utils.register_skim_access_variable(
-                    col + '_{0}_'.format(impedance) + str(tt),
-                    col, impedance, tt, beam_skims_imputed)
-
-        for col in ['avg_income']:
-            for tt in [30]:
-                utils.register_skim_access_variable(
-                    col + '_{0}_'.format(impedance) + str(tt),
-                    col, impedance, tt, beam_skims_imputed, np.mean)
+def skims_aggregations():
+    """
+    Register every skim-based zonal accessibility variable. They are
+    computed together in one pass over the dense skims, or loaded from
+    the cache if the skims, specs and zonal inputs are all unchanged.
+
+    """
+    cache_path = _access_cache_path(
+        'zones',
+        orca.get_injectable('beam_skim_store').fingerprint,
+        skim_access_specs,
+        cache.file_hash(variables_path),
+        _tables_fingerprint(['zones', 'households', 'jobs'] +
+                            geography_tables))
+
+    zone_access_vars = None
+    if cache_path is not None:
+        zone_access_vars = cache.load_frame(cache_path)
+
+    if zone_access_vars is not None:
+        for col in zone_access_vars.columns:
+            orca.add_column('zones', col, zone_access_vars[col])
+        return
+
+    utils.register_skim_access_variables(skim_access_specs)
+
+    if cache_path is not None:
+        cache.save_frame(
+            orca.get_injectable('zone_skim_accessibilities'), cache_path)
+
+
+# tables and columns written by each accessibility step. when the
+# steps are run in parallel these are copied back from the workers.
+accessibility_step_outputs = {
+    'network_aggregations_small': {'nodessmall': None},
+    'network_aggregations_walk': {'nodeswalk': None},
+    'skims_aggregations': {
+        'zones': [spec[0] for spec in skim_access_specs]}}
 
 
 @orca.step()
@@ -70,15 +127,35 @@ def test_manual_registration():
     print("Model step is running")
 
 
+def _network_fingerprint(nodes_name, edges_name):
+    """
+    Fingerprint of the node and edge files of a network, or None if
+    either has no file on disk. It keys the node id and accessibility
+    caches; the networks themselves are not cached, pandana cannot
+    save its contraction hierarchy or precomputed ranges, so they are
+    rebuilt on every run.
+    """
+    fingerprints = [
+        datasources.source_fingerprint(table_name)
+        for table_name in [nodes_name, edges_name]]
+    if None in fingerprints:
+        return None
+    return cache.cache_key(*fingerprints)
+
+
 @orca.step()
 def initialize_network_small():
     """
     This will be turned into a data loading template.
     """
+    @orca.injectable('netsmall_fingerprint', cache=True)
+    def netsmall_fingerprint():
+        return _network_fingerprint('drive_nodes', 'drive_edges')
+
     @orca.injectable('netsmall', cache=True)
     def build_networksmall(drive_nodes, drive_edges):
-        drive_nodes = drive_nodes.to_frame()
-        drive_edges = drive_edges.to_frame()
+        drive_nodes = drive_nodes.to_frame(columns=['x', 'y'])
+        drive_edges = drive_edges.to_frame(columns=['u', 'v', 'length'])
         netsmall = pdna.Network(
             drive_nodes.x, drive_nodes.y, drive_edges.u,
             drive_edges.v, drive_edges[['length']],
@@ -93,10 +170,14 @@ def initialize_network_walk():
     This will be turned into a data loading template.
 
     """
+    @orca.injectable('netwalk_fingerprint', cache=True)
+    def netwalk_fingerprint():
+        return _network_fingerprint('walk_nodes', 'walk_edges')
+
     @orca.injectable('netwalk', cache=True)
     def build_networkwalk(walk_nodes, walk_edges):
-        walk_nodes = walk_nodes.to_frame()
-        walk_edges = walk_edges.to_frame()
+        walk_nodes = walk_nodes.to_frame(columns=['x', 'y'])
+        walk_edges = walk_edges.to_frame(columns=['u', 'v', 'length'])
         netwalk = pdna.Network(
             walk_nodes.x, walk_nodes.y, walk_edges.u,
             walk_edges.v, walk_edges[['length']], twoway=True)
@@ -104,29 +185,141 @@ def initialize_network_walk():
         return netwalk
 
 
+# tables that determine which network nodes and zones every agent
+# maps to, on top of the tables that are aggregated themselves
+geography_tables = ['parcels', 'buildings', 'units']
+
+
+def _tables_fingerprint(table_names):
+    return cache.cache_key(*[
+        utils.frame_fingerprint(orca.get_table(table_name).local)
+        for table_name in sorted(set(table_names))])
+
+
+def _access_cache_path(table_name, *key_parts):
+    """
+    Path of a cached accessibility table, or None if caching is off or
+    part of the inputs cannot be identified.
+    """
+    if not orca.get_injectable('use_access_cache') or None in key_parts:
+        return None
+    return os.path.join(
+        orca.get_injectable('cache_dir'), 'accessibility',
+        '{0}_{1}.parquet'.format(table_name, cache.cache_key(*key_parts)))
+
+
+def _network_aggregations(table_name, net_name, cfgname, nodes_name,
+                          edges_name):
+    """
+    Compute network aggregations from a yaml config, or load them from
+    the cache if the config, computed column definitions, network and
+    aggregated tables are all unchanged since they were last computed.
+    """
+    cfg_path = misc.config(cfgname)
+    with open(cfg_path) as f:
+        table_names = [
+            var['dataframe'] for var in
+            yaml.safe_load(f)['variable_definitions']]
+
+    cache_path = _access_cache_path(
+        table_name, cache.file_hash(cfg_path),
+        cache.file_hash(variables_path),
+        _network_fingerprint(nodes_name, edges_name),
+        _tables_fingerprint(table_names + geography_tables))
+
+    nodes = None
+    if cache_path is not None:
+        nodes = cache.load_frame(cache_path)
+
+    if nodes is None:
+        nodes = accessibility.from_yaml(
+            orca.get_injectable(net_name), cfgname)
+        nodes = nodes.fillna(0)
+        if cache_path is not None:
+            cache.save_frame(nodes, cache_path)
+
+    print(nodes.describe())
+    orca.add_table(table_name, nodes)
+
+
+def update_network_aggregations(table_name, cfgname, edges_name, twoway,
+                                base_frames):
+    """
+    Update a table of network aggregations in place after a scenario
+    has edited some of its source tables, rather than recomputing it
+    for the whole region.
+
+    Parameters
+    ----------
+    table_name : str
+        e.g. 'nodeswalk'.
+    cfgname : str
+        Config the table was computed from.
+    edges_name : str
+        Table of network edges.
+    twoway : bool
+        Whether the network was built as a two-way network.
+    base_frames : dict
+        Source frames from accessibility.source_frames(cfgname) taken
+        before the edits.
+    """
+    nodes = accessibility.update_from_yaml(
+        orca.get_table(table_name).local, cfgname,
+        orca.get_table(edges_name).to_frame(), base_frames,
+        accessibility.source_frames(cfgname), twoway)
+    orca.add_table(table_name, nodes)
+
+
+# config, edges table and two-way flag of the network each network
+# aggregations table was computed on
+network_aggregation_specs = {
+    'nodessmall': ('network_aggregations_small.yaml', 'drive_edges', False),
+    'nodeswalk': ('network_aggregations_walk.yaml', 'walk_edges', True)}
+
+
+def run_scenario(scenario_steps):
+    """
+    Run steps that edit the model tables, e.g. adding or removing
+    buildings, and then update the network aggregations for the
+    records they changed. Zone-level skim aggregations are left as
+    they are.
+
+    Parameters
+    ----------
+    scenario_steps : list of str
+        Names of the orca steps that make up the scenario.
+    """
+    base_frames = {
+        table_name: accessibility.source_frames(cfgname)
+        for table_name, (cfgname, _, _) in network_aggregation_specs.items()}
+
+    orca.run(scenario_steps)
+
+    for table_name, (cfgname, edges_name, twoway) in \
+            network_aggregation_specs.items():
+        update_network_aggregations(
+            table_name, cfgname, edges_name, twoway, base_frames[table_name])
+
+
 @orca.step()
-def network_aggregations_small(netsmall):
+def network_aggregations_small():
     """
     This will be turned into a network aggregation template.
     """
-    nodessmall = networks.from_yaml(
-        netsmall, 'network_aggregations_small.yaml')
-    nodessmall = nodessmall.fillna(0)
-
-    print(nodessmall.describe())
-    orca.add_table('nodessmall', nodessmall)
+    _network_aggregations(
+        'nodessmall', 'netsmall', 'network_aggregations_small.yaml',
+        'drive_nodes', 'drive_edges')
 
 
 @orca.step()
-def network_aggregations_walk(netwalk):
+def network_aggregations_walk():
     """
     This will be turned into a network aggregation template.
 
     """
-    nodeswalk = networks.from_yaml(netwalk, 'network_aggregations_walk.yaml')
-    nodeswalk = nodeswalk.fillna(0)
-    print(nodeswalk.describe())
-    orca.add_table('nodeswalk', nodeswalk)
+    _network_aggregations(
+        'nodeswalk', 'netwalk', 'network_aggregations_walk.yaml',
+        'walk_nodes', 'walk_edges')
 
 
 @orca.step()
@@ -136,27 +329,62 @@ def network_aggregations_beam(netbeam):
 
     """
 
-    nodesbeam = networks.from_yaml(netbeam, 'network_aggregations_beam.yaml')
+    nodesbeam = accessibility.from_yaml(
+        netbeam, 'network_aggregations_beam.yaml')
     nodesbeam = nodesbeam.fillna(0)
     print(nodesbeam.describe())
     orca.add_table('nodesbeam', nodesbeam)
 
 
+# importance sampling of WLCM jobs by band of generalized car travel time
+# (minutes) from home, see sampling.ZoneImportanceSampler. None samples
+# jobs uniformly.
+wlcm_sampling = {
+    'measure': 'gen_tt_CAR_' + utils.default_skim_period,
+    'bands': [15, 30, 45, 60],
+    'band_weights': [8, 4, 2, 1, 0.5]}
+
+
 @orca.step()
-def wlcm_simulate(beam_skims_imputed):
+def wlcm_simulate(wlcm_workers, wlcm_max_rounds):
     """
     Generate workplace location choices for the synthetic pop. This is just
     a temporary workaround until the model templates themselves can handle
     interaction terms. Otherwise the model template would normally not need
     an addtional orca step wrapper such as is defined here.
 
+    With wlcm_workers set, chooser batches are simulated side by side in
+    that many worker processes, the skims are gathered from the skim
+    store for the sampled pairs instead of being joined as a frame and
+    jobs are sampled by importance as set in wlcm_sampling. Choosers
+    that lose a capacity conflict draw again for up to wlcm_max_rounds
+    rounds before sampling new jobs.
     """
-    interaction_terms = beam_skims_imputed.to_frame().rename_axis(
-        ['zone_id_home', 'zone_id_work'])
-
     m = mm.get_step('WLCM_gen_tt_simple')
 
-    m.run(chooser_batch_size=200000, interaction_terms=[interaction_terms])
+    # the model was estimated on the skims of one period, which it reads
+    # without their period suffix
+    period = utils.default_skim_period
+    if wlcm_workers is None:
+        skims = orca.get_table('beam_skims_imputed')
+        columns = utils.period_skim_columns(skims.columns, period)
+        interaction_terms = skims.to_frame(columns=list(columns)).rename(
+            columns=columns)
+        interaction_terms.rename_axis(
+            ['zone_id_home', 'zone_id_work'], inplace=True)
+        m.run(
+            chooser_batch_size=200000, interaction_terms=[interaction_terms])
+    else:
+        skim_store = orca.get_injectable('beam_skim_store')
+        sampler = None
+        if wlcm_sampling is not None:
+            sampler = sampling.ZoneImportanceSampler(
+                skim_store, **wlcm_sampling)
+        wlcm.simulate(
+            m, interaction_terms=[
+                wlcm.SkimInteractionTerms(skim_store, period=period)],
+            chooser_batch_size=200000, workers=wlcm_workers,
+            sampler=sampler, max_rounds=wlcm_max_rounds)
 
     orca.broadcast(
         'jobs', 'persons', cast_index=True, onto_on='job_id')
@@ -174,16 +402,28 @@ def auto_ownership_simulate(households):
     """
     m = mm.get_step('auto_ownership')
 
-    # remove filters, specify out tables
+    # remove filters
     m.filters = None
-    m.tables = [
-        'households', 'units', 'buildings', 'parcels', 'nodessmall',
-        'nodeswalk']
-    m.out_tables = [
+
+    # merge only the columns the model uses rather than every column of
+    # the six tables, including all of the node accessibilities
+    tables = [
         'households', 'units', 'buildings', 'parcels', 'nodessmall',
         'nodeswalk']
+    hh_merged = orca.merge_tables(
+        'households', tables,
+        columns=utils.available_columns(tables, utils.step_columns(m)))
+    orca.add_table('hh_merged', hh_merged)
+
+    m.tables = 'hh_merged'
+    m.out_tables = 'hh_merged'
     m.run()
 
+    out_column = m.out_column or m.choice_column
+    update_column(
+        'households', out_column,
+        orca.get_table('hh_merged').get_column(out_column))
+
 
 @orca.step()
 def primary_mode_choice_simulate(persons):
@@ -200,21 +440,22 @@ def primary_mode_choice_simulate(persons):
     """
 
     @orca.table(cache=True)
-    def persons_CHTS_format(mtc_skims):
+    def persons_CHTS_format(mtc_skim_store, zone_system):
     # use persons with jobs for persons
-        persons = orca.get_table('persons').to_frame()
+        persons = orca.get_table('persons').to_frame(columns=[
+            'sex','age','race_id','worker','edu','household_id','job_id', 'TOD'])
         persons.index.name = 'person_id'
         persons.reset_index(inplace=True)
         persons = persons[['person_id','sex','age','race_id','worker','edu','household_id','job_id', 'TOD']]
 
-        hh_df = orca.get_table('households').to_frame().reset_index()[['household_id','cars','tenure','income','persons','building_id']]
-        jobs_df = orca.get_table('jobs').to_frame().reset_index()[['job_id','building_id']]
-        buildings_df = orca.get_table('buildings').to_frame().reset_index()[['building_id','parcel_id']]
-        try:
-            parcels_df = orca.get_table('parcels').to_frame().reset_index()[['parcel_id','zone_id']]
-        except KeyError:
-            parcels_df = orca.get_table('parcels').to_frame().reset_index()[['primary_id','zone_id']]
-            parcels_df.rename(columns = {'primary_id':'parcel_id'}, inplace = True)
+        hh_df = orca.get_table('households').to_frame(columns=[
+            'cars','tenure','income','persons','building_id']).reset_index()[['household_id','cars','tenure','income','persons','building_id']]
+        jobs_df = orca.get_table('jobs').to_frame(columns=['building_id']).reset_index()[['job_id','building_id']]
+        buildings_df = orca.get_table('buildings').to_frame(columns=['parcel_id']).reset_index()[['building_id','parcel_id']]
+        # the parcels index is named primary_id in some inputs
+        parcels_df = orca.get_table('parcels').to_frame(columns=['zone_id'])
+        parcels_df.index.name = 'parcel_id'
+        parcels_df = parcels_df.reset_index()[['parcel_id','zone_id']]
 
         # rename columns/change values to match CHTS
         persons.columns = ['person_id','GEND','AGE','RACE1','JOBS','EDUCA','household_id','job_id', 'TOD']
@@ -224,24 +465,6 @@ def primary_mode_choice_simulate(persons):
                                                             20:4,21:5,22:6,23:6,24:6})
         persons.TOD = persons.TOD.map({2:'EA',3:'EA',12:'AM',14:'AM',22:'MD',23:'MD',24:'MD'})
 
-        # read skim
-        skim = orca.get_table('mtc_skims').to_frame()
-        
-        skim.columns = skim.columns.str.replace('_distance','_Distance') # capitalization issues
-        skim.columns = skim.columns.str.replace('_cost','_Cost')
-        
-        EA_skim = skim[['orig','dest']+list(skim.filter(like = 'EA').columns)]
-        EA_skim.columns = EA_skim.columns.str.replace('_EA','')
-        EA_skim['TOD'] = 'EA'
-        AM_skim = skim[['orig','dest']+list(skim.filter(like = 'AM').columns)]
-        AM_skim.columns = AM_skim.columns.str.replace('_AM','')
-        AM_skim['TOD'] = 'AM'
-        MD_skim = skim[['orig','dest']+list(skim.filter(like = 'MD').columns)]
-        MD_skim.columns = MD_skim.columns.str.replace('_MD','')
-        MD_skim['TOD'] = 'MD'
-
-        skim_combined = pd.concat([EA_skim,AM_skim,MD_skim])
-
         MTC_acc = pd.read_csv('./data/MTC_TAZ_accessibility.csv')
 
         # merge attributes onto persons
@@ -260,10 +483,32 @@ def primary_mode_choice_simulate(persons):
         persons.drop(['building_id','parcel_id'],axis = 1,inplace = True)
 
 
-        persons = persons.merge(MTC_acc, how = 'left',left_on = 'orig', right_on = 'taz1454')
-        persons[MTC_acc.columns] = persons[MTC_acc.columns].fillna(0)
-
-        persons = persons.merge(skim_combined, how = 'left', on = ['orig','dest','TOD'])
+        # gather the accessibilities by zone code rather than merging on
+        # zone ids, which are floats after the left merges above
+        acc_zones = ZoneSystem(MTC_acc['taz1454'].values)
+        acc_codes = acc_zones.encode(persons['orig'].values)
+        MTC_acc.set_index('taz1454', drop=False, inplace=True)
+        for col in MTC_acc.columns:
+            persons[col] = acc_zones.take(MTC_acc[col], acc_codes, 0)
+
+        # look up each person's skims for their departure period straight
+        # from the dense skim store rather than merging the full skims
+        orig_codes = zone_system.recode(
+            zone_system.encode(persons['orig'].values), mtc_skim_store.zones)
+        dest_codes = zone_system.recode(
+            zone_system.encode(persons['dest'].values), mtc_skim_store.zones)
+        for period in ['EA', 'AM', 'MD']:
+            in_period = (persons['TOD'] == period).values
+            for measure in mtc_skim_store.measures:
+                if '_' + period not in measure:
+                    continue
+                col = measure.replace('_' + period, '')
+                col = col.replace('_distance', '_Distance')  # capitalization issues
+                col = col.replace('_cost', '_Cost')
+                if col not in persons.columns:
+                    persons[col] = np.nan
+                persons.loc[in_period, col] = mtc_skim_store.take(
+                    orig_codes[in_period], dest_codes[in_period], measure)
 
         
         # rename the remaning attributes
@@ -285,37 +530,47 @@ def primary_mode_choice_simulate(persons):
 
 
 @orca.step()
-def TOD_choice_simulate(mtc_skims):
+def TOD_choice_simulate(mtc_skim_store, zone_system):
     """
     Generate time of day period choices for the synthetic population
     home-work and work-home trips.
     """
-    TOD_obs = orca.merge_tables('persons', ['persons', 'households', 'jobs'])
+    m = mm.get_step('TOD_choice')
+
+    # only the model's own columns and the home/work zones to look the
+    # skims up by
+    tables = ['persons', 'households', 'jobs']
+    columns = utils.step_columns(m)
+    TOD_obs = orca.merge_tables(
+        'persons', tables, columns=utils.available_columns(
+            tables, columns | {'zone_code_home', 'zone_code_work'}))
     
     # TOD_obs.dropna(inplace = True)
     TOD_obs.reset_index(inplace=True)
 
-    mtc_skims = orca.get_table('mtc_skims').to_frame()
-    
-    TOD_obs = pd.merge(TOD_obs, mtc_skims, how = 'left', 
-                       left_on=['zone_id_home', 'zone_id_work'], 
-                       right_on=['orig', 'dest'])
-
-    TOD_obs = pd.merge(TOD_obs, mtc_skims, how = 'left',
-                       left_on=['zone_id_work','zone_id_home'], 
-                       right_on=['orig', 'dest'], suffixes=('_HW', '_WH'))
-    
-    TOD_list = ['EA','AM','MD','PM','EV']
-
-    for tod1 in TOD_list:
-        for tod2 in TOD_list:
+    # gather the home-work and work-home drive times of every period
+    # straight from the dense skims, then add up every pair of periods
+    # in one broadcast rather than merging the full skims on twice
+    TOD_list = ['EA', 'AM', 'MD', 'PM', 'EV']
+    home = zone_system.recode(
+        TOD_obs['zone_code_home'].values, mtc_skim_store.zones)
+    work = zone_system.recode(
+        TOD_obs['zone_code_work'].values, mtc_skim_store.zones)
+    HW = np.column_stack([
+        mtc_skim_store.take(home, work, f'da_Time_{tod}') for tod in TOD_list])
+    WH = np.column_stack([
+        mtc_skim_store.take(work, home, f'da_Time_{tod}') for tod in TOD_list])
+    da_Time = HW[:, :, None] + WH[:, None, :]
+
+    # the model only reads a few of the period pairs
+    for i, tod1 in enumerate(TOD_list):
+        for j, tod2 in enumerate(TOD_list):
             col_name = f'da_Time_{tod1}_{tod2}'
-            TOD_obs[col_name] = TOD_obs[f'da_Time_{tod1}_HW'] + TOD_obs[f'da_Time_{tod2}_WH']
+            if col_name in columns:
+                TOD_obs[col_name] = da_Time[:, i, j]
 
     # TOD_obs['TOD'] = None
     
-    m = mm.get_step('TOD_choice')
-    
     @orca.table(cache=True)
     def tripsA():
         return TOD_obs
@@ -338,192 +593,18 @@ def TOD_distribution_simulate():
     """
     Generate specific time of day choices for the synthetic population
     home-work and work-home trips.
-    
-    """
-    persons = orca.get_table('persons').to_frame()
-    
-    trips02 = persons.loc[persons['TOD'].isin([2])]
-    trips03 = persons.loc[persons['TOD'].isin([3])]
-    trips12 = persons.loc[persons['TOD'].isin([12])]
-    trips13 = persons.loc[persons['TOD'].isin([13])]
-    trips14 = persons.loc[persons['TOD'].isin([14])]
-    trips22 = persons.loc[persons['TOD'].isin([22])]
-    trips23 = persons.loc[persons['TOD'].isin([23])]
-    trips24 = persons.loc[persons['TOD'].isin([24])]
-    
-    trips02['HW_ST'] = st.burr.rvs(size= len(trips02), 
-                                   c=104.46,d=0.03,loc=2.13,scale=3.72)
-    trips02['WH_ST'] = st.argus.rvs(size= len(trips02), 
-                                    chi=3.02,loc=7.70,scale=7.66)
-
-    trips03['HW_ST'] = st.genlogistic.rvs(size= len(trips03), c=0.08,loc=5.86,scale=0.05)
-    trips03['WH_ST'] = st.bradford.rvs(size= len(trips03), c=8.91, loc=15.50, scale=3.01)
 
-    trips12['HW_ST'] = st.vonmises_line.rvs(size= len(trips12), 
-                                            kappa=0.33,loc=7.48,scale=0.47)
-    trips12['WH_ST'] = st.johnsonsb.rvs(size= len(trips12), 
-                                        a=-0.95, b=0.71, loc=8.69, scale=6.80)
-
-    trips13['HW_ST'] = st.vonmises_line.rvs(size= len(trips13), 
-                                            kappa=0.46,loc=7.48,scale=0.47)
-    trips13['WH_ST'] = st.vonmises_line.rvs(size= len(trips13), 
-                                            kappa=0.41, loc=16.99, scale=0.47)
-
-    trips14['HW_ST'] = st.beta.rvs(size= len(trips14), a=1.58,b=1.14,loc=5.90,scale=3.07)
-    trips14['WH_ST'] = st.pareto.rvs(size= len(trips14), b=19.93, loc=-0.36, scale=18.86)
-
-    trips22['HW_ST'] = st.weibull_min.rvs(size= len(trips22), c=0.95,loc=9.00,scale=1.04)
-    trips22['WH_ST'] = st.burr.rvs(size= len(trips22), 
-                                   c=263.97, d=0.03, loc=-1.00, scale=16.33)
-
-    trips23['HW_ST'] = st.levy.rvs(size= len(trips23), loc=8.93,scale=0.30)
-    trips23['WH_ST'] = st.triang.rvs(size= len(trips23), c=0.90, loc=15.17, scale=3.34)
-
-    trips24['WH_ST'] = st.bradford.rvs(size= len(trips24), c=21.60, loc=18.50, scale=7.76)
-    
-    #make sure start times are within the correct period of day:
-    while len(trips02.loc[(trips02['HW_ST'] < 3) | (trips02['HW_ST'] >= 6)]) > 0:
-        trips02.loc[ (trips02['HW_ST'] < 3) | (trips02['HW_ST'] >= 6),
-           'HW_ST'] = st.burr.rvs(size= len(trips02.loc[(trips02['HW_ST'] < 3) |
-                                                        (trips02['HW_ST'] >= 6)]), 
-                                  c=104.46,d=0.03,loc=2.13,scale=3.72)
-
-    while len(trips03.loc[(trips03['HW_ST'] < 3) | (trips03['HW_ST'] >= 6)]) > 0:
-        trips03.loc[ (trips03['HW_ST'] < 3) | (trips03['HW_ST'] >= 6),
-           'HW_ST'] = st.genlogistic.rvs(size= len(trips03.loc[(trips03['HW_ST'] < 3) |
-                                                               (trips03['HW_ST'] >= 6)]), 
-                                         c=0.08,loc=5.86,scale=0.05)
-    while len(trips12.loc[(trips12['HW_ST'] < 6) | (trips12['HW_ST'] >= 9)]) > 0:
-        trips12.loc[ (trips12['HW_ST'] < 6) | (trips12['HW_ST'] >= 9),
-           'HW_ST'] = st.vonmises_line.rvs(size= len(trips12.loc[(trips12['HW_ST'] < 6) | 
-                                                                 (trips12['HW_ST'] >= 9)]), 
-                                           kappa=0.33,loc=7.48,scale=0.47)
-
-    while len(trips13.loc[(trips13['HW_ST'] < 6) | (trips13['HW_ST'] >= 9)]) > 0:
-        trips13.loc[ (trips13['HW_ST'] < 6) | (trips13['HW_ST'] >= 9),
-           'HW_ST'] = st.vonmises_line.rvs(size= len(trips13.loc[(trips13['HW_ST'] < 6) | 
-                                                                 (trips13['HW_ST'] >= 9)]), 
-                                           kappa=0.46,loc=7.48,scale=0.47)
-
-    while len(trips14.loc[(trips14['HW_ST'] < 6) | (trips14['HW_ST'] >= 9)]) > 0:
-        trips14.loc[ (trips14['HW_ST'] < 6) | (trips14['HW_ST'] >= 9),
-           'HW_ST'] = st.beta.rvs(size= len(trips14.loc[(trips14['HW_ST'] < 6) | 
-                                                        (trips14['HW_ST'] >= 9)]), 
-                                  a=1.58,b=1.14,loc=5.90,scale=3.07)
-
-    while len(trips22.loc[(trips22['HW_ST'] < 9) | (trips22['HW_ST'] >= 15.5)]) > 0:
-        trips22.loc[ (trips22['HW_ST'] < 9) | (trips22['HW_ST'] >= 15.5),
-           'HW_ST'] = st.weibull_min.rvs(size= len(trips22.loc[(trips22['HW_ST'] < 9) | 
-                                                               (trips22['HW_ST'] >= 15.5)]), 
-                                         c=0.95,loc=9.00,scale=1.04)
-
-    while len(trips23.loc[(trips23['HW_ST'] < 9) | (trips23['HW_ST'] >= 15.5)]) > 0:
-        trips23.loc[ (trips23['HW_ST'] < 9) | (trips23['HW_ST'] >= 15.5),
-           'HW_ST'] = st.levy.rvs(size= len(trips23.loc[(trips23['HW_ST'] < 9) | 
-                                                        (trips23['HW_ST'] >= 15.5)]), 
-                                  loc=8.93,scale=0.30)
-    
-    while len(trips02.loc[(trips02['WH_ST'] < 9) | (trips02['WH_ST'] >= 15.5)]) > 0:
-        trips02.loc[ (trips02['WH_ST'] < 9) | (trips02['WH_ST'] >= 15.5),
-           'WH_ST'] = st.argus.rvs(size= len(trips02.loc[(trips02['WH_ST'] < 9) | 
-                                                         (trips02['WH_ST'] >= 15.5)]), 
-                                   chi=3.02,loc=7.70,scale=7.66)
-
-    while len(trips03.loc[(trips03['WH_ST'] < 15.5) | (trips03['WH_ST'] >= 18.5)]) > 0:
-        trips03.loc[ (trips03['WH_ST'] < 15.5) | (trips03['WH_ST'] >= 18.5),
-           'WH_ST'] = st.bradford.rvs(size= len(trips03.loc[(trips03['WH_ST'] < 15.5) | 
-                                                            (trips03['WH_ST'] >= 18.5)]), 
-                                      c=8.91, loc=15.50, scale=3.01)
-
-    while len(trips12.loc[(trips12['WH_ST'] < 9) | (trips12['WH_ST'] >= 15.5)]) > 0:
-        trips12.loc[ (trips12['WH_ST'] < 9) | (trips12['WH_ST'] >= 15.5),
-           'WH_ST'] = st.johnsonsb.rvs(size= len(trips12.loc[(trips12['WH_ST'] < 9) | 
-                                                             (trips12['WH_ST'] >= 15.5)]), 
-                                       a=-0.95, b=0.71, loc=8.69, scale=6.80)
-
-    while len(trips13.loc[(trips13['WH_ST'] < 15.5) | (trips13['WH_ST'] >= 18.5)]) > 0:
-        trips13.loc[ (trips13['WH_ST'] < 15.5) | (trips13['WH_ST'] >= 18.5),
-           'WH_ST'] = st.vonmises_line.rvs(size= len(
-            trips13.loc[(trips13['WH_ST'] < 15.5) | (trips13['WH_ST'] >= 18.5)]), 
-                                           kappa=0.41, loc=16.99, scale=0.47)
- 
-    while len(trips14.loc[(trips14['WH_ST'] < 18.5) | (trips14['WH_ST'] >= 27)]) > 0:
-        trips14.loc[ (trips14['WH_ST'] < 18.5) | (trips14['WH_ST'] >= 27),
-           'WH_ST'] = st.pareto.rvs(size= len(trips14.loc[(trips14['WH_ST'] < 18.5) | 
-                                                          (trips14['WH_ST'] >= 27)]), 
-                                    b=19.93, loc=-0.36, scale=18.86)
-
-    trips14.loc[ (trips14['WH_ST'] > 24),'WH_ST'] = trips14['WH_ST'] - 24
-    
-    while len(trips22.loc[(trips22['WH_ST'] < 9) | (trips22['WH_ST'] >= 15.5)]) > 0:
-        trips22.loc[ (trips22['WH_ST'] < 9) | (trips22['WH_ST'] >= 15.5),
-           'WH_ST'] = st.burr.rvs(size= len(trips22.loc[(trips22['WH_ST'] < 9) | 
-                                                        (trips22['WH_ST'] >= 15.5)]), 
-                                  c=263.97, d=0.03, loc=-1.00, scale=16.33)
-    #make sure HW time is before WH time for people in period 22:
-    while len(trips22.loc[(trips22['HW_ST'] >= trips22['WH_ST'])]) > 0:
-        trips22.loc[ (trips22['HW_ST'] >= trips22['WH_ST']),
-           'WH_ST'] = st.burr.rvs(size= len(trips22.loc[(trips22['HW_ST'] >= 
-                                                         trips22['WH_ST'])]), 
-                                  c=263.97, d=0.03, loc=-1.00, scale=16.33)
-
-        trips22.loc[ (trips22['HW_ST'] >= trips22['WH_ST']),
-           'HW_ST'] = st.weibull_min.rvs(size= len(trips22.loc[(trips22['HW_ST'] >= 
-                                                                trips22['WH_ST'])]), 
-                                         c=0.95,loc=9.00,scale=1.04)
-    
-    while len(trips23.loc[(trips23['WH_ST'] < 15.5) | (trips23['WH_ST'] >= 18.5)]) > 0:
-        trips23.loc[ (trips23['WH_ST'] < 15.5) | (trips23['WH_ST'] >= 18.5),
-           'WH_ST'] = st.triang.rvs(size= len(trips23.loc[(trips23['WH_ST'] < 15.5) | 
-                                                          (trips23['WH_ST'] >= 18.5)]), 
-                                    c=0.90, loc=15.17, scale=3.34)
-
-    while len(trips24.loc[(trips24['WH_ST'] < 18.5) | (trips24['WH_ST'] >= 27)]) > 0:
-        trips24.loc[ (trips24['WH_ST'] < 18.5) | (trips24['WH_ST'] >= 27),
-           'WH_ST'] = st.bradford.rvs(size= len(trips24.loc[(trips24['WH_ST'] < 18.5) | 
-                                                            (trips24['WH_ST'] >= 27)]), 
-                                      c=21.60, loc=18.50, scale=7.76)
-    
-    trips24.loc[ (trips24['WH_ST'] > 24),'WH_ST'] = trips24['WH_ST'] - 24
-    
-    #set up separate HW distribution assignment for 9am-12pm and 12-3:29pm:
-    trips24a = trips24.sample(int(round(len(trips24)*(241/377))))
-
-    AM = trips24a.index.unique()
-
-    trips24b = trips24[~trips24.index.isin(AM)] 
-    
-    trips24a['HW_ST'] = st.bradford.rvs(size= len(trips24a), c=9.63, loc=9.00, scale=2.83)
-    trips24b['HW_ST'] = st.exponweib.rvs(size= len(trips24b), 
-                                         a=0.05, c=21.50, loc=11.99, scale=3.23)
-    
-    while len(trips24a.loc[(trips24a['HW_ST'] < 9) | (trips24a['HW_ST'] >= 12)]) > 0:
-        trips24a.loc[ (trips24a['HW_ST'] < 9) | (trips24a['HW_ST'] >= 12),
-           'HW_ST'] = st.bradford.rvs(size= len(trips24a.loc[(trips24a['HW_ST'] < 9) | 
-                                                             (trips24a['HW_ST'] >= 12)]), 
-                                      c=9.63, loc=9.00, scale=2.83)
-
-    while len(trips24b.loc[(trips24b['HW_ST'] < 12) | (trips24b['HW_ST'] >= 15.5)]) > 0:
-        trips24b.loc[ (trips24b['HW_ST'] < 12) | (trips24b['HW_ST'] >= 15.5),
-           'HW_ST'] = st.exponweib.rvs(size= len(trips24b.loc[(trips24b['HW_ST'] < 12) | 
-                                                              (trips24b['HW_ST'] >= 15.5)]), 
-                                       a=0.05, c=21.50, loc=11.99, scale=3.23)
-
-    cols = list(trips02.columns.values)
-
-    frames = [
-        trips02, trips03, trips12, trips13, trips14, trips22, trips23, trips24a, trips24b]
-
-    TOD_obs2 = pd.concat(frames)
+    Departure times are drawn from the distributions fitted for each
+    time of day period choice, truncated to the bounds of its periods,
+    see configs/TOD_distribution.yaml.
+    """
+    persons = orca.get_table('persons').to_frame(columns=['TOD'])
 
-    TOD_obs2 = TOD_obs2[cols]
+    TOD_obs2 = departure_times.simulate(
+        persons['TOD'], departure_times.load_specs())
 
     for col in ['HW_ST', 'WH_ST']:
         update_column('persons', col, TOD_obs2[col])
-    # persons = pd.merge(
-    #     persons, TOD_obs2[['HW_ST', 'WH_ST']], how='left',
-    #     left_index=True, right_index=True)
-    # orca.add_table('persons', persons)
 
 
 @orca.step()
@@ -531,14 +612,17 @@ def generate_activity_plans():
 
     time = str(datetime.now().strftime('%Y-%m-%d_%H:%M:%S'))
 
-    persons = orca.get_table('persons').to_frame().reset_index().rename(
+    persons = orca.get_table('persons').to_frame(columns=[
+        'household_id', 'job_id', 'HW_ST', 'WH_ST']).reset_index().rename(
         columns={'index': 'person_id'})
 
-    job_coords = orca.merge_tables('jobs', ['jobs', 'buildings', 'parcels'])
+    job_coords = orca.merge_tables(
+        'jobs', ['jobs', 'buildings', 'parcels'], columns=['x', 'y'])
     job_coords = job_coords[['x', 'y']]
 
     hh_coords = orca.merge_tables(
-        'households', ['households', 'units', 'buildings', 'parcels'])
+        'households', ['households', 'units', 'buildings', 'parcels'],
+        columns=['x', 'y'])
     hh_coords = hh_coords[['x', 'y']]
 
     trips = persons[[
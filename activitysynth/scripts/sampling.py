@@ -0,0 +1,189 @@
+import numpy as np
+
+
+def alias_tables(weights):
+    """
+    Walker alias tables for each row of a matrix of weights, built for
+    all rows at once with Vose's method.
+
+    Parameters
+    ----------
+    weights : numpy.ndarray
+        (m, n) non-negative weights. Rows without any weight get a
+        uniform distribution.
+
+    Returns
+    -------
+    prob : numpy.ndarray
+        (m, n) probability of keeping each drawn column.
+    alias : numpy.ndarray
+        (m, n) int32 column to take instead.
+    """
+    m, n = weights.shape
+    totals = weights.sum(axis=1)
+    scaled = np.ones((m, n))
+    has_weight = totals > 0
+    scaled[has_weight] = weights[has_weight] * (
+        n / totals[has_weight])[:, None]
+
+    prob = np.ones((m, n))
+    alias = np.tile(np.arange(n, dtype=np.int32), (m, 1))
+
+    # per-row stacks of the columns below and above the average
+    is_small = scaled < 1
+    order = np.argsort(~is_small, axis=1, kind='stable').astype(np.int32)
+    n_small = is_small.sum(axis=1)
+    n_large = n - n_small
+    small = order.copy()
+    large = np.take_along_axis(
+        order, np.minimum(n_small[:, None] + np.arange(n), n - 1), axis=1)
+
+    rows = np.arange(m)
+    while True:
+        r = rows[(n_small > 0) & (n_large > 0)]
+        if not len(r):
+            break
+        n_small[r] -= 1
+        n_large[r] -= 1
+        s = small[r, n_small[r]]
+        l = large[r, n_large[r]]
+        prob[r, s] = scaled[r, s]
+        alias[r, s] = l
+        scaled[r, l] -= 1 - scaled[r, s]
+
+        # the large column goes back on the stack it now belongs to
+        to_small = scaled[r, l] < 1
+        rs, ls = r[to_small], l[to_small]
+        small[rs, n_small[rs]] = ls
+        n_small[rs] += 1
+        rl, ll = r[~to_small], l[~to_small]
+        large[rl, n_large[rl]] = ll
+        n_large[rl] += 1
+
+    return prob, alias
+
+
+def alias_draws(prob, alias, rows, rng):
+    """
+    One draw per entry of `rows` from the alias tables of those rows.
+    """
+    cols = rng.integers(0, prob.shape[1], size=rows.shape)
+    keep = rng.random(rows.shape) < prob[rows, cols]
+    return np.where(keep, cols, alias[rows, cols])
+
+
+class ZoneImportanceSampler(object):
+    """
+    Importance sampling of alternatives located in zones, e.g. jobs,
+    stratified by origin zone and impedance band.
+
+    An alternative in zone z is drawn for a chooser in zone h with
+    probability proportional to the weight of the band that the skims
+    put z in from h. Zones are drawn from per-origin alias tables over
+    the zones' counts of available alternatives times their band
+    weights, and an alternative is then drawn uniformly within the
+    zone, so every draw takes constant time.
+
+    Choice probabilities stay consistent by subtracting the log of the
+    sampling weight of each sampled alternative from its utility, see
+    `log_weights` as returned by sample(). Alternatives outside the
+    skim zones are never sampled, and choosers outside them sample
+    alternatives uniformly.
+
+    Parameters
+    ----------
+    skim_store : skims.SkimStore
+    measure : str
+        Skim measure the bands are defined on, e.g. 'gen_tt_CAR_AM'.
+    bands : list of float
+        Upper bounds of all but the last band, in increasing order.
+    band_weights : list of float
+        Sampling weight of each band, one more than `bands`. Missing
+        skims get no weight.
+    obs_col : str, optional
+        Chooser column holding the origin zone id.
+    alt_col : str, optional
+        Alternative column holding the zone id of the alternative.
+    """
+
+    def __init__(self, skim_store, measure, bands, band_weights,
+                 obs_col='zone_id_home', alt_col='zone_id_work'):
+        if len(band_weights) != len(bands) + 1:
+            raise ValueError('Expected {0} band weights, got {1}'.format(
+                len(bands) + 1, len(band_weights)))
+        self.skim_store = skim_store
+        self.measure = measure
+        self.bands = list(bands)
+        self.band_weights = np.asarray(band_weights, dtype=float)
+        self.obs_col = obs_col
+        self.alt_col = alt_col
+
+    @property
+    def key_names(self):
+        return [self.obs_col, self.alt_col]
+
+    def prepare(self, observations, alternatives):
+        """
+        Encode the choosers' and alternatives' zones and weight every
+        OD pair by its band. Called once per simulation.
+        """
+        zones = self.skim_store.zones
+        self._orig = zones.encode(observations[self.obs_col].values)
+        self._zone = zones.encode(alternatives[self.alt_col].values)
+
+        impedance = np.asarray(self.skim_store.matrix(self.measure))
+        band = np.digitize(impedance, self.bands)
+        weights = self.band_weights[np.minimum(band, len(self.bands))]
+        weights[np.isnan(impedance)] = 0
+
+        # zone code -1 picks the last row, which weights zones evenly
+        self._band_weights = np.vstack([weights, np.ones(len(zones))])
+
+    def fit(self, available):
+        """
+        Build the alias tables over the zones' counts of the available
+        alternatives. Called whenever the available alternatives change.
+
+        Parameters
+        ----------
+        available : numpy.ndarray
+            Positions of the alternatives that may be sampled.
+        """
+        available = available[self._zone[available] >= 0]
+        if not len(available):
+            raise ValueError('No alternatives to sample in the skim zones')
+        zone = self._zone[available]
+        n_zones = len(self.skim_store.zones)
+
+        order = np.argsort(zone, kind='stable')
+        self._members = available[order]
+        self._counts = np.bincount(zone, minlength=n_zones)
+        self._offsets = np.r_[0, np.cumsum(self._counts)[:-1]]
+
+        # origins that reach none of the available alternatives with
+        # any weight fall back to sampling them uniformly
+        band_weights = self._band_weights.copy()
+        weights = band_weights * self._counts
+        unreachable = weights.sum(axis=1) == 0
+        band_weights[unreachable] = 1
+        weights[unreachable] = self._counts
+        self._log_weights = np.full(band_weights.shape, -np.inf)
+        np.log(band_weights, out=self._log_weights, where=band_weights > 0)
+        self._prob, self._alias = alias_tables(weights)
+
+    def sample(self, chooser_pos, k, rng):
+        """
+        Sample `k` alternatives with replacement for each chooser.
+
+        Returns
+        -------
+        alt_pos : numpy.ndarray
+            (n, k) positions of the sampled alternatives.
+        log_weights : numpy.ndarray
+            (n, k) log sampling weights, to subtract from utilities.
+        """
+        rows = np.repeat(self._orig[chooser_pos], k).reshape(-1, k)
+        zone = alias_draws(self._prob, self._alias, rows, rng)
+        member = (rng.random(zone.shape) * self._counts[zone]).astype(int)
+        alt_pos = self._members[self._offsets[zone] + member]
+        return alt_pos, self._log_weights[rows, zone]
@@ -0,0 +1,308 @@
+import os
+import json
+
+import pandas as pd
+import numpy as np
+
+from activitysynth.scripts.zones import ZoneSystem
+
+
+class SkimStore(object):
+    """
+    Dense origin-destination skims backed by memory-mapped arrays.
+
+    Each impedance measure is stored on disk as a zone x zone .npy file
+    alongside a sorted array of zone ids, so that once a store has been
+    built from the long-format skims the parse cost is never paid again
+    and the pages can be shared by every process that opens the store.
+
+    Parameters
+    ----------
+    path : str
+        Directory holding the store.
+    zone_ids : numpy.ndarray
+        Sorted external zone ids. Row/column i of every matrix
+        corresponds to zone_ids[i], i.e. to zone code i of the store's
+        ZoneSystem.
+    measures : list of str
+        Names of the impedance measures held in the store.
+    fingerprint : str, optional
+        Identifier of the source data the store was built from.
+    """
+
+    meta_fname = 'meta.json'
+    zones_fname = 'zone_ids.npy'
+
+    def __init__(self, path, zone_ids, measures, fingerprint=None):
+        self.path = path
+        self.zones = ZoneSystem(zone_ids)
+        self.zone_ids = self.zones.zone_ids
+        self.measures = list(measures)
+        self.fingerprint = fingerprint
+        self._matrices = {}
+
+    def __len__(self):
+        return len(self.zone_ids)
+
+    def __contains__(self, measure):
+        return measure in self.measures
+
+    @classmethod
+    def from_frame(
+            cls, df, path, orig_col=None, dest_col=None, measures=None,
+            dtype='float64', fingerprint=None):
+        """
+        Build a store from long-format skims and write it to disk.
+
+        Parameters
+        ----------
+        df : pandas.DataFrame
+            One row per OD pair. If `orig_col` and `dest_col` are not
+            given, the first two levels of the index are used.
+        path : str
+            Directory to write the store to. Created if missing.
+        orig_col, dest_col : str, optional
+            Names of the origin and destination zone id columns.
+        measures : list of str, optional
+            Columns to store. Defaults to every numeric column.
+        dtype : str, optional
+            Storage dtype of the matrices.
+        fingerprint : str, optional
+            Identifier of the source data, checked by `is_current()`.
+
+        Returns
+        -------
+        SkimStore
+        """
+        if orig_col is None or dest_col is None:
+            orig = df.index.get_level_values(0).values
+            dest = df.index.get_level_values(1).values
+        else:
+            orig = df[orig_col].values
+            dest = df[dest_col].values
+
+        if measures is None:
+            measures = [
+                col for col in df.select_dtypes(include=[np.number]).columns
+                if col not in (orig_col, dest_col)]
+
+        zones = ZoneSystem(np.concatenate([orig, dest]))
+        zone_ids = zones.zone_ids
+        n = len(zone_ids)
+        o = zones.encode(orig)
+        d = zones.encode(dest)
+        valid = (o >= 0) & (d >= 0)
+        o, d = o[valid], d[valid]
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        elif os.path.exists(os.path.join(path, cls.meta_fname)):
+            # invalidate the old store until the new one is complete
+            os.remove(os.path.join(path, cls.meta_fname))
+
+        for measure in measures:
+            mat = np.lib.format.open_memmap(
+                os.path.join(path, measure + '.npy'), mode='w+',
+                dtype=dtype, shape=(n, n))
+            mat[:] = np.nan
+            mat[o, d] = df[measure].values[valid]
+            mat.flush()
+            del mat
+
+        np.save(os.path.join(path, cls.zones_fname), zone_ids)
+        with open(os.path.join(path, cls.meta_fname), 'w') as f:
+            json.dump({
+                'measures': list(measures), 'dtype': dtype,
+                'fingerprint': fingerprint}, f)
+
+        return cls(path, zone_ids, measures, fingerprint)
+
+    @classmethod
+    def open(cls, path):
+        """
+        Open an existing store read-only.
+        """
+        with open(os.path.join(path, cls.meta_fname)) as f:
+            meta = json.load(f)
+        zone_ids = np.load(os.path.join(path, cls.zones_fname))
+        return cls(
+            path, zone_ids, meta['measures'], meta.get('fingerprint'))
+
+    @classmethod
+    def is_current(cls, path, fingerprint):
+        """
+        Whether a store exists at `path` and was built from the source
+        data identified by `fingerprint`.
+        """
+        meta_path = os.path.join(path, cls.meta_fname)
+        if fingerprint is None or not os.path.exists(meta_path):
+            return False
+        with open(meta_path) as f:
+            meta = json.load(f)
+        return meta.get('fingerprint') == fingerprint
+
+    def matrix(self, measure):
+        """
+        Zone x zone memory-mapped array of one impedance measure.
+        """
+        if measure not in self._matrices:
+            if measure not in self.measures:
+                raise KeyError(
+                    'Measure {0} not found in skim store at {1}'.format(
+                        measure, self.path))
+            self._matrices[measure] = np.load(
+                os.path.join(self.path, measure + '.npy'), mmap_mode='r')
+        return self._matrices[measure]
+
+    def zone_index(self, zone_ids):
+        """
+        Positional index of each external zone id, -1 where the zone is
+        not part of the store.
+        """
+        return self.zones.encode(zone_ids)
+
+    def lookup(self, orig, dest, measure):
+        """
+        Vectorized OD lookup.
+
+        Parameters
+        ----------
+        orig, dest : array-like
+            External origin and destination zone ids of equal length.
+        measure : str
+            Impedance measure to look up.
+
+        Returns
+        -------
+        numpy.ndarray
+            Float array, NaN where either zone is unknown or the OD pair
+            is missing from the skims.
+        """
+        return self.take(
+            self.zones.encode(orig), self.zones.encode(dest), measure)
+
+    def take(self, orig_codes, dest_codes, measure):
+        """
+        Vectorized OD lookup by zone codes of the store's zone system,
+        e.g. from ZoneSystem.recode, skipping the id lookups.
+
+        Returns
+        -------
+        numpy.ndarray
+            Float array, NaN where either code is -1 or the OD pair is
+            missing from the skims.
+        """
+        o = np.asarray(orig_codes)
+        d = np.asarray(dest_codes)
+        valid = (o >= 0) & (d >= 0)
+        out = np.full(len(o), np.nan)
+        out[valid] = self.matrix(measure)[o[valid], d[valid]]
+        return out
+
+    def to_frame(self, measures=None):
+        """
+        Long-format skims indexed by (from_zone_id, to_zone_id).
+        """
+        if measures is None:
+            measures = self.measures
+        n = len(self.zone_ids)
+        index = pd.MultiIndex.from_arrays(
+            [np.repeat(self.zone_ids, n), np.tile(self.zone_ids, n)],
+            names=['from_zone_id', 'to_zone_id'])
+        return pd.DataFrame(
+            {m: np.asarray(self.matrix(m)).ravel() for m in measures},
+            index=index, columns=measures)
+
+
+def load_skim_store(path, fingerprint, frame_func, **kwargs):
+    """
+    Open the skim store at `path` if it was built from the same source
+    data, otherwise (re)build it from the frame returned by `frame_func`.
+
+    Parameters
+    ----------
+    path : str
+        Directory of the store.
+    fingerprint : str
+        Identifier of the source data, e.g. from utils.file_fingerprint.
+    frame_func : callable
+        Returns the long-format skims. Only called on a cache miss.
+    **kwargs
+        Passed through to SkimStore.from_frame.
+
+    Returns
+    -------
+    SkimStore
+    """
+    if SkimStore.is_current(path, fingerprint):
+        return SkimStore.open(path)
+    print('Building skim store at {0}'.format(path))
+    return SkimStore.from_frame(
+        frame_func(), path, fingerprint=fingerprint, **kwargs)
+
+
+def compute_skim_accessibilities(skim_store, zone_values, specs):
+    """
+    Compute a batch of skim-based zonal accessibility variables.
+
+    Specs are grouped by (impedance, threshold) so that each threshold
+    mask is built once, as a sparse OD matrix, and multiplied against
+    every variable that shares it in a single product.
+
+    Parameters
+    ----------
+    skim_store : SkimStore
+    zone_values : pandas.DataFrame
+        Zonal variables to summarize, indexed by zone id.
+    specs : list of tuples
+        (column_name, variable, impedance, threshold, agg) where agg is
+        'sum' or 'mean' (or np.sum/np.mean). Destinations are reachable
+        if their impedance is strictly below the threshold.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One column per spec, indexed like `zone_values`. As with
+        misc.compute_range based variables, the origin zone's own value
+        is added to the result.
+    """
+    from scipy import sparse
+
+    aggs = {np.sum: 'sum', np.mean: 'mean', 'sum': 'sum', 'mean': 'mean'}
+
+    variables = sorted({spec[1] for spec in specs})
+    values = zone_values[variables].reindex(skim_store.zone_ids)
+    notnull = values.notnull().values.astype(float)
+    values = values.fillna(0).values.astype(float)
+    var_pos = {var: i for i, var in enumerate(variables)}
+
+    groups = {}
+    for spec in specs:
+        groups.setdefault((spec[2], spec[3]), []).append(spec)
+
+    results = pd.DataFrame(index=skim_store.zone_ids)
+    for (impedance, threshold), group in groups.items():
+        with np.errstate(invalid='ignore'):
+            reachable = sparse.csr_matrix(
+                np.asarray(skim_store.matrix(impedance)) < threshold,
+                dtype=float)
+        sums = reachable.dot(values)
+        counts = None
+        for name, variable, _, _, agg in group:
+            i = var_pos[variable]
+            if aggs[agg] == 'sum':
+                results[name] = sums[:, i]
+            else:
+                if counts is None:
+                    counts = reachable.dot(notnull)
+                with np.errstate(invalid='ignore', divide='ignore'):
+                    results[name] = np.where(
+                        counts[:, i] > 0, sums[:, i] / counts[:, i], 0)
+
+    results = results.reindex(zone_values.index).fillna(0)
+
+    # add vars from orig zone, typically not included in skims
+    for name, variable, _, _, _ in specs:
+        results[name] = results[name] + zone_values[variable]
+
+    return results[[spec[0] for spec in specs]]
@@ -1,8 +1,50 @@
 import orca
 import pandas as pd
 import numpy as np
+import ast
+import re
+import hashlib
+import os
+import textwrap
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import yaml
 from urbansim.utils import misc
 
+from activitysynth.scripts import joins, loaders, skims
+
+
+def file_fingerprint(*paths):
+    """
+    Cheap identifier of the state of one or more input files, built
+    from their paths, sizes and modification times.
+
+    Returns
+    -------
+    str or None
+        Hex digest, or None if any of the files is missing.
+    """
+    h = hashlib.sha1()
+    for path in paths:
+        if not os.path.exists(path):
+            return None
+        stat = os.stat(path)
+        h.update('{0}|{1}|{2};'.format(
+            os.path.abspath(path), stat.st_size,
+            stat.st_mtime).encode('utf-8'))
+    return h.hexdigest()
+
+
+def frame_fingerprint(df):
+    """
+    Content hash of a DataFrame, including its index and column names.
+    """
+    h = hashlib.sha1()
+    h.update(str(list(df.columns)).encode('utf-8'))
+    h.update(pd.util.hash_pandas_object(df, index=True).values.tobytes())
+    return h.hexdigest()
+
 
 def register_skim_access_variable(
         column_name, variable_to_summarize, impedance_measure,
@@ -49,13 +91,554 @@ def register_skim_access_variable(
     return
 
 
-def impute_missing_skims(mtc_skims, beam_skims_raw):
-    df = beam_skims_raw.to_frame()
+def register_skim_access_variables(
+        specs, skim_store_name='beam_skim_store',
+        batch_name='zone_skim_accessibilities'):
+    """
+    Register a batch of skim-based accessibility variables with orca.
 
-    # seconds to minutes
-    df['gen_tt'] = df['generalizedTimeInS'] / 60
+    All variables are computed together, in a single pass over the
+    dense skims, the first time any one of them is requested.
+
+    Parameters
+    ----------
+    specs : list of tuples
+        (column_name, variable_to_summarize, impedance_measure,
+        distance, agg) for each zones column to register. See
+        skims.compute_skim_accessibilities.
+    skim_store_name : str, optional
+        Name of the orca injectable holding the SkimStore to query.
+    batch_name : str, optional
+        Name of the orca injectable the batch results are cached as.
+
+    Returns
+    -------
+    None
+    """
+    @orca.injectable(batch_name, cache=True, cache_scope='iteration')
+    def batch_func(zones):
+        skim_store = orca.get_injectable(skim_store_name)
+        variables = sorted({spec[1] for spec in specs})
+        zone_values = zones.to_frame(columns=variables)
+        return skims.compute_skim_accessibilities(
+            skim_store, zone_values, specs)
+
+    for spec in specs:
+        _register_batch_column('zones', spec[0], batch_name)
+
+    return
+
+
+def register_zone_rollups(specs, batch_name='zone_rollups'):
+    """
+    Register a batch of zonal aggregations of the agent tables with orca.
+
+    All variables are computed together the first time any one of them
+    is requested. See joins.rollup for the specs.
+
+    Parameters
+    ----------
+    specs : list of tuples
+        (column_name, table_name, variable, agg, weights) for each zones
+        column to register.
+    batch_name : str, optional
+        Name of the orca injectable the batch results are cached as.
+
+    Returns
+    -------
+    None
+    """
+    @orca.injectable(batch_name, cache=True, cache_scope='iteration')
+    def batch_func(join_index):
+        return joins.rollup(join_index, 'zones', specs)
+
+    for spec in specs:
+        _register_batch_column('zones', spec[0], batch_name)
+
+    return
+
+
+def dummy_variables(values, spec):
+    """
+    Compute every dummy variable of one spec in a single vectorized pass.
+
+    Parameters
+    ----------
+    values : pandas.Series
+        Column the dummies are derived from.
+    spec : dict
+        Either 'categories', a dict of {dummy name: list of values}, or
+        'bins', a sorted list of bin edges, with 'names' holding one
+        dummy name (or None to skip the bin) per bin. Bins are closed
+        on the right if 'right' is True (the default) and on the left
+        otherwise. 'include_lowest' sets whether values equal to the
+        lowest edge fall in the first bin, and defaults to True for
+        bins closed on the left.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One uint8 column per dummy, indexed like `values`.
+    """
+    x = values.values
+    if 'categories' in spec:
+        names = list(spec['categories'])
+        categories = [
+            (value, i) for i, name in enumerate(names)
+            for value in spec['categories'][name]]
+        lookup = pd.Index([value for value, _ in categories])
+        dummy_pos = np.array([i for _, i in categories] + [-1])
+        codes = dummy_pos[lookup.get_indexer(x)]
+    else:
+        names = spec['names']
+        edges = np.asarray(spec['bins'], dtype=float)
+        right = spec.get('right', True)
+        include_lowest = spec.get('include_lowest', not right)
+        assert len(names) == len(edges) - 1, \
+            'Need one name per bin for {0}'.format(values.name)
+        x = x.astype(float)
+        codes = np.digitize(x, edges, right=right) - 1
+        if include_lowest == right:
+            codes[x == edges[0]] = 0 if include_lowest else -1
+        codes[(codes >= len(names)) | np.isnan(x)] = -1
+
+    block = np.zeros((len(x), len(names)), dtype=np.uint8)
+    rows = np.flatnonzero(codes >= 0)
+    block[rows, codes[rows]] = 1
+    keep = [i for i, name in enumerate(names) if name is not None]
+    return pd.DataFrame(
+        block[:, keep], index=values.index,
+        columns=[names[i] for i in keep])
+
+
+def register_dummy_variables(specs):
+    """
+    Register blocks of dummy variables with orca.
+
+    The dummies of every spec on a table are computed together, one
+    pass per source column, the first time any one of them is requested
+    in a step, and are held as uint8.
+
+    Parameters
+    ----------
+    specs : list of dicts
+        Each with the 'table' and 'column' to derive dummies from, and
+        the categories or bins described in dummy_variables.
+
+    Returns
+    -------
+    None
+    """
+    tables = {}
+    for spec in specs:
+        tables.setdefault(spec['table'], []).append(spec)
+
+    for table_name, table_specs in tables.items():
+        batch_name = '{0}_dummies'.format(table_name)
+        _register_dummy_batch(table_name, table_specs, batch_name)
+        for spec in table_specs:
+            names = spec['categories'] if 'categories' in spec \
+                else spec['names']
+            for name in filter(None, names):
+                _register_batch_column(
+                    table_name, name, batch_name, cache_scope='step')
+
+    return
+
+
+def _register_dummy_batch(table_name, specs, batch_name):
+    """
+    Register the injectable computing every dummy of a table at once.
+    """
+    @orca.injectable(batch_name, cache=True, cache_scope='step')
+    def batch_func():
+        table = orca.get_table(table_name)
+        return pd.concat([
+            dummy_variables(table.get_column(spec['column']), spec)
+            for spec in specs], axis=1)
+
+    return
+
+
+def _register_batch_column(table_name, column_name, batch_name,
+                           cache_scope='iteration'):
+    """
+    Register an orca column that is served from a batch injectable.
+    """
+    @orca.column(table_name, column_name, cache=True, cache_scope=cache_scope)
+    def column_func():
+        return orca.get_injectable(batch_name)[column_name]
+
+    return
+
+
+# names that can appear in model expressions and filters without being
+# columns
+_expression_keywords = {
+    'np', 'C', 'I', 'Q', 'and', 'or', 'not', 'in', 'is', 'True', 'False',
+    'None', 'nan', 'inf'}
+
+# step attributes that hold expressions or column names
+_step_expression_attrs = [
+    'model_expression', 'filters', 'out_filters', 'chooser_filters',
+    'out_chooser_filters', 'alt_filters', 'out_alt_filters']
+_step_column_attrs = [
+    'model_expression_keys', 'choice_column', 'alt_capacity',
+    'chooser_size']
+
+
+def expression_columns(expressions):
+    """
+    Column names referred to by model expressions or filter queries.
+
+    Identifiers that are function calls, attribute lookups, string
+    literals or python/patsy keywords are skipped, e.g.
+    'np.log1p(gen_tt_CAR):hh_inc_under_25k' gives gen_tt_CAR and
+    hh_inc_under_25k.
+
+    Parameters
+    ----------
+    expressions : str or list of str
+        Strings holding a list literal, as in some saved configs, are
+        parsed first.
+
+    Returns
+    -------
+    set of str
+    """
+    if expressions is None:
+        return set()
+    if isinstance(expressions, str):
+        if expressions.startswith('['):
+            expressions = ast.literal_eval(expressions)
+        else:
+            expressions = [expressions]
+
+    columns = set()
+    for expression in expressions:
+        expression = re.sub(r'\'[^\']*\'|"[^"]*"', '', str(expression))
+        for match in re.finditer(
+                r'(?<![\w.])([A-Za-z_]\w*)(?!\w)(\s*\()?', expression):
+            if match.group(2) is None and \
+                    match.group(1) not in _expression_keywords:
+                columns.add(match.group(1))
+    return columns
+
+
+def step_columns(step):
+    """
+    Columns a model step reads: everything referred to by its model
+    expression, model expression keys, filters and column settings.
+
+    Parameters
+    ----------
+    step : urbansim_templates model step
+
+    Returns
+    -------
+    set of str
+    """
+    columns = set()
+    for attr in _step_expression_attrs:
+        columns |= expression_columns(getattr(step, attr, None))
+    for attr in _step_column_attrs:
+        value = getattr(step, attr, None)
+        if isinstance(value, str) and value.startswith('['):
+            value = ast.literal_eval(value)
+        if isinstance(value, str):
+            columns.add(value)
+        elif value is not None:
+            columns |= set(value)
+    columns.discard('intercept')
+    return columns
+
+
+def available_columns(table_names, columns):
+    """
+    Subset of `columns` that is registered on any of the orca tables,
+    in a stable order, to pass on to to_frame or merge_tables.
+    """
+    registered = set()
+    for table_name in table_names:
+        registered |= set(orca.get_table(table_name).columns)
+    return sorted(set(columns) & registered)
+
+
+def _config_tables(step_name):
+    """
+    Tables named in a saved model step config.
+    """
+    path = misc.config('{0}.yaml'.format(step_name))
+    if not os.path.exists(path):
+        return set()
+    with open(path) as f:
+        cfg = yaml.safe_load(f)['saved_object']
+    tables = set()
+    for attr in ['tables', 'out_tables', 'choosers', 'out_choosers',
+                 'alternatives', 'out_alternatives']:
+        value = cfg.get(attr)
+        if isinstance(value, str):
+            tables.add(value)
+        elif value is not None:
+            tables |= set(value)
+    return tables
+
+
+def source_tables(step_names):
+    """
+    Input tables that a list of orca steps is expected to read.
+
+    Tables are found from the arguments of each step, which orca
+    evaluates before running it, the tables of the model step configs
+    it runs and, since computed columns reach up the geography
+    hierarchy, the ancestors of every agent table found. Tables a step
+    only gets from orca in some cases, e.g. raw skims to impute from
+    or network nodes and edges for networks not yet built, are left to
+    be loaded when they are used.
+
+    Parameters
+    ----------
+    step_names : list of str
+
+    Returns
+    -------
+    list of str
+        Names of tables that have a loader schema.
+    """
+    names = set()
+    for step_name in step_names:
+        source = textwrap.dedent(
+            orca.get_step(step_name).func_source_data()[2])
+        func = ast.parse(source).body[0]
+        names |= {arg.arg for arg in func.args.args}
+        for config_name in re.findall(
+                r'mm\.get_step\([\'"](\w+)[\'"]\)', source):
+            names |= _config_tables(config_name)
+
+    for name in list(names):
+        while name in joins.parent_keys:
+            name = joins.parent_keys[name][1]
+            names.add(name)
+
+    return sorted(names & set(loaders.table_schemas))
+
+
+def _load_table_in_worker(table_name):
+    return orca.get_table(table_name).local
+
+
+def _load_table_in_thread(table_name):
+    # getting a table runs its (cached) table function
+    orca.get_table(table_name)
+
+
+def prefetch_tables(table_names, processes=False, max_workers=None):
+    """
+    Load input tables concurrently so that the first steps of a run do
+    not wait on each table in turn.
 
-    mtc = mtc_skims.to_frame(columns=['orig', 'dest', 'da_distance_AM'])
+    With threads, the registered table functions are evaluated side by
+    side and cache their results in orca as usual, which suits parquet
+    reads that release the GIL. With processes, which suit csv parsing,
+    tables are loaded in forked workers and added to orca as loaded
+    tables. Tables that fail to load are left to be loaded, and raise,
+    when they are first used.
+
+    Parameters
+    ----------
+    table_names : list of str
+    processes : bool, optional
+        Load in worker processes rather than threads.
+    max_workers : int, optional
+        Defaults to one per table, up to the number of cores.
+
+    Returns
+    -------
+    None
+    """
+    table_names = [
+        name for name in table_names if orca.is_table(name) and
+        orca.table_type(name) == 'function']
+    if not table_names:
+        return
+    if max_workers is None:
+        max_workers = min(len(table_names), multiprocessing.cpu_count())
+
+    # evaluate the shared injectables once rather than in every worker
+    for name in ['input_file_format', 'input_data_dir', 'store',
+                 'input_fnames']:
+        if orca.is_injectable(name):
+            orca.get_injectable(name)
+
+    print('Prefetching {0} with {1} {2}'.format(
+        ', '.join(table_names), max_workers,
+        'processes' if processes else 'threads'))
+
+    if processes and 'fork' in multiprocessing.get_all_start_methods():
+        executor = ProcessPoolExecutor(
+            max_workers=max_workers,
+            mp_context=multiprocessing.get_context('fork'))
+        load = _load_table_in_worker
+    else:
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        load = _load_table_in_thread
+
+    with executor:
+        futures = [(name, executor.submit(load, name)) for name in table_names]
+        for name, future in futures:
+            try:
+                df = future.result()
+            except Exception as e:
+                print('Could not prefetch {0}: {1!r}'.format(name, e))
+                continue
+            if df is not None:
+                orca.add_table(name, df)
+
+
+def _run_step_in_worker(step_name, outputs, threads_per_worker):
+    """
+    Run one orca step in a forked worker process and return the tables
+    and columns it produced.
+    """
+    from threadpoolctl import threadpool_limits
+
+    if threads_per_worker:
+        # OpenMP/BLAS runtimes already loaded in the parent have read
+        # their environment before the fork, so they are capped through
+        # threadpoolctl. The environment covers any loaded afterwards.
+        for var in [
+                'OMP_NUM_THREADS', 'MKL_NUM_THREADS',
+                'OPENBLAS_NUM_THREADS']:
+            os.environ[var] = str(threads_per_worker)
+
+    with threadpool_limits(limits=threads_per_worker):
+        orca.run([step_name])
+
+    return {
+        table_name: orca.get_table(table_name).to_frame(columns=columns)
+        for table_name, columns in outputs.items()}
+
+
+def run_steps_in_parallel(
+        step_outputs, max_workers=None, threads_per_worker=None):
+    """
+    Run independent orca steps concurrently in worker processes and
+    merge what they produce back into orca in this process.
+
+    Workers are forked, so they start from a copy of the current orca
+    state. Steps must not depend on each other's outputs.
+
+    Parameters
+    ----------
+    step_outputs : dict
+        Maps each step name to a dict of {table_name: columns} it
+        produces. columns=None copies back the whole table (replacing
+        it), otherwise only the listed columns are added to the table.
+    max_workers : int, optional
+        Maximum number of worker processes. Defaults to one per step.
+    threads_per_worker : int, optional
+        Cap on the OpenMP/BLAS threads each worker may use, e.g. for
+        pandana's aggregations.
+
+    Returns
+    -------
+    None
+    """
+    steps = list(step_outputs)
+    if max_workers is None:
+        max_workers = len(steps)
+
+    if max_workers <= 1 or 'fork' not in \
+            multiprocessing.get_all_start_methods():
+        orca.run(steps)
+        return
+
+    with ProcessPoolExecutor(
+            max_workers=min(max_workers, len(steps)),
+            mp_context=multiprocessing.get_context('fork')) as executor:
+        futures = {
+            step_name: executor.submit(
+                _run_step_in_worker, step_name, step_outputs[step_name],
+                threads_per_worker)
+            for step_name in steps}
+
+        for step_name in steps:
+            results = futures[step_name].result()
+            for table_name, columns in step_outputs[step_name].items():
+                df = results[table_name]
+                if columns is None:
+                    orca.add_table(table_name, df)
+                else:
+                    for col in columns:
+                        orca.add_column(table_name, col, df[col])
+            print('Finished {0} in a worker process'.format(step_name))
+
+
+# raw BEAM skims column names and their names within activitysynth
+beam_skims_raw_columns = {
+    'generalizedCost': 'gen_cost', 'origTaz': 'from_zone_id',
+    'destTaz': 'to_zone_id'}
+
+# hours of the day making up each skims period. AM keeps the 7-9am
+# window the WLCM was estimated against.
+skim_periods = {
+    'EA': [3, 4, 5, 6],
+    'AM': [7, 8, 9],
+    'MD': [10, 11, 12, 13, 14],
+    'PM': [15, 16, 17, 18],
+    'EV': [19, 20, 21, 22, 23, 0, 1, 2]}
+
+# period of the skims the WLCM and the skim accessibilities were
+# estimated against, e.g. gen_tt_CAR_AM stands in for their gen_tt_CAR
+default_skim_period = 'AM'
+
+
+# columns of the MTC skims that skim imputation reads
+mtc_dist_columns = ['orig', 'dest', 'da_distance_AM']
+
+
+def period_skim_columns(columns, period, periods=skim_periods):
+    """
+    Skims columns of one period, and those without a period such as
+    dist, mapped to the names the models were estimated with, e.g.
+    gen_tt_CAR_AM to gen_tt_CAR. Period columns take precedence over
+    unsuffixed columns of the same name, as in SkimInteractionTerms.
+
+    Returns
+    -------
+    dict
+    """
+    suffix = '_' + period
+    period_suffixes = tuple('_' + p for p in periods)
+    names = set(columns)
+    return {
+        col: col[:-len(suffix)] if col.endswith(suffix) else col
+        for col in columns if col.endswith(suffix) or (
+            not col.endswith(period_suffixes) and col + suffix not in names)}
+
+
+def check_imputed_skims(columns, periods=skim_periods):
+    """
+    Make sure imputed skims have columns for every skims period. Skims
+    imputed before the periods were introduced only have unsuffixed
+    AM columns, e.g. gen_tt_CAR, which the models no longer read.
+    """
+    missing = [
+        period for period in periods
+        if not any(col.endswith('_' + period) for col in columns)]
+    if missing:
+        raise ValueError(
+            'Imputed skims have no columns for the {0} periods. They were '
+            'likely imputed by an earlier version, remove them so they are '
+            'imputed again from the raw skims.'.format(', '.join(missing)))
+
+
+def _mtc_dists(mtc_skims):
+    """
+    MTC zone-to-zone drive distances in meters, indexed by
+    (from_zone_id, to_zone_id).
+    """
+    mtc = mtc_skims.to_frame(columns=mtc_dist_columns)
     mtc.rename(
         columns={'orig': 'from_zone_id', 'dest': 'to_zone_id'},
         inplace=True)
@@ -63,6 +646,28 @@ def impute_missing_skims(mtc_skims, beam_skims_raw):
 
     # miles to meters
     mtc['dist'] = mtc['da_distance_AM'] * 1609.34
+    return mtc[['dist']]
+
+
+def _check_complete_od(n_od_pairs, dists):
+    """
+    Make sure the imputed skims cover every OD pair of the zone system.
+    """
+    zone_ids = np.union1d(
+        dists.index.get_level_values('from_zone_id').unique(),
+        dists.index.get_level_values('to_zone_id').unique())
+    assert n_od_pairs == len(zone_ids) ** 2, (
+        'Imputed skims have {0} OD pairs, expected {1} for {2} zones'.format(
+            n_od_pairs, len(zone_ids) ** 2, len(zone_ids)))
+
+
+def _prepare_raw_skims(df, mtc, periods):
+    """
+    Clean up a block of raw BEAM skims and label each record with its
+    skims period.
+    """
+    # seconds to minutes
+    df['gen_tt'] = df['generalizedTimeInS'] / 60
 
     # impute mtc zone-to-zone distances where zero-valued in beam skims
     if len(df.loc[df['distanceInM'] == 0, 'distanceInM']) > 0:
@@ -75,47 +680,298 @@ def impute_missing_skims(mtc_skims, beam_skims_raw):
     df.loc[intra_taz_mask, 'distanceInM'] = mtc.loc[pd.MultiIndex.from_frame(
         df.loc[intra_taz_mask, ['from_zone_id', 'to_zone_id']]), 'dist'].values
 
-
-    # create morning peak lookup
     df['gen_time_per_m'] = df['gen_tt'] / df['distanceInM']
     df['gen_cost_per_m'] = df['gen_cost'] / df['distanceInM']
-    df.loc[df['hour'].isin([7, 8, 9]), 'period'] = 'AM'
-    df_am = df[df['period'] == 'AM']
-    df_am = df_am.replace([np.inf, -np.inf], np.nan)
-    df_am = df_am.loc[df_am.index.repeat(df_am.numObservations)]  # weighted
-    am_lookup = df_am[[
-        'mode', 'gen_time_per_m', 'gen_cost_per_m']].dropna().groupby(
-            ['mode']).mean().reset_index()
-
-    # morning averages
-    df_am_avg = df_am[[
-        'from_zone_id', 'to_zone_id', 'mode', 'gen_tt',
-        'gen_cost']].groupby(
-        ['from_zone_id', 'to_zone_id', 'mode']).mean().reset_index()
-
-    # long to wide
-    df_am_pivot = df_am_avg.pivot_table(
-        index=['from_zone_id', 'to_zone_id'], columns='mode')
-    df_am_pivot.columns = ['_'.join(col) for col in df_am_pivot.columns.values]
+    hour_to_period = {
+        hour: period for period, hours in periods.items() for hour in hours}
+    df['period'] = df['hour'].map(hour_to_period)
+    df = df[df['period'].notnull()]
+    return df.replace([np.inf, -np.inf], np.nan)
+
+
+def _weighted_skim_sums(df):
+    """
+    Observation-weighted sums from which the weighted means used by the
+    imputation are derived. Sums, unlike means, can be accumulated
+    across chunks of the raw skims.
+
+    Returns
+    -------
+    od_sums : pandas.DataFrame
+        Indexed by (period, from_zone_id, to_zone_id, mode).
+    mode_sums : pandas.DataFrame
+        Indexed by (period, mode).
+    """
+    w = df['numObservations']
+
+    # per-meter rates by mode, over records where both rates are valid
+    valid = df[['mode', 'gen_time_per_m', 'gen_cost_per_m']].notnull().all(
+        axis=1)
+    mode_sums = pd.DataFrame({
+        'period': df.loc[valid, 'period'],
+        'mode': df.loc[valid, 'mode'],
+        'w': w[valid],
+        'gen_time_per_m': df.loc[valid, 'gen_time_per_m'] * w[valid],
+        'gen_cost_per_m': df.loc[valid, 'gen_cost_per_m'] * w[valid]}
+    ).groupby(['period', 'mode']).sum()
+
+    od = df[['period', 'from_zone_id', 'to_zone_id', 'mode']].copy()
+    for impedance in ['gen_tt', 'gen_cost']:
+        od[impedance] = (df[impedance] * w).fillna(0)
+        od[impedance + '_w'] = w.where(df[impedance].notnull(), 0)
+    od_sums = od.groupby(
+        ['period', 'from_zone_id', 'to_zone_id', 'mode']).sum()
+
+    return od_sums, mode_sums
+
+
+def _add_sums(acc, sums):
+    if acc is None:
+        return sums
+    return pd.concat([acc, sums]).groupby(
+        level=list(range(sums.index.nlevels))).sum()
+
+
+def _imputed_columns(od_sums, mode_sums, periods):
+    """
+    Column names of the imputed skims, in output order.
+    """
+    modes = sorted(
+        set(od_sums.index.get_level_values('mode')) |
+        set(mode_sums.index.get_level_values('mode')))
+    columns = ['dist']
+    for impedance in ['gen_cost', 'gen_tt']:
+        columns += [
+            '{0}_{1}_{2}'.format(impedance, mode, period)
+            for mode in modes for period in periods]
+    return columns
+
+
+def _impute_from_sums(dists, od_sums, mode_sums, periods, columns=None):
+    """
+    Weighted mean impedances by OD pair, mode and period, in wide
+    format, with missing OD pairs imputed from the mean per-meter rates
+    of each mode in that period (or across all periods if the mode was
+    not observed in the period at all).
+
+    Parameters
+    ----------
+    dists : pandas.DataFrame
+        'dist' column indexed by (from_zone_id, to_zone_id). Defines
+        the OD pairs of the output.
+    od_sums, mode_sums : pandas.DataFrame
+        As returned by _weighted_skim_sums.
+    periods : dict
+        Skims periods, as in skim_periods.
+    columns : list of str, optional
+        Output columns, as returned by _imputed_columns.
+    """
+    rate_cols = ['gen_time_per_m', 'gen_cost_per_m']
+    lookup = mode_sums[rate_cols].div(mode_sums['w'], axis=0)
+    all_periods = mode_sums.groupby(level='mode').sum()
+    all_periods_lookup = all_periods[rate_cols].div(all_periods['w'], axis=0)
+
+    # weighted means, long to wide
+    od_means = pd.DataFrame({
+        impedance: od_sums[impedance] / od_sums[impedance + '_w']
+        for impedance in ['gen_tt', 'gen_cost']})
+    od_pivot = od_means.unstack(['period', 'mode'])
+    od_pivot.columns = [
+        '{0}_{1}_{2}'.format(impedance, mode, period)
+        for impedance, period, mode in od_pivot.columns.values]
 
     # combine with mtc-based dists
     merged = pd.merge(
-        mtc[['dist']], df_am_pivot, left_index=True, right_index=True,
-        how='left')
+        dists, od_pivot, left_index=True, right_index=True, how='left')
 
     # impute
-    for mode in am_lookup['mode'].values:
-        for impedance in ['gen_tt', 'gen_cost']:
-            if impedance == 'gen_tt':
-                lookup_col = 'gen_time_per_m'
-            elif impedance == 'gen_cost':
-                lookup_col = 'gen_cost_per_m'
-            colname = impedance + '_' + mode
-            lookup_val = am_lookup.loc[
-                am_lookup['mode'] == mode, lookup_col].values[0]
-            merged.loc[pd.isnull(merged[colname]), colname] = merged.loc[
-                pd.isnull(merged[colname]), 'dist'] * lookup_val
-
-    assert len(merged) == 2114116
+    for mode in all_periods_lookup.index.values:
+        for period in periods:
+            if (period, mode) in lookup.index:
+                rates = lookup.loc[(period, mode)]
+            else:
+                rates = all_periods_lookup.loc[mode]
+            for impedance, lookup_col in [
+                    ('gen_tt', 'gen_time_per_m'),
+                    ('gen_cost', 'gen_cost_per_m')]:
+                colname = '{0}_{1}_{2}'.format(impedance, mode, period)
+                if colname not in merged.columns:
+                    merged[colname] = np.nan
+                missing = pd.isnull(merged[colname])
+                merged.loc[missing, colname] = merged.loc[
+                    missing, 'dist'] * rates[lookup_col]
+
+    if columns is None:
+        columns = _imputed_columns(od_sums, mode_sums, periods)
+
+    return merged.reindex(columns=columns)
+
+
+def impute_missing_skims(mtc_skims, beam_skims_raw, periods=skim_periods):
+    """
+    Build BEAM skims for every MTC OD pair and skims period, using
+    observation-weighted means of the raw skims where available and
+    mode-specific per-meter rates times MTC distances elsewhere. All
+    periods are imputed in the same grouped pass over the raw skims.
+
+    Parameters
+    ----------
+    mtc_skims : orca.DataFrameWrapper
+    beam_skims_raw : orca.DataFrameWrapper
+    periods : dict, optional
+        Hours of the day making up each period.
+
+    Returns
+    -------
+    pandas.DataFrame
+        Indexed by (from_zone_id, to_zone_id), with columns
+        {impedance}_{mode}_{period} for gen_tt and gen_cost.
+    """
+    mtc = _mtc_dists(mtc_skims)
+    df = _prepare_raw_skims(beam_skims_raw.to_frame(), mtc, periods)
+    od_sums, mode_sums = _weighted_skim_sums(df)
+    merged = _impute_from_sums(mtc, od_sums, mode_sums, periods)
+
+    _check_complete_od(len(merged), mtc)
 
     return merged
+
+
+# file formats that skims can be streamed from and to
+streaming_skim_formats = ['csv', 'parquet', 'feather']
+
+
+def _skims_file_format(path):
+    """
+    Format of a skims file to stream, from its extension.
+    """
+    file_format = os.path.splitext(path)[1].lstrip('.')
+    if file_format not in streaming_skim_formats:
+        raise ValueError(
+            'Cannot stream skims from or to {0}, expected one of {1}'.format(
+                path, ', '.join(streaming_skim_formats)))
+    return file_format
+
+
+def _read_in_chunks(path, chunksize, columns):
+    """
+    Iterate over a .csv, .parquet or .feather file as DataFrames of at
+    most `chunksize` rows. Parquet files are read one batch at a time
+    and feather files are memory-mapped.
+    """
+    file_format = _skims_file_format(path)
+    if file_format == 'parquet':
+        import pyarrow.parquet as pq
+        pf = pq.ParquetFile(path)
+        for batch in pf.iter_batches(batch_size=chunksize, columns=columns):
+            yield batch.to_pandas()
+    elif file_format == 'feather':
+        import pyarrow.feather as feather
+        table = feather.read_table(path, columns=columns, memory_map=True)
+        for batch in table.to_batches(max_chunksize=chunksize):
+            yield batch.to_pandas()
+    else:
+        for chunk in pd.read_csv(path, chunksize=chunksize, usecols=columns):
+            yield chunk
+
+
+def impute_missing_skims_streaming(
+        mtc_skims, raw_path, out_path, chunksize=1000000,
+        origins_per_block=100, periods=skim_periods):
+    """
+    Same as impute_missing_skims, but the raw skims are read from disk
+    in chunks and reduced to running observation-weighted sums, and the
+    imputed skims are written to `out_path` a block of origin zones at
+    a time. Peak memory is bounded by the chunk size and the number of
+    observed (period, OD pair, mode) combinations rather than by the
+    raw file.
+
+    Parameters
+    ----------
+    mtc_skims : orca.DataFrameWrapper
+    raw_path : str
+        Path to the raw BEAM skims, .csv, .parquet or .feather.
+    out_path : str
+        Path to write the imputed skims to, .csv, .parquet or .feather.
+    chunksize : int, optional
+        Number of raw skims records to process at a time.
+    origins_per_block : int, optional
+        Number of origin zones to write at a time.
+    periods : dict, optional
+        Hours of the day making up each period.
+
+    Returns
+    -------
+    int
+        Number of OD pairs written.
+    """
+    out_format = _skims_file_format(out_path)
+    mtc = _mtc_dists(mtc_skims)
+    raw_columns = [
+        'origTaz', 'destTaz', 'hour', 'mode', 'generalizedTimeInS',
+        'generalizedCost', 'distanceInM', 'numObservations']
+
+    od_sums = None
+    mode_sums = None
+    n_read = 0
+    for chunk in _read_in_chunks(raw_path, chunksize, raw_columns):
+        n_read += len(chunk)
+        chunk.rename(columns=beam_skims_raw_columns, inplace=True)
+        chunk_od, chunk_mode = _weighted_skim_sums(
+            _prepare_raw_skims(chunk, mtc, periods))
+        od_sums = _add_sums(od_sums, chunk_od)
+        mode_sums = _add_sums(mode_sums, chunk_mode)
+        print('Processed {0} raw skims records'.format(n_read))
+
+    # fix the output columns up front so that every block matches
+    columns = _imputed_columns(od_sums, mode_sums, periods)
+
+    # write to a temporary file, so that an interrupted or incomplete
+    # run never leaves imputed skims behind to be loaded as valid ones
+    tmp_path = out_path + '.tmp'
+    origins = mtc.index.get_level_values('from_zone_id').unique().values
+    od_origins = od_sums.index.get_level_values('from_zone_id')
+    writer = None
+    n_written = 0
+    try:
+        for start in range(0, len(origins), origins_per_block):
+            block_origins = origins[start:start + origins_per_block]
+            block = _impute_from_sums(
+                mtc[mtc.index.get_level_values('from_zone_id').isin(
+                    block_origins)],
+                od_sums[od_origins.isin(block_origins)], mode_sums,
+                periods, columns)
+
+            if out_format in ['parquet', 'feather']:
+                import pyarrow as pa
+                import pyarrow.parquet as pq
+                table = pa.Table.from_pandas(
+                    block.reset_index(), preserve_index=False)
+                if writer is None:
+                    # feather files are Arrow IPC files, written
+                    # uncompressed so that they can be memory-mapped
+                    writer = pq.ParquetWriter(tmp_path, table.schema) \
+                        if out_format == 'parquet' else \
+                        pa.ipc.new_file(tmp_path, table.schema)
+                writer.write_table(table)
+            else:
+                block.to_csv(
+                    tmp_path, mode='w' if start == 0 else 'a',
+                    header=start == 0)
+            n_written += len(block)
+
+        if writer is not None:
+            writer.close()
+            writer = None
+
+        _check_complete_od(n_written, mtc)
+    except BaseException:
+        if writer is not None:
+            writer.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    os.replace(tmp_path, out_path)
+
+    return n_written
@@ -1,9 +1,13 @@
+import os
+
 import orca
 from urbansim.utils import misc
 
 import pandas as pd
 import numpy as np
 
+from activitysynth.scripts import cache, utils
+
 
 #########################
 #    ZONES VARIABLES    #
@@ -12,41 +16,18 @@ import numpy as np
 # these are primarily used for calculating skim-based
 # acccessibilities
 
-@orca.column('zones', cache=True)
-def total_jobs(jobs, zones):
-    return jobs.zone_id_work.groupby(
-        jobs.zone_id_work).count().reindex(zones.index).fillna(0)
-
-
-@orca.column('zones', cache=True)
-def sum_residential_units(parcels, buildings, zones):
-    s = buildings.residential_units.groupby(
-        buildings.parcel_id).sum().groupby(parcels.zone_id).sum()
-    return s.reindex(zones.index).fillna(0)
-
-
-@orca.column('zones', cache=True)
-def sum_persons(households, buildings, parcels, zones):
-    s = households.persons.groupby(
-        households.building_id).sum().groupby(
-        buildings.parcel_id).sum().groupby(parcels.zone_id).sum()
-    return s.reindex(zones.index).fillna(0)
-
+# (column_name, table_name, variable, agg, weights) for each zonal
+# aggregation of the agent tables. all of them are computed in one pass
+# the first time any one of them is requested, see joins.rollup
+zone_rollup_specs = [
+    ('total_jobs', 'jobs', None, 'count', None),
+    ('sum_residential_units', 'buildings', 'residential_units', 'sum', None),
+    ('sum_persons', 'households', 'persons', 'sum', None),
+    ('sum_income', 'households', 'income', 'sum', None),
+    ('avg_income', 'households', 'income', 'mean', None),
+]
 
-@orca.column('zones', cache=True)
-def sum_income(households, buildings, parcels, zones):
-    s = households.income.groupby(
-        households.building_id).sum().groupby(
-        buildings.parcel_id).sum().groupby(parcels.zone_id).sum()
-    return s.reindex(zones.index).fillna(0)
-
-
-@orca.column('zones', cache=True)
-def avg_income(households, buildings, parcels, zones):
-    s = households.income.groupby(
-        households.building_id).mean().groupby(
-        buildings.parcel_id).mean().groupby(parcels.zone_id).mean()
-    return s.reindex(zones.index).fillna(0)
+utils.register_zone_rollups(zone_rollup_specs)
 
 
 ############################
@@ -54,82 +35,108 @@ def avg_income(households, buildings, parcels, zones):
 ############################
 
 
-@orca.column('parcels')
-def node_id_small(parcels, netsmall):
-    idssmall_parcel = netsmall.get_node_ids(parcels.x, parcels.y)
+# nearest nodes are cached on disk by network and coordinates, and in
+# memory for the rest of the run. the network is only built on a cache
+# miss. agent tables take the parcel values through the positional join
+# paths of the join_index injectable.
+
+@orca.column('parcels', cache=True)
+def node_id_small(parcels, netsmall_fingerprint, cache_dir):
+    idssmall_parcel = cache.load_node_ids(
+        os.path.join(cache_dir, 'node_ids'), netsmall_fingerprint,
+        lambda: orca.get_injectable('netsmall'), parcels.x,
+        parcels.y)
     return idssmall_parcel
 
 
-@orca.column('rentals')
-def node_id_small(rentals, netsmall):
-    idssmall_rentals = netsmall.get_node_ids(
-        rentals.longitude, rentals.latitude)
+@orca.column('rentals', cache=True)
+def node_id_small(rentals, netsmall_fingerprint, cache_dir):
+    idssmall_rentals = cache.load_node_ids(
+        os.path.join(cache_dir, 'node_ids'), netsmall_fingerprint,
+        lambda: orca.get_injectable('netsmall'), rentals.longitude,
+        rentals.latitude)
     return idssmall_rentals
 
 
 @orca.column('buildings')
-def node_id_small(parcels, buildings):
-    return misc.reindex(parcels.node_id_small, buildings.parcel_id)
+def node_id_small(parcels, join_index):
+    return join_index.broadcast(
+        parcels.node_id_small, 'buildings', 'parcels')
 
 
 @orca.column('units')
-def node_id_small(buildings, units):
-    return misc.reindex(buildings.node_id_small, units.building_id)
+def node_id_small(parcels, join_index):
+    return join_index.broadcast(
+        parcels.node_id_small, 'units', 'parcels')
 
 
 @orca.column('households')
-def node_id_small(units, households):
-    return misc.reindex(units.node_id_small, households.unit_id)
+def node_id_small(parcels, join_index):
+    return join_index.broadcast(
+        parcels.node_id_small, 'households', 'parcels')
 
 
 @orca.column('persons')
-def node_id_small(households, persons):
-    return misc.reindex(households.node_id_small, persons.household_id)
+def node_id_small(parcels, join_index):
+    return join_index.broadcast(
+        parcels.node_id_small, 'persons', 'parcels')
 
 
 @orca.column('jobs')
-def node_id_small(buildings, jobs):
-    return misc.reindex(buildings.node_id_small, jobs.building_id)
+def node_id_small(parcels, join_index):
+    return join_index.broadcast(
+        parcels.node_id_small, 'jobs', 'parcels')
 
 
 ###########################
 #    walk network vars    #
 ###########################
-@orca.column('parcels')
-def node_id_walk(parcels, netwalk):
-    idswalk_parcel = netwalk.get_node_ids(parcels.x, parcels.y)
+@orca.column('parcels', cache=True)
+def node_id_walk(parcels, netwalk_fingerprint, cache_dir):
+    idswalk_parcel = cache.load_node_ids(
+        os.path.join(cache_dir, 'node_ids'), netwalk_fingerprint,
+        lambda: orca.get_injectable('netwalk'), parcels.x,
+        parcels.y)
     return idswalk_parcel
 
 
-@orca.column('rentals')
-def node_id_walk(rentals, netwalk):
-    idswalk_rentals = netwalk.get_node_ids(rentals.longitude, rentals.latitude)
+@orca.column('rentals', cache=True)
+def node_id_walk(rentals, netwalk_fingerprint, cache_dir):
+    idswalk_rentals = cache.load_node_ids(
+        os.path.join(cache_dir, 'node_ids'), netwalk_fingerprint,
+        lambda: orca.get_injectable('netwalk'), rentals.longitude,
+        rentals.latitude)
     return idswalk_rentals
 
 
 @orca.column('buildings')
-def node_id_walk(parcels, buildings):
-    return misc.reindex(parcels.node_id_walk, buildings.parcel_id)
+def node_id_walk(parcels, join_index):
+    return join_index.broadcast(
+        parcels.node_id_walk, 'buildings', 'parcels')
 
 
 @orca.column('units')
-def node_id_walk(buildings, units):
-    return misc.reindex(buildings.node_id_walk, units.building_id)
+def node_id_walk(parcels, join_index):
+    return join_index.broadcast(
+        parcels.node_id_walk, 'units', 'parcels')
 
 
 @orca.column('households')
-def node_id_walk(units, households):
-    return misc.reindex(units.node_id_walk, households.unit_id)
+def node_id_walk(parcels, join_index):
+    return join_index.broadcast(
+        parcels.node_id_walk, 'households', 'parcels')
 
 
 @orca.column('persons')
-def node_id_walk(households, persons):
-    return misc.reindex(households.node_id_walk, persons.household_id)
+def node_id_walk(parcels, join_index):
+    return join_index.broadcast(
+        parcels.node_id_walk, 'persons', 'parcels')
 
 
 @orca.column('jobs')
-def node_id_walk(buildings, jobs):
-    return misc.reindex(buildings.node_id_walk, jobs.building_id)
+def node_id_walk(parcels, join_index):
+    return join_index.broadcast(
+        parcels.node_id_walk, 'jobs', 'parcels')
 
 
 ##########################
@@ -265,80 +272,53 @@ def avg_hhs_1500_walk (nodeswalk):
 #      WLCM dummy columns     #
 ###############################
 
-@orca.column('jobs')
-def sector_retail(jobs):
-    return jobs['sector_id'].isin([44, 45]).astype(int)
-
-
-@orca.column('jobs')
-def sector_healthcare(jobs):
-    return jobs['sector_id'].isin([62]).astype(int)
-
-
-@orca.column('jobs')
-def sector_tech(jobs):
-    return jobs['sector_id'].isin([51, 54]).astype(int)
-
-
-@orca.column('jobs')
-def sector_food_and_hosp(jobs):
-    return jobs['sector_id'].isin([72]).astype(int)
-
-
-@orca.column('jobs')
-def sector_mfg(jobs):
-    return jobs['sector_id'].isin([31, 32, 33]).astype(int)
-
-
-@orca.column('jobs')
-def sector_edu_serv(jobs):
-    return jobs['sector_id'].isin([61]).astype(int)
-
-
-@orca.column('jobs')
-def sector_oth_serv(jobs):
-    return jobs['sector_id'].isin([81]).astype(int)
-
-
-@orca.column('jobs')
-def sector_constr(jobs):
-    return jobs['sector_id'].isin([23]).astype(int)
-
-
-@orca.column('jobs')
-def sector_gov(jobs):
-    return jobs['sector_id'].isin([92]).astype(int)
-
-
-@orca.column('jobs')
-def sector_fire(jobs):
-    return jobs['sector_id'].isin([52, 53]).astype(int)
-
-
-@orca.column('jobs')
-def sector_whlsale(jobs):
-    return jobs['sector_id'].isin([42]).astype(int)
-
-
-@orca.column('jobs')
-def sector_admin(jobs):
-    return jobs['sector_id'].isin([56]).astype(int)
-
-
-@orca.column('jobs')
-def sector_transport(jobs):
-    return jobs['sector_id'].isin([48]).astype(int)
-
-
-@orca.column('jobs')
-def sector_arts(jobs):
-    return jobs['sector_id'].isin([71]).astype(int)
-
-
-@orca.column('jobs')
-def sector_util(jobs):
-    return jobs['sector_id'].isin([22]).astype(int)
-
+# dummy variables, declared per source column. the dummies of each
+# table are computed together in one vectorized pass and registered as
+# uint8 columns, see utils.register_dummy_variables
+dummy_specs = [
+    {'table': 'jobs', 'column': 'sector_id', 'categories': {
+        'sector_retail': [44, 45],
+        'sector_healthcare': [62],
+        'sector_tech': [51, 54],
+        'sector_food_and_hosp': [72],
+        'sector_mfg': [31, 32, 33],
+        'sector_edu_serv': [61],
+        'sector_oth_serv': [81],
+        'sector_constr': [23],
+        'sector_gov': [92],
+        'sector_fire': [52, 53],
+        'sector_whlsale': [42],
+        'sector_admin': [56],
+        'sector_transport': [48],
+        'sector_arts': [71],
+        'sector_util': [22]}},
+
+    # WLCM income dummies: (10, 25k) and [75k, 200k). hh_inc_25_to_75k
+    # has always been income >= 25k, which is what the WLCM coefficients
+    # were estimated with, so it gets a bin of its own
+    {'table': 'households', 'column': 'income',
+     'bins': [10, 25000, 75000, 200000], 'right': False,
+     'include_lowest': False,
+     'names': ['hh_inc_under_25k', None, 'hh_inc_75_to_200k']},
+    {'table': 'households', 'column': 'income',
+     'bins': [25000, np.inf], 'right': False,
+     'names': ['hh_inc_25_to_75k']},
+
+    # auto ownership income bins: [0, 20k], (20k, 40k], ..., (120k, inf)
+    {'table': 'households', 'column': 'income',
+     'bins': [0, 20000, 40000, 60000, 80000, 100000, 120000, np.inf],
+     'right': True, 'include_lowest': True,
+     'names': ['income_2', 'income_4', 'income_6', 'income_8', 'income_10',
+               'income_12', 'income_12p']},
+
+    # auto ownership tenure and building type dummies
+    {'table': 'households', 'column': 'tenure', 'categories': {
+        'tenure_1': [1], 'tenure_2': [2], 'tenure_3': [3], 'tenure_4': [4]}},
+    {'table': 'households', 'column': 'building_type', 'categories': {
+        'building_type_2': [2]}},
+]
+
+utils.register_dummy_variables(dummy_specs)
 
 # @orca.column('jobs')
 # def parcel_id(jobs, buildings):
@@ -356,43 +336,43 @@ def age_under_45(persons):
     return (persons['age'] < 45).astype(int)
 
 
-@orca.column('households')
-def hh_inc_under_25k(households):
-    return ((
-        households['income'] < 25000) & (
-        households['income'] > 10)).astype(int)
+# dense zone codes, see zones.ZoneSystem
+@orca.column('parcels')
+def zone_code(parcels, zone_system):
+    return pd.Series(
+        zone_system.encode(parcels.zone_id.values), index=parcels.index)
 
 
-@orca.column('households')
-def hh_inc_25_to_75k(households):
-    return ((
-        households['income'] >= 25000) & (
-        households['persons'] < 75000)).astype(int)
+def _parcel_zone_codes(parcels, join_index, table_name, via=None):
+    positions = join_index.positions(table_name, 'parcels', via)
+    # position -1 picks the missing code appended after the last parcel
+    return pd.Series(
+        np.append(parcels.zone_code.values, -1)[positions],
+        index=orca.get_table(table_name).index)
 
 
-@orca.column('households')
-def hh_inc_75_to_200k(households):
-    return ((
-        households['income'] >= 75000) & (
-        households['income'] < 200000)).astype(int)
+@orca.column('jobs')
+def zone_code_work(parcels, join_index):
+    return _parcel_zone_codes(parcels, join_index, 'jobs')
+
+
+@orca.column('persons')
+def zone_code_home(parcels, join_index):
+    return _parcel_zone_codes(parcels, join_index, 'persons')
 
 
 # cols for WLCM interaction terms
 @orca.column('jobs')
-def zone_id_work(jobs, buildings, parcels):
-    return misc.reindex(
-        orca.merge_tables(
-            buildings, [buildings, parcels], columns=['zone_id'])['zone_id'],
-        jobs.building_id).astype(float)
+def zone_id_work(jobs, zone_system):
+    return pd.Series(
+        zone_system.decode(jobs.zone_code_work.values), index=jobs.index)
 
 
 @orca.column('persons')
-def zone_id_home(persons, households, units, buildings, parcels):
-    return misc.reindex(
-        orca.merge_tables(
-            households, [households, units, buildings, parcels],
-            columns=['zone_id'])['zone_id'],
-        persons.household_id).astype(float)
+def zone_id_home(persons, zone_system):
+    return pd.Series(
+        zone_system.decode(persons.zone_code_home.values),
+        index=persons.index)
 
 
 #########################################
@@ -400,73 +380,11 @@ def zone_id_home(persons, households, units, buildings, parcels):
 #########################################
 
 
-# income bin dummies
-@orca.column('households')
-def income_2(households):
-    return ((households['income']>= 0) & (households['income']<= 20000)).astype(int)
-
-
-@orca.column('households')
-def income_4(households):
-    return ((households['income']> 20000) & (households['income']<= 40000)).astype(int)
-
-
-@orca.column('households')
-def income_6(households):
-    return ((households['income']> 40000) & (households['income']<= 60000)).astype(int)
-
-
-@orca.column('households')
-def income_8(households):
-    return ((households['income']> 60000) & (households['income']<= 80000)).astype(int)
-
-
-@orca.column('households')
-def income_10(households):
-    return ((households['income']> 80000) & (households['income']<= 100000)).astype(int)
-
-
-@orca.column('households')
-def income_12(households):
-    return ((households['income']> 100000) & (households['income']<= 120000)).astype(int)
-
-
-@orca.column('households')
-def income_12p(households):
-    return (households['income']> 120000).astype(int)
-
-
-# tenure type dummies
-@orca.column('households')
-def tenure_1(households):
-    return (households['tenure'] == 1).astype(int)
-
-
-@orca.column('households')
-def tenure_2(households):
-    return (households['tenure'] == 2).astype(int)
-
-
-@orca.column('households')
-def tenure_3(households):
-    return (households['tenure'] == 3).astype(int)
-
-
-@orca.column('households')
-def tenure_4(households):
-    return (households['tenure'] == 4).astype(int)
-
-
 @orca.column('households')
 def single_family_int(households):
     return households['single_family'].astype(int)
 
 
-@orca.column('households')
-def building_type_2(households):
-    return (households['building_type'] == 2).astype(int)
-
-
 # AM Peak Accessibility Vars
 
 @orca.column('parcels')
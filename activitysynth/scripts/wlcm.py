@@ -0,0 +1,382 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+import numpy as np
+from patsy import dmatrix, NAAction
+
+from urbansim.models.util import columns_in_formula
+from urbansim_templates.utils import get_data, to_list, update_column
+
+from activitysynth.scripts import assignment
+
+
+# state shared with the forked simulation workers, see simulate()
+_shared = {}
+
+
+class SkimInteractionTerms(object):
+    """
+    Interaction terms gathered straight from a SkimStore for sampled
+    (chooser, alternative) pairs, for use in place of a long-format
+    skims frame joined onto every choice table.
+
+    Choosers and alternatives are encoded into the store's zone codes
+    once per simulation, and each batch then gathers only the measures
+    the model expression uses, by array indexing into the store's
+    matrices.
+
+    Parameters
+    ----------
+    skim_store : skims.SkimStore
+    obs_col : str, optional
+        Chooser column holding the origin zone id.
+    alt_col : str, optional
+        Alternative column holding the destination zone id.
+    period : str, optional
+        Skims period to read, e.g. 'AM'. Model column gen_tt_CAR is then
+        gathered from measure gen_tt_CAR_AM. Columns without a measure
+        for the period, e.g. dist, are gathered as they are.
+    """
+
+    def __init__(self, skim_store, obs_col='zone_id_home',
+                 alt_col='zone_id_work', period=None):
+        self.skim_store = skim_store
+        self.obs_col = obs_col
+        self.alt_col = alt_col
+        self.suffix = '' if period is None else '_' + period
+
+    @property
+    def key_names(self):
+        return [self.obs_col, self.alt_col]
+
+    def encode(self, observations, alternatives):
+        """
+        Zone codes of the choosers and alternatives in the skim store.
+        """
+        zones = self.skim_store.zones
+        return (
+            zones.encode(observations[self.obs_col].values),
+            zones.encode(alternatives[self.alt_col].values))
+
+    def gather(self, orig_codes, dest_codes, columns):
+        """
+        Values of the measures among `columns` for each OD pair, NaN
+        where a zone or the pair is missing from the store.
+
+        Returns
+        -------
+        dict of numpy.ndarray
+        """
+        terms = {}
+        for col in columns:
+            for measure in [col + self.suffix, col]:
+                if measure in self.skim_store:
+                    terms[col] = self.skim_store.take(
+                        orig_codes, dest_codes, measure)
+                    break
+        return terms
+
+
+def _key_names(terms):
+    if isinstance(terms, SkimInteractionTerms):
+        return terms.key_names
+    return terms.index.names
+
+
+def step_data(m, interaction_terms=None, extra_columns=None):
+    """
+    Choosers and alternatives of a LargeMultinomialLogitStep, selected
+    the same way as LargeMultinomialLogitStep.run selects them.
+
+    Parameters
+    ----------
+    m : urbansim_templates.models.LargeMultinomialLogitStep
+    interaction_terms : list, optional
+        DataFrames or SkimInteractionTerms. The columns they are keyed
+        on are kept as extra columns.
+    extra_columns : list of str, optional
+        Other columns to keep from either table, if present.
+
+    Returns
+    -------
+    observations, alternatives : pandas.DataFrame
+    """
+    intx_cols = list({
+        name for terms in to_list(interaction_terms)
+        for name in _key_names(terms)}) + to_list(extra_columns)
+    obs_extra_cols = to_list(m.chooser_size) + intx_cols
+    alts_extra_cols = to_list(m.alt_capacity) + intx_cols
+
+    observations = get_data(
+        tables=m.out_choosers, fallback_tables=m.choosers,
+        filters=m.out_chooser_filters, model_expression=m.model_expression,
+        extra_columns=obs_extra_cols)
+    alternatives = get_data(
+        tables=m.out_alternatives, fallback_tables=m.alternatives,
+        filters=m.out_alt_filters, model_expression=m.model_expression,
+        extra_columns=alts_extra_cols)
+
+    # drop the filter columns, which may overlap between the two tables
+    expr_cols = columns_in_formula(m.model_expression)
+    observations = observations[[
+        col for col in observations.columns
+        if col in set(expr_cols + obs_extra_cols)]]
+    alternatives = alternatives[[
+        col for col in alternatives.columns
+        if col in set(expr_cols + alts_extra_cols)]]
+    return observations, alternatives
+
+
+def _choice_table(observations, alternatives, chooser_pos, alt_pos,
+                  interaction_terms, term_codes, columns):
+    """
+    Long-format table of each chooser and its sampled alternatives,
+    built by position rather than by merging on ids.
+    """
+    k = alt_pos.shape[1]
+    obs_rows = np.repeat(chooser_pos, k)
+    alt_rows = alt_pos.ravel()
+    df = pd.concat([
+        observations.iloc[obs_rows].reset_index(drop=True),
+        alternatives.iloc[alt_rows].reset_index(drop=True)], axis=1)
+    for terms, codes in zip(to_list(interaction_terms), term_codes):
+        if codes is None:
+            df = df.join(terms, on=list(terms.index.names))
+        else:
+            for col, values in terms.gather(
+                    codes[0][obs_rows], codes[1][alt_rows],
+                    columns).items():
+                df[col] = values
+    return df
+
+
+def _batch_choice_sets(chooser_pos, seed):
+    """
+    Sample alternatives for a batch of choosers and compute their choice
+    probabilities.
+
+    Returns
+    -------
+    alt_pos : numpy.ndarray
+        (n, k) positions in the alternatives table of the sampled
+        alternatives.
+    probs : numpy.ndarray
+        (n, k) choice probabilities.
+    """
+    rng = np.random.default_rng(seed)
+    available = _shared['available']
+    n = len(chooser_pos)
+    k = min(_shared['sample_size'], len(available))
+
+    sampler = _shared['sampler']
+    if sampler is None:
+        # uniform sampling with replacement, as in MergedChoiceTable
+        alt_pos = available[rng.integers(0, len(available), size=(n, k))]
+    else:
+        k = _shared['sample_size']
+        alt_pos, log_weights = sampler.sample(chooser_pos, k, rng)
+    df = _choice_table(
+        _shared['observations'], _shared['alternatives'], chooser_pos,
+        alt_pos, _shared['interaction_terms'], _shared['term_codes'],
+        _shared['expression_columns'])
+
+    # keep rows with missing values, which get no probability, so that
+    # every chooser keeps k rows
+    dm = dmatrix(
+        _shared['model_expression'], data=df,
+        NA_action=NAAction(NA_types=[]))
+    u = np.dot(np.asarray(dm), _shared['fitted_parameters']).reshape(n, k)
+    if sampler is not None:
+        # sampling correction, which keeps the choice probabilities of
+        # the full choice set
+        u -= log_weights
+    u[np.isnan(u)] = -np.inf
+    with np.errstate(invalid='ignore'):
+        probs = np.nan_to_num(np.exp(u - u.max(axis=1, keepdims=True)))
+    # choosers without any valid alternative pick one uniformly
+    probs[probs.sum(axis=1) == 0] = 1
+    probs /= probs.sum(axis=1, keepdims=True)
+    return alt_pos, probs
+
+
+def _assign_batches(m, batches, batch_seeds, results, choices, sizes,
+                    remaining, max_rounds, iteration):
+    """
+    Draw the choices of each batch from its choice sets, in batch
+    order, and report the assignment conflicts of the iteration.
+    """
+    conflicts = []
+    for batch, seed, (alt_pos, probs) in zip(batches, batch_seeds, results):
+        rng = np.random.default_rng(seed.spawn(1)[0])
+        if not m.constrained_choices:
+            choices[batch] = alt_pos[
+                np.arange(len(batch)), assignment.draw(probs, rng)]
+            continue
+
+        chosen, batch_conflicts = assignment.assign(
+            alt_pos, probs, sizes[batch], remaining, rng, max_rounds)
+        choices[batch] = chosen
+        for i, n in enumerate(batch_conflicts):
+            if i == len(conflicts):
+                conflicts.append(0)
+            conflicts[i] += n
+
+    if m.constrained_choices:
+        print('Iteration {0}: {1} of {2} valid choices, conflicts per '
+              'round: {3}'.format(
+                  iteration, (choices >= 0).sum(), len(choices),
+                  ', '.join(str(n) for n in conflicts)))
+
+
+def simulate(m, interaction_terms=None, chooser_batch_size=None,
+             workers=None, seed=None, sampler=None, sample_size=None,
+             max_rounds=1):
+    """
+    Simulate the choices of a LargeMultinomialLogitStep with chooser
+    batches run side by side in worker processes, and update the step's
+    out column with them.
+
+    Workers are forked, so the choosers, alternatives and interaction
+    terms are shared with them read-only rather than pickled. Each
+    worker samples alternatives for its batch and computes their choice
+    probabilities. Choices are drawn in this process, batch by batch as
+    the workers finish them. With constrained choices, each batch goes
+    through assignment.assign, in a random chooser priority order, and
+    choosers whose sampled alternatives all fill up sample new ones
+    among the alternatives with capacity left in the next iteration, as
+    in choicemodels' iterative lottery.
+
+    Every batch has its own random stream, derived from `seed`, so the
+    choices do not depend on the number of workers.
+
+    Parameters
+    ----------
+    m : urbansim_templates.models.LargeMultinomialLogitStep
+    interaction_terms : list, optional
+        DataFrames as in LargeMultinomialLogitStep.run, or
+        SkimInteractionTerms.
+    chooser_batch_size : int, optional
+        Choosers per batch. Defaults to splitting the choosers evenly
+        across the workers.
+    workers : int, optional
+        Number of worker processes. Defaults to the number of cores.
+    seed : int, optional
+    sampler : sampling.ZoneImportanceSampler, optional
+        Samples alternatives by importance instead of uniformly.
+    sample_size : int, optional
+        Alternatives sampled per chooser, instead of the step's
+        alt_sample_size, e.g. a smaller one with a sampler.
+    max_rounds : int, optional
+        Maximum number of assignment rounds per batch and iteration.
+        With more than one round, choosers that lose a conflict draw
+        again among the rest of their sampled alternatives before
+        sampling new ones. That settles in fewer iterations, but the
+        later draws come from smaller choice sets, so the default
+        matches the iterative lottery, where they sample anew.
+
+    Returns
+    -------
+    pandas.Series
+        Chosen alternative id of each chooser that could be placed.
+    """
+    observations, alternatives = step_data(
+        m, interaction_terms,
+        extra_columns=None if sampler is None else sampler.key_names)
+    if len(observations) == 0 or len(alternatives) == 0:
+        print('No valid choosers or alternatives')
+        return
+
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if chooser_batch_size is None:
+        chooser_batch_size = -(-len(observations) // workers)
+
+    if m.chooser_size is None:
+        sizes = np.ones(len(observations))
+    else:
+        sizes = observations[m.chooser_size].values.astype(float)
+    if m.alt_capacity is None:
+        remaining = np.ones(len(alternatives))
+    else:
+        remaining = alternatives[m.alt_capacity].values.astype(float)
+
+    _shared.update({
+        'observations': observations, 'alternatives': alternatives,
+        'interaction_terms': interaction_terms,
+        'term_codes': [
+            terms.encode(observations, alternatives)
+            if isinstance(terms, SkimInteractionTerms) else None
+            for terms in to_list(interaction_terms)],
+        'expression_columns': columns_in_formula(m.model_expression),
+        'model_expression': m.model_expression,
+        'fitted_parameters': np.asarray(m.fitted_parameters),
+        'sampler': sampler,
+        'sample_size': sample_size or m.alt_sample_size or len(alternatives)})
+    if sampler is not None:
+        sampler.prepare(observations, alternatives)
+
+    rng = np.random.default_rng(seed)
+    seeds = np.random.SeedSequence(seed)
+    choices = np.full(len(observations), -1)
+    unplaced = np.arange(len(observations))
+    iteration = 0
+
+    while len(unplaced):
+        iteration += 1
+        if m.max_iter is not None and iteration > m.max_iter:
+            break
+        available = np.flatnonzero(remaining >= sizes[unplaced].min())
+        if m.constrained_choices and len(available) == 0:
+            print('{0} choosers cannot be allocated'.format(len(unplaced)))
+            break
+        if not m.constrained_choices:
+            available = np.arange(len(alternatives))
+        _shared['available'] = available
+        if sampler is not None:
+            sampler.fit(available)
+
+        # random chooser priority, which batch order preserves
+        unplaced = rng.permutation(unplaced)
+        batches = [
+            unplaced[i:i + chooser_batch_size]
+            for i in range(0, len(unplaced), chooser_batch_size)]
+        batch_seeds = seeds.spawn(len(batches))
+
+        if workers <= 1 or len(batches) == 1 or \
+                'fork' not in multiprocessing.get_all_start_methods():
+            results = map(_batch_choice_sets, batches, batch_seeds)
+            _assign_batches(
+                m, batches, batch_seeds, results, choices, sizes, remaining,
+                max_rounds, iteration)
+        else:
+            with ProcessPoolExecutor(
+                    max_workers=min(workers, len(batches)),
+                    mp_context=multiprocessing.get_context('fork')
+                    ) as executor:
+                results = executor.map(
+                    _batch_choice_sets, batches, batch_seeds)
+                _assign_batches(
+                    m, batches, batch_seeds, results, choices, sizes,
+                    remaining, max_rounds, iteration)
+
+        if not m.constrained_choices:
+            break
+        n_unplaced = len(unplaced)
+        unplaced = np.sort(unplaced[choices[unplaced] < 0])
+        if len(unplaced) == n_unplaced:
+            print('{0} choosers cannot be allocated'.format(len(unplaced)))
+            break
+
+    _shared.clear()
+
+    placed = choices >= 0
+    choices = pd.Series(
+        alternatives.index.values[choices[placed]],
+        index=observations.index[placed], name=alternatives.index.name)
+    choices.index.name = observations.index.name
+
+    update_column(
+        table=m.out_choosers, fallback_table=m.choosers,
+        column=m.out_column, fallback_column=m.choice_column, data=choices)
+    return choices
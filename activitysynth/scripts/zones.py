@@ -0,0 +1,136 @@
+import pandas as pd
+import numpy as np
+
+
+class ZoneSystem(object):
+    """
+    Mapping between external zone ids (e.g. TAZ numbers) and dense
+    int32 zone codes 0..N-1.
+
+    Zone-level arrays such as skim matrices or zonal attributes are laid
+    out in code order, so that once agents carry zone codes every skim
+    lookup, zonal broadcast or OD join is plain array indexing rather
+    than a hash join on ids that may have been cast to float along the
+    way. Code -1 stands for a missing or unknown zone throughout.
+
+    Parameters
+    ----------
+    zone_ids : array-like
+        External zone ids. Duplicates are dropped and codes follow the
+        sorted order of the ids.
+    """
+
+    def __init__(self, zone_ids):
+        zone_ids = np.asarray(zone_ids)
+        if zone_ids.dtype.kind == 'f':
+            zone_ids = zone_ids[~np.isnan(zone_ids)].astype(np.int64)
+        self.zone_ids = np.unique(zone_ids)
+
+        # direct lookup table for the usual small non-negative zone ids
+        self._lut = None
+        if len(self.zone_ids) and self.zone_ids.dtype.kind in 'iu' and \
+                self.zone_ids[0] >= 0 and \
+                self.zone_ids[-1] < max(10 * len(self.zone_ids), 100000):
+            self._lut = np.full(self.zone_ids[-1] + 1, -1, dtype=np.int32)
+            self._lut[self.zone_ids] = np.arange(
+                len(self.zone_ids), dtype=np.int32)
+
+    def __len__(self):
+        return len(self.zone_ids)
+
+    def equals(self, other):
+        return np.array_equal(self.zone_ids, other.zone_ids)
+
+    def encode(self, zone_ids):
+        """
+        Zone code of each external zone id.
+
+        Parameters
+        ----------
+        zone_ids : array-like
+            Integer or float ids. NaN ids are treated as missing.
+
+        Returns
+        -------
+        numpy.ndarray
+            int32 codes, -1 where the id is missing or not part of the
+            zone system.
+        """
+        zone_ids = np.asarray(zone_ids)
+        if len(self) == 0:
+            return np.full(len(zone_ids), -1, dtype=np.int32)
+
+        valid = np.ones(len(zone_ids), dtype=bool)
+        if zone_ids.dtype.kind == 'f':
+            valid = ~np.isnan(zone_ids)
+            ids = np.where(valid, zone_ids, -1)
+            valid &= ids == np.round(ids)
+            ids = ids.astype(np.int64)
+        else:
+            ids = zone_ids.astype(np.int64, copy=False)
+
+        if self._lut is not None:
+            valid &= (ids >= 0) & (ids < len(self._lut))
+            return np.where(
+                valid, self._lut[np.where(valid, ids, 0)], -1).astype(
+                    np.int32)
+
+        codes = np.searchsorted(self.zone_ids, ids)
+        codes[codes == len(self.zone_ids)] = 0
+        valid &= self.zone_ids[codes] == ids
+        return np.where(valid, codes, -1).astype(np.int32)
+
+    def decode(self, codes):
+        """
+        External zone id of each zone code, as floats with NaN for -1
+        like misc.reindex would give.
+        """
+        return self.take(self.zone_ids.astype(float), codes)
+
+    def take(self, values, codes, fill_value=np.nan):
+        """
+        Broadcast a zone-level array to agents by their zone codes.
+
+        Parameters
+        ----------
+        values : array-like or pandas.Series
+            One value per zone in code order. A Series indexed by
+            external zone id is aligned to the zone system first.
+        codes : numpy.ndarray
+            Zone codes, -1 for missing zones.
+        fill_value : scalar, optional
+            Value for missing zones.
+
+        Returns
+        -------
+        numpy.ndarray
+        """
+        if isinstance(values, pd.Series):
+            values = self.align(values, fill_value)
+        values = np.asarray(values)
+        if values.dtype.kind in 'iub' and np.isnan(fill_value):
+            values = values.astype(float)
+        # code -1 picks the fill value appended after the last zone
+        return np.append(values, fill_value)[codes]
+
+    def align(self, values, fill_value=np.nan):
+        """
+        Values of a Series indexed by external zone id, in code order.
+        """
+        codes = self.encode(values.index.values)
+        found = codes >= 0
+        out = np.full(
+            len(self), fill_value,
+            dtype=np.result_type(values.dtype, np.asarray(fill_value)))
+        out[codes[found]] = values.values[found]
+        return out
+
+    def recode(self, codes, other):
+        """
+        Translate zone codes of this zone system into codes of `other`,
+        e.g. into the zones of a skim store, with a single gather.
+        """
+        if self.equals(other):
+            return codes
+        mapping = np.append(other.encode(self.zone_ids), -1)
+        return mapping[codes].astype(np.int32)
@@ -0,0 +1,213 @@
+import os
+
+import numpy as np
+import orca
+import pandas as pd
+import pytest
+
+from activitysynth.scripts import accessibility
+
+
+config = """
+name: network_aggregations
+node_col: node_id
+variable_definitions:
+  - name: units_sum_flat
+    dataframe: buildings
+    varname: units
+    radius: 3
+    decay: flat
+  - name: units_sum_linear
+    dataframe: buildings
+    varname: units
+    radius: 3
+    decay: linear
+  - name: units_sum_exp
+    dataframe: buildings
+    varname: units
+    radius: 2
+    decay: exp
+  - name: buildings_count
+    dataframe: buildings
+    radius: 3
+    aggregation: count
+  - name: buildings_count_exp
+    dataframe: buildings
+    radius: 2
+    aggregation: count
+    decay: exp
+  - name: mf_units_ave
+    dataframe: buildings
+    varname: units
+    filters:
+    - building_type_id == 3
+    radius: 3
+    aggregation: ave
+  - name: units_max
+    dataframe: buildings
+    varname: units
+    radius: 2
+    aggregation: max
+  - name: units_std
+    dataframe: buildings
+    varname: units
+    radius: 3
+    aggregation: std
+  - name: units_log_sum
+    dataframe: buildings
+    varname: units
+    radius: 3
+    apply: np.log1p
+"""
+
+
+@pytest.fixture
+def network(tmpdir, monkeypatch):
+    monkeypatch.setenv('DATA_HOME', str(tmpdir))
+    os.makedirs(str(tmpdir.join('configs')))
+    tmpdir.join('configs', 'aggregations.yaml').write(config)
+
+    rng = np.random.default_rng(0)
+    side = 8
+    node_ids = np.arange(side * side) + 100
+    xy = np.indices((side, side)).reshape(2, -1).astype(float)
+    nodes = pd.DataFrame({'x': xy[0], 'y': xy[1]}, index=node_ids)
+    u, v = [], []
+    for i in range(side):
+        for j in range(side):
+            if i + 1 < side:
+                u.append(i * side + j)
+                v.append((i + 1) * side + j)
+            if j + 1 < side:
+                u.append(i * side + j)
+                v.append(i * side + j + 1)
+    edges = pd.DataFrame({
+        'u': node_ids[u], 'v': node_ids[v],
+        'length': rng.uniform(0.5, 1.5, len(u))})
+
+    buildings = pd.DataFrame({
+        'node_id': rng.choice(node_ids, 200),
+        'units': rng.integers(1, 50, 200).astype(float),
+        'building_type_id': rng.choice([1, 3], 200)},
+        index=pd.Index(np.arange(200), name='building_id'))
+
+    yield nodes, edges, buildings
+    orca.clear_all()
+
+
+def _network(nodes, edges, twoway):
+    pdna = pytest.importorskip('pandana')
+    net = pdna.Network(
+        nodes.x, nodes.y, edges.u, edges.v, edges[['length']],
+        twoway=twoway)
+    net.precompute(3)
+    return net
+
+
+def _aggregations(nodes, edges, buildings, twoway):
+    orca.add_table('buildings', buildings)
+    net = _network(nodes, edges, twoway)
+    return accessibility.from_yaml(net, 'aggregations.yaml').fillna(0)
+
+
+def test_from_yaml_matches_urbansim(network):
+    networks = pytest.importorskip('urbansim.utils.networks')
+    nodes, edges, buildings = network
+    orca.add_table('buildings', buildings)
+    net = _network(nodes, edges, True)
+
+    expected = networks.from_yaml(net, 'aggregations.yaml')
+    pd.testing.assert_frame_equal(
+        accessibility.from_yaml(net, 'aggregations.yaml'), expected)
+
+
+def test_from_yaml_sets_each_variable_once(network, monkeypatch):
+    nodes, edges, buildings = network
+    orca.add_table('buildings', buildings)
+    net = _network(nodes, edges, True)
+    calls = []
+    set_variable = net.set
+
+    def set_once(node_ids, variable=None, name='tmp'):
+        calls.append(variable.name if variable is not None else None)
+        return set_variable(node_ids, variable=variable, name=name)
+
+    monkeypatch.setattr(net, 'set', set_once)
+    accessibility.from_yaml(net, 'aggregations.yaml')
+
+    # units unfiltered, units of building type 3, and building counts
+    assert sorted(calls, key=str) == [None, 'units', 'units']
+
+
+def _recomputed(nodes, edges, buildings, twoway):
+    """
+    Every variable recomputed at every node without pandana.
+    """
+    graph = accessibility._network_graph(nodes.index.values, edges, twoway)
+    positions = np.arange(len(nodes))
+    results = pd.DataFrame(index=nodes.index)
+    for definition in accessibility._load_variable_definitions(
+            'aggregations.yaml'):
+        source_nodes, values = accessibility._source_values(
+            buildings, definition)
+        results[definition['name']] = accessibility._recompute_nodes(
+            graph, positions, nodes.index.values, source_nodes, values,
+            definition)
+        if definition['apply'] is not None:
+            results[definition['name']] = results[definition['name']].apply(
+                eval(definition['apply']))
+    return results
+
+
+def _edit(buildings, nodes):
+    """
+    Edit one neighborhood: modify, move, add and remove buildings.
+    """
+    new = buildings.copy()
+    new.loc[[3, 4], 'units'] += 25
+    new.loc[5, 'node_id'] = nodes.index[10]
+    new.loc[6, 'building_type_id'] = 4 - new.loc[6, 'building_type_id']
+    new = new.drop([7, 8])
+    new.loc[500] = [nodes.index[20], 30., 3]
+    new['node_id'] = new['node_id'].astype(buildings['node_id'].dtype)
+    return new
+
+
+@pytest.mark.parametrize('twoway', [True, False])
+def test_update_from_yaml_matches_recompute_nodes(network, twoway):
+    nodes, edges, buildings = network
+    base = _recomputed(nodes, edges, buildings, twoway)
+    new = _edit(buildings, nodes)
+
+    expected = _recomputed(nodes, edges, new, twoway)
+    updated = accessibility.update_from_yaml(
+        base, 'aggregations.yaml', edges, {'buildings': buildings},
+        {'buildings': new}, twoway)
+
+    pd.testing.assert_frame_equal(
+        updated, expected, check_exact=False, rtol=1e-6, atol=1e-9)
+
+
+@pytest.mark.parametrize('twoway', [True, False])
+def test_update_from_yaml_matches_full_recompute(network, twoway):
+    nodes, edges, buildings = network
+    base = _aggregations(nodes, edges, buildings, twoway)
+    old_tables = {'buildings': buildings}
+    new = _edit(buildings, nodes)
+
+    expected = _aggregations(nodes, edges, new, twoway)
+    updated = accessibility.update_from_yaml(
+        base, 'aggregations.yaml', edges, old_tables, {'buildings': new},
+        twoway)
+
+    pd.testing.assert_frame_equal(
+        updated, expected, check_exact=False, rtol=1e-6, atol=1e-9)
+
+
+def test_update_from_yaml_without_changes(network):
+    nodes, edges, buildings = network
+    base = _aggregations(nodes, edges, buildings, True)
+    updated = accessibility.update_from_yaml(
+        base, 'aggregations.yaml', edges, {'buildings': buildings},
+        {'buildings': buildings.copy()}, True)
+    pd.testing.assert_frame_equal(updated, base)
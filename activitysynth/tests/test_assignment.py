@@ -0,0 +1,91 @@
+import numpy as np
+import pytest
+
+from activitysynth.scripts import assignment
+
+
+def _first_fit(alts, sizes, remaining):
+    remaining = remaining.astype(float)
+    accepted = np.zeros(len(alts), dtype=bool)
+    for i, (alt, size) in enumerate(zip(alts, sizes)):
+        if size <= remaining[alt]:
+            remaining[alt] -= size
+            accepted[i] = True
+    return accepted
+
+
+@pytest.mark.parametrize('unit_sizes', [True, False])
+def test_accept_is_first_fit_in_priority_order(unit_sizes):
+    rng = np.random.default_rng(0)
+    for _ in range(500):
+        n = rng.integers(1, 40)
+        alts = rng.integers(0, 5, n)
+        sizes = np.ones(n) if unit_sizes else \
+            rng.integers(1, 5, n).astype(float)
+        remaining = rng.integers(0, 8, 5).astype(float)
+        np.testing.assert_array_equal(
+            assignment.accept(alts, sizes, remaining),
+            _first_fit(alts, sizes, remaining))
+
+
+def test_accept_skips_choosers_that_do_not_fit():
+    accepted = assignment.accept(
+        np.array([0, 0, 0]), np.array([3., 5., 2.]), np.array([5.]))
+    np.testing.assert_array_equal(accepted, [True, False, True])
+
+
+def _choice_sets(rng, n, k, n_alts):
+    alt_pos = np.array([rng.choice(n_alts, k, replace=False)
+                        for _ in range(n)])
+    probs = rng.random((n, k))
+    return alt_pos, probs / probs.sum(axis=1, keepdims=True)
+
+
+@pytest.mark.parametrize('max_rounds', [1, 3, 10])
+def test_assign_never_exceeds_capacity(max_rounds):
+    rng = np.random.default_rng(1)
+    alt_pos, probs = _choice_sets(rng, 300, 5, 40)
+    sizes = rng.integers(1, 4, 300).astype(float)
+    capacity = rng.integers(0, 12, 40).astype(float)
+    remaining = capacity.copy()
+
+    chosen, conflicts = assignment.assign(
+        alt_pos, probs, sizes, remaining, rng, max_rounds)
+
+    placed = chosen >= 0
+    used = np.bincount(
+        chosen[placed], weights=sizes[placed], minlength=len(capacity))
+    assert (used <= capacity).all()
+    np.testing.assert_allclose(remaining, capacity - used)
+    assert len(conflicts) <= max_rounds
+    # choosers only get alternatives from their own choice set
+    assert (alt_pos[placed] == chosen[placed, None]).any(axis=1).all()
+
+
+def test_assign_only_redraws_losers():
+    rng = np.random.default_rng(2)
+    alt_pos, probs = _choice_sets(rng, 200, 4, 30)
+    sizes = np.ones(200)
+    remaining = np.full(30, 4.)
+
+    first = alt_pos[np.arange(200), assignment.draw(
+        probs, np.random.default_rng(3))]
+    winners = assignment.accept(first, sizes, remaining)
+    chosen, conflicts = assignment.assign(
+        alt_pos, probs, sizes, remaining, np.random.default_rng(3),
+        max_rounds=5)
+
+    # winners of the first round keep their first draw
+    np.testing.assert_array_equal(chosen[winners], first[winners])
+    assert conflicts[0] == (~winners).sum()
+    # some losers are placed in the later rounds
+    assert (chosen[~winners] >= 0).any()
+
+
+def test_assign_without_conflicts_takes_one_round():
+    rng = np.random.default_rng(4)
+    alt_pos, probs = _choice_sets(rng, 50, 3, 10)
+    chosen, conflicts = assignment.assign(
+        alt_pos, probs, np.ones(50), np.full(10, 50.), rng)
+    assert (chosen >= 0).all()
+    assert conflicts == [0]
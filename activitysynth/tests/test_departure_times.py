@@ -0,0 +1,48 @@
+import numpy as np
+import pytest
+import scipy.stats as st
+
+from activitysynth.scripts import departure_times
+
+
+# distributions with a closed-form inverse, one inverted from its
+# tabulated CDF and one whose bounds sit in its upper tail
+dists = [
+    (st.beta(a=1.58, b=1.14, loc=5.90, scale=3.07), 6, 9),
+    (st.vonmises_line(kappa=0.41, loc=16.99, scale=0.47), 15.5, 18.5),
+    (st.levy(loc=8.93, scale=0.30), 9, 15.5),
+]
+
+
+@pytest.mark.parametrize('dist, lower, upper', dists)
+def test_truncated_inverse_cdf_stays_in_bounds(dist, lower, upper):
+    rng = np.random.default_rng(0)
+    u = np.r_[0, rng.random(10000), np.nextafter(1, 0)]
+    lowers = rng.uniform(lower, (lower + upper) / 2, len(u))
+
+    x = departure_times.truncated_inverse_cdf(dist, u, lowers, upper)
+
+    assert ((x >= lowers) & (x < upper)).all()
+
+
+@pytest.mark.parametrize('dist, lower, upper', dists)
+def test_truncated_inverse_cdf_matches_rejection_sampling(
+        dist, lower, upper):
+    rng = np.random.default_rng(1)
+    x = departure_times.truncated_inverse_cdf(
+        dist, rng.random(20000), lower, upper)
+
+    # uniform proposals over the bounds, accepted by their density
+    proposals = rng.uniform(lower, upper, 400000)
+    envelope = 1.01 * dist.pdf(np.linspace(lower, upper, 10001)).max()
+    accepted = proposals[
+        rng.random(len(proposals)) * envelope < dist.pdf(proposals)][:20000]
+
+    assert len(accepted) == 20000
+    assert st.ks_2samp(x, accepted).pvalue > 0.01
+
+
+def test_truncated_inverse_cdf_without_mass():
+    with pytest.raises(ValueError):
+        departure_times.truncated_inverse_cdf(
+            st.uniform(loc=0, scale=1), np.array([0.5]), 2, 3)
@@ -0,0 +1,47 @@
+import numpy as np
+import pytest
+
+from activitysynth.scripts import sampling
+
+
+def _implied_probs(prob, alias):
+    """
+    Probability of drawing each column from alias tables: kept when
+    drawn itself, plus taken in place of every column aliased to it.
+    """
+    m, n = prob.shape
+    implied = prob.copy()
+    rows = np.repeat(np.arange(m), n)
+    np.add.at(implied, (rows, alias.ravel()), (1 - prob).ravel())
+    return implied / n
+
+
+@pytest.mark.parametrize('n', [1, 2, 7, 50])
+def test_alias_tables_reproduce_weights(n):
+    rng = np.random.default_rng(0)
+    weights = rng.random((20, n)) ** 3
+    weights[rng.random((20, n)) < 0.3] = 0
+    weights[0] = 0
+
+    prob, alias = sampling.alias_tables(weights)
+
+    expected = np.full(weights.shape, 1 / n)
+    totals = weights.sum(axis=1)
+    expected[totals > 0] = weights[totals > 0] / totals[totals > 0, None]
+    np.testing.assert_allclose(
+        _implied_probs(prob, alias), expected, rtol=0, atol=1e-12)
+    assert ((prob >= 0) & (prob <= 1 + 1e-12)).all()
+    assert alias.dtype == np.int32
+
+
+def test_alias_draws_follow_weights():
+    weights = np.array([[1., 0., 3., 4.], [0., 0., 0., 2.]])
+    prob, alias = sampling.alias_tables(weights)
+    rows = np.repeat([0, 1], 200000)
+
+    draws = sampling.alias_draws(
+        prob, alias, rows, np.random.default_rng(0))
+
+    freqs = np.bincount(draws[rows == 0], minlength=4) / 200000
+    np.testing.assert_allclose(freqs, [1 / 8, 0, 3 / 8, 1 / 2], atol=5e-3)
+    assert (draws[rows == 1] == 3).all()
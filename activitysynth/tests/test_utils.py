@@ -0,0 +1,53 @@
+import os
+
+import orca
+import pytest
+
+from activitysynth.scripts import utils
+
+
+step_config = """
+saved_object:
+  choosers: persons
+  alternatives: jobs
+  out_choosers: persons
+"""
+
+
+@pytest.fixture
+def steps(tmpdir, monkeypatch):
+    monkeypatch.setenv('DATA_HOME', str(tmpdir))
+    os.makedirs(str(tmpdir.join('configs')))
+    tmpdir.join('configs', 'location_choice.yaml').write(step_config)
+
+    @orca.step()
+    def load_step(buildings, skims_chunksize, input_fnames):
+        # tables only read as a fallback stay out of the list
+        try:
+            return orca.get_table('beam_skims_imputed').to_frame()
+        except FileNotFoundError:
+            return orca.get_table('beam_skims_raw').to_frame()
+
+    @orca.step()
+    def model_step(zones):
+        m = mm.get_step('location_choice')  # noqa: F821
+        m.run()
+
+    @orca.step()
+    def network_step():
+        orca.get_table('drive_nodes')
+        orca.get_table('walk_edges')
+
+    yield
+    orca.clear_all()
+
+
+def test_source_tables(steps):
+    assert utils.source_tables(['load_step']) == ['buildings', 'parcels',
+                                                   'zones']
+    assert utils.source_tables(['model_step']) == [
+        'buildings', 'households', 'jobs', 'parcels', 'persons', 'units',
+        'zones']
+    assert utils.source_tables(['network_step']) == []
+    assert utils.source_tables(['load_step', 'network_step']) == \
+        utils.source_tables(['load_step'])
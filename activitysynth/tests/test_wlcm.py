@@ -0,0 +1,115 @@
+import os
+
+import numpy as np
+import pandas as pd
+import pytest
+import yaml
+from urbansim.models.util import columns_in_formula
+
+wlcm = pytest.importorskip('activitysynth.scripts.wlcm')
+from activitysynth.scripts import utils  # noqa: E402
+from activitysynth.scripts.skims import SkimStore  # noqa: E402
+
+
+config_path = os.path.join(
+    os.path.dirname(__file__), '..', 'configs', 'WLCM_gen_tt_simple.yaml')
+
+zone_ids = np.array([1, 2, 3])
+
+
+@pytest.fixture
+def model():
+    with open(config_path) as f:
+        return yaml.safe_load(f)['saved_object']
+
+
+@pytest.fixture
+def skims():
+    """
+    Imputed skims with per-period columns, dist without a period and a
+    stale unsuffixed gen_tt_CAR that must not be read.
+    """
+    rng = np.random.default_rng(0)
+    index = pd.MultiIndex.from_product(
+        [zone_ids, zone_ids], names=['from_zone_id', 'to_zone_id'])
+    df = pd.DataFrame({'dist': rng.uniform(1000, 20000, len(index))},
+                      index=index)
+    for period in utils.skim_periods:
+        for impedance in ['gen_tt_CAR', 'gen_cost_CAR']:
+            df['{0}_{1}'.format(impedance, period)] = rng.uniform(
+                5, 60, len(index))
+    df['gen_tt_CAR'] = -1.
+    return df
+
+
+def _tables(model, rng, n_obs=20, n_alts=30):
+    columns = [
+        col for col in columns_in_formula(model['model_expression'])
+        if col not in ['dist', 'gen_tt_CAR', 'gen_cost_CAR',
+                       'total_jobs_gen_tt_CAR_15']]
+    observations = pd.DataFrame(
+        rng.integers(0, 2, (n_obs, len(columns))), columns=columns)
+    observations['zone_id_home'] = rng.choice(zone_ids, n_obs)
+    alternatives = pd.DataFrame({
+        'zone_id_work': rng.choice(zone_ids, n_alts),
+        'total_jobs_gen_tt_CAR_15': rng.integers(0, 1000, n_alts)})
+    return observations, alternatives
+
+
+def test_skim_interaction_terms_simulate_wlcm(model, skims, tmpdir):
+    store = SkimStore.from_frame(skims, str(tmpdir.join('skims')))
+    terms = wlcm.SkimInteractionTerms(store, period='AM')
+    rng = np.random.default_rng(1)
+    observations, alternatives = _tables(model, rng)
+
+    wlcm._shared.update({
+        'observations': observations, 'alternatives': alternatives,
+        'interaction_terms': [terms],
+        'term_codes': [terms.encode(observations, alternatives)],
+        'expression_columns': columns_in_formula(model['model_expression']),
+        'model_expression': model['model_expression'],
+        'fitted_parameters': np.asarray(model['fitted_parameters']),
+        'sampler': None, 'sample_size': model['alt_sample_size'],
+        'available': np.arange(len(alternatives))})
+    try:
+        chooser_pos = np.arange(len(observations))
+        alt_pos, probs = wlcm._batch_choice_sets(chooser_pos, 2)
+
+        df = wlcm._choice_table(
+            observations, alternatives, chooser_pos, alt_pos, [terms],
+            wlcm._shared['term_codes'], wlcm._shared['expression_columns'])
+    finally:
+        wlcm._shared.clear()
+
+    # every pair has valid skims, so no chooser falls back to uniform
+    # probabilities through missing values
+    np.testing.assert_allclose(probs.sum(axis=1), 1)
+    assert not (probs == 1 / probs.shape[1]).all(axis=1).any()
+
+    od = pd.MultiIndex.from_arrays([
+        np.repeat(observations['zone_id_home'].values, alt_pos.shape[1]),
+        alternatives['zone_id_work'].values[alt_pos.ravel()]])
+    np.testing.assert_array_equal(df['dist'], skims['dist'].loc[od])
+    np.testing.assert_array_equal(
+        df['gen_tt_CAR'], skims['gen_tt_CAR_AM'].loc[od])
+    np.testing.assert_array_equal(
+        df['gen_cost_CAR'], skims['gen_cost_CAR_AM'].loc[od])
+
+
+def test_period_skim_columns(skims):
+    columns = utils.period_skim_columns(skims.columns, 'AM')
+    assert columns == {
+        'dist': 'dist', 'gen_tt_CAR_AM': 'gen_tt_CAR',
+        'gen_cost_CAR_AM': 'gen_cost_CAR'}
+
+    # without period columns the unsuffixed ones are used as they are
+    columns = utils.period_skim_columns(['dist', 'gen_tt_CAR'], 'AM')
+    assert columns == {'dist': 'dist', 'gen_tt_CAR': 'gen_tt_CAR'}
+
+
+def test_check_imputed_skims(skims):
+    utils.check_imputed_skims(skims.columns)
+
+    # skims imputed before the periods, with unsuffixed AM measures
+    with pytest.raises(ValueError, match='EA, AM, MD, PM, EV'):
+        utils.check_imputed_skims(['dist', 'gen_tt_CAR', 'gen_cost_CAR'])
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from activitysynth.scripts.zones import ZoneSystem
+
+
+# small ids are encoded through a lookup table, large ones by search
+@pytest.fixture(params=[[3, 1, 7, 3], [10 ** 9 + 3, 10 ** 9 + 1, 10 ** 9]])
+def zone_system(request):
+    return ZoneSystem(request.param)
+
+
+def test_zone_ids_are_sorted_and_unique(zone_system):
+    assert len(zone_system) == 3
+    assert (np.diff(zone_system.zone_ids) > 0).all()
+
+
+def test_encode_known_ids(zone_system):
+    ids = zone_system.zone_ids
+    np.testing.assert_array_equal(
+        zone_system.encode(ids[[2, 0, 1, 0]]), [2, 0, 1, 0])
+    assert zone_system.encode(ids).dtype == np.int32
+
+
+def test_encode_nan_and_missing_ids(zone_system):
+    ids = zone_system.zone_ids
+    float_ids = np.array([ids[1], np.nan, ids[0] + 0.5, ids[2]], dtype=float)
+    np.testing.assert_array_equal(
+        zone_system.encode(float_ids), [1, -1, -1, 2])
+    np.testing.assert_array_equal(
+        zone_system.encode(np.array([-5, ids[0] - 1, ids[2] + 1, ids[0]])),
+        [-1, -1, -1, 0])
+
+
+def test_encode_no_ids(zone_system):
+    codes = zone_system.encode(np.array([], dtype=float))
+    assert len(codes) == 0
+    assert codes.dtype == np.int32
+
+
+def test_empty_zone_system():
+    zones = ZoneSystem(np.array([np.nan]))
+    assert len(zones) == 0
+    np.testing.assert_array_equal(
+        zones.encode(np.array([1., np.nan])), [-1, -1])
+    np.testing.assert_array_equal(zones.encode([3, 4]), [-1, -1])
+    assert np.isnan(zones.decode(np.array([-1]))).all()
+
+
+def test_decode_take_and_align():
+    zones = ZoneSystem([10, 20, 30])
+    codes = zones.encode([30, np.nan, 10])
+    np.testing.assert_array_equal(zones.decode(codes), [30, np.nan, 10])
+
+    values = pd.Series([1, 2, 5], index=[20, 10, 99])
+    np.testing.assert_array_equal(zones.align(values), [2, 1, np.nan])
+    np.testing.assert_array_equal(
+        zones.take(values, codes), [np.nan, np.nan, 2])
+
+
+def test_recode():
+    zones = ZoneSystem([10, 20, 30])
+    other = ZoneSystem([20, 30, 40])
+    np.testing.assert_array_equal(
+        zones.recode(np.array([0, 1, 2, -1]), other), [-1, 0, 1, -1])